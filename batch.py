@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+import os
+import sys
+import argparse
+
+import yaml
+
+from main import configure_moviepy
+from parsing import OutputConfig
+
+
+def _is_settings_file(filepath: str) -> bool:
+    # Round configs may share the folder, but only settings list rounds
+    try:
+        with open(filepath) as settings_filehandle:
+            contents = yaml.full_load(settings_filehandle)
+    except (OSError, yaml.YAMLError):
+        return False
+    return type(contents) == OutputConfig or (type(contents) == dict
+                                              and "rounds" in contents)
+
+
+def find_settings_files(paths: [str]) -> [str]:
+    """Settings files given, or found directly in the folders given"""
+    filepaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths += [
+                os.path.join(path, filename)
+                for filename in sorted(os.listdir(path))
+                if filename.endswith(".yaml")
+                and _is_settings_file(os.path.join(path, filename))
+            ]
+        elif os.path.isfile(path):
+            filepaths.append(path)
+        else:
+            print("Settings file ({}) not found".format(path))
+            sys.exit(1)
+    return filepaths
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description="Render several projects at once, sharing workers,"
+                    " memory and caches.")
+    parser.add_argument(
+        "-t", "--threads",
+        help="number of active round workers on CPU, for all projects"
+             " (default: the most any project uses)",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "-m", "--memory",
+        help="memory budget in GB for rendering rounds, for all projects"
+             " (0: use free memory)",
+        type=float,
+        default=0)
+    parser.add_argument(
+        "settings",
+        metavar="<SETTINGS>.yaml",
+        help="project settings files, or folders of them",
+        nargs="+")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    output_configs = [OutputConfig({"_settings": filepath})
+                      for filepath in find_settings_files(args.settings)]
+    if output_configs == []:
+        print("\r\nERROR: No settings files found")
+        sys.exit(1)
+    threads = args.threads or max(output_config.threads
+                                  for output_config in output_configs)
+    print("\r\nRendering %i projects with %i workers" % (
+        len(output_configs), threads))
+
+    configure_moviepy()
+    from run import make_batch
+    make_batch(output_configs, threads, args.memory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from constants import DAEMON_HOST, DAEMON_PORT, DAEMON_POLL_INTERVAL
+from credit import AudioCredit, RoundCredits, VideoCredit
+from parsing import OutputConfig, RoundConfig
+
+
+def _request(method: str, path: str, data: dict = None,
+             port: int = DAEMON_PORT, timeout: float = None) -> dict:
+    body = None if data is None else json.dumps(data).encode()
+    request = Request("http://%s:%i%s" % (DAEMON_HOST, port, path),
+                      data=body,
+                      method=method,
+                      headers={"Content-Type": "application/json"})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return json.load(response)
+    except HTTPError as err:
+        return json.load(err)
+
+
+def to_data(value):
+    """Settings, rounds and credits as JSON data, with absolute paths"""
+    if isinstance(value, (OutputConfig, RoundConfig)):
+        # Rounds are checked again, but the settings file isn't read, and
+        # unset items are left to their defaults
+        data = {
+            item: to_data(getattr(value, item))
+            for item in value.ITEMS
+            if (item == "_settings" or not item.startswith("_"))
+            and getattr(value, item) is not None
+        }
+        if data.get("_settings"):
+            data["_settings"] = os.path.abspath(data["_settings"])
+        return data
+    elif isinstance(value, (RoundCredits, AudioCredit, VideoCredit)):
+        return to_data(value.__dict__)
+    elif isinstance(value, dict):
+        return {key: to_data(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [to_data(item) for item in value]
+    return value
+
+
+def is_running(port: int = DAEMON_PORT) -> bool:
+    """Whether a render daemon is listening"""
+    try:
+        _request("GET", "/jobs", port=port, timeout=1)
+    except (URLError, OSError, ValueError):
+        return False
+    return True
+
+
+def submit(output_config: OutputConfig, port: int = DAEMON_PORT) -> dict:
+    """Submit a project to the render daemon, returning its job"""
+    job = _request("POST", "/jobs", {"config": to_data(output_config)}, port)
+    if "error" in job:
+        print(job.get("log", ""), end="")
+        print("\r\nERROR: %s" % job["error"])
+        sys.exit(1)
+    return job
+
+
+def cancel(job_id: int, port: int = DAEMON_PORT) -> dict:
+    return _request("POST", "/jobs/%i/cancel" % job_id, {}, port)
+
+
+def follow(job_id: int, port: int = DAEMON_PORT) -> str:
+    """
+    Print a job's log as it renders, returning how it ended. Interrupting
+    cancels the job, and interrupting again stops following it.
+    """
+    offset = 0
+    cancelled = False
+    while True:
+        try:
+            update = _request("GET", "/jobs/%i/log?offset=%i" % (
+                job_id, offset), port=port)
+            print(update["log"], end="", flush=True)
+            offset = update["offset"]
+            if update["state"] in ["done", "failed", "cancelled"]:
+                return update["state"]
+            time.sleep(DAEMON_POLL_INTERVAL)
+        except URLError:
+            print("\r\nERROR: Lost the render daemon")
+            return "failed"
+        except KeyboardInterrupt:
+            if cancelled:
+                print("\r\nStopped following job %i" % job_id)
+                return "running"
+            print("\r\nCancelling job %i; its running steps will finish"
+                  % job_id)
+            cancel(job_id, port)
+            cancelled = True
+
+
+def render(output_config: OutputConfig, port: int = DAEMON_PORT):
+    """Render a project with the render daemon, as `make` would"""
+    try:
+        job = submit(output_config, port)
+    except URLError:
+        print("\r\nERROR: No render daemon on port %i; start daemon.py"
+              % port)
+        sys.exit(1)
+    print("\r\nSubmitted %s as job %i, saving videos in %s" % (
+        job["name"], job["id"], job["folder"]))
+    if follow(job["id"], port) != "done":
+        sys.exit(1)
@@ -0,0 +1,65 @@
+import random
+
+import numpy as np
+
+CUT_DTYPE = np.dtype([
+    ("source", np.int32),  # index of the source in the round's sources
+    ("start", np.float64),  # in and out points in the source
+    ("stop", np.float64),
+    ("position", np.float64),  # start in the round
+    ("version", np.int8),  # index of the chosen version
+])
+
+
+class SourceFile:
+    """A source video, only opened once it is first cut from"""
+    __slots__ = ("start", "filename", "path", "duration", "_open_clip",
+                 "_clip")
+
+    @staticmethod
+    def get_random_start(rng: random.Random = random):
+        """Skip first 15-25 seconds"""
+        return 15 + rng.random() * 10
+
+    def __init__(self, filename: str, duration: float, open_clip,
+                 path: str = None):
+        """
+        open_clip: returns a VideoFileClip of the source, when called
+        path: the file the clip is opened from, if not `filename` itself
+        """
+        self.start = SourceFile.get_random_start()
+        self.filename = filename
+        self.path = path or filename
+        self.duration = duration
+        self._open_clip = open_clip
+        self._clip = None
+
+    @property
+    def clip(self):
+        """The source's VideoFileClip, opened if it isn't already"""
+        if self._clip is None:
+            self._clip = self._open_clip()
+        return self._clip
+
+    @property
+    def is_open(self) -> bool:
+        return self._clip is not None
+
+    def close(self):
+        """Close the source's readers, to be opened again if it is cut"""
+        if self._clip is not None:
+            self._clip.close()
+            self._clip = None
+
+
+class Compilation:
+    """
+    A round's chosen cuts, in timeline order, as a structured array of
+    CUT_DTYPE, and the sources they are cut from. Clips are only made
+    from the cuts when the round is rendered.
+    """
+    __slots__ = ("sources", "cuts")
+
+    def __init__(self, sources: [SourceFile], cuts: np.ndarray):
+        self.sources = sources
+        self.cuts = cuts
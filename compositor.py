@@ -0,0 +1,113 @@
+import numpy as np
+from moviepy.audio.AudioClip import CompositeAudioClip
+from moviepy.video.VideoClip import VideoClip
+
+from constants import FADE_DURATION
+
+ALIGNMENTS = {"left": 0, "top": 0, "center": 0.5, "right": 1, "bottom": 1}
+
+
+class RoundCompositor:
+    """
+    Makes the frames of a round from a flat list of layers: its cuts, a
+    beatmeter band over them, if any, and fades in from and out to black.
+
+    Frames are made in one reused buffer: the beatmeter is only blended
+    within its bounding box, and fades scale the buffer in place. Each
+    frame is overwritten by the next, so it must be used (or copied)
+    before the next one is made, as moviepy's writers do.
+    """
+
+    def __init__(
+        self,
+        base: VideoClip,
+        overlay: VideoClip,
+        duration: float,
+        dims: (int, int),
+        fade_duration: float = FADE_DURATION,
+    ):
+        self.base = base
+        self.overlay = overlay
+        self.duration = duration
+        self.fade_duration = fade_duration
+        self._frame = np.zeros((dims[1], dims[0], 3), dtype=np.uint8)
+        self._scratch = None
+
+    def get_fade(self, t: float) -> float:
+        """Brightness at time `t`, from 0 (black) to 1 (unfaded)"""
+        t -= self.fade_duration
+        if t < 0 or t >= self.duration:
+            return 0
+        fade_in = min(1, t / self.fade_duration)
+        fade_out = min(1, (self.duration - t) / self.fade_duration)
+        return fade_in * fade_out
+
+    def make_frame(self, t: float) -> np.ndarray:
+        frame = self._frame
+        fade = self.get_fade(t)
+        if fade == 0:
+            frame.fill(0)
+            return frame
+        t -= self.fade_duration
+        np.copyto(frame, self.base.get_frame(t), casting="unsafe")
+        if self.overlay is not None and self.overlay.is_playing(t):
+            self._blend(self.overlay, t)
+        if fade < 1:
+            np.multiply(frame, fade, out=frame, casting="unsafe")
+        return frame
+
+    def _blend(self, clip: VideoClip, t: float):
+        t -= clip.start
+        image = clip.get_frame(t)
+        height, width = self._frame.shape[:2]
+        x, y = [
+            int(ALIGNMENTS[p] * (size - clip_size)) if isinstance(p, str)
+            else int(p)
+            for p, size, clip_size in zip(clip.pos(t),
+                                          (width, height),
+                                          (image.shape[1], image.shape[0]))
+        ]
+
+        # Only the part of the clip within the frame is blended
+        left, top = max(0, -x), max(0, -y)
+        right = min(image.shape[1], width - x)
+        bottom = min(image.shape[0], height - y)
+        if left >= right or top >= bottom:
+            return
+        image = image[top:bottom, left:right, :3]
+        region = self._frame[y + top:y + bottom, x + left:x + right]
+        if clip.mask is None:
+            region[...] = image
+            return
+
+        # region + mask * (image - region), in a reused float buffer
+        mask = clip.mask.get_frame(t)[top:bottom, left:right, np.newaxis]
+        if self._scratch is None or self._scratch.shape != region.shape:
+            self._scratch = np.empty(region.shape, dtype=np.float32)
+        scratch = self._scratch
+        np.subtract(image, region, out=scratch, dtype=np.float32)
+        scratch *= mask
+        scratch += region
+        np.copyto(region, scratch, casting="unsafe")
+
+
+def composite_round(
+    base: VideoClip,
+    beatmeter: VideoClip,
+    duration: float,
+    dims: (int, int),
+    fade_duration: float = FADE_DURATION,
+) -> VideoClip:
+    """
+    The round's video, fading in from and out to black, with the beatmeter
+    over it: the same frames as crossfading a CompositeVideoClip of them
+    """
+    compositor = RoundCompositor(base, beatmeter, duration, dims,
+                                 fade_duration)
+    video = VideoClip(compositor.make_frame,
+                      duration=duration + 2 * fade_duration)
+    if base.audio is not None:
+        video = video.set_audio(CompositeAudioClip([
+            base.audio.set_duration(duration).set_start(fade_duration)
+        ]).set_duration(video.duration))
+    return video
@@ -5,3 +5,36 @@ FADE_DURATION = 1.0
 START_DIR = "."
 FFMPEG_PRESET = "ultrafast"
 DEFAULT_FPS = 60
+PREVIEW_FPS = 15
+PREVIEW_LOOKAHEAD = 3
+PREVIEW_ROUNDS = 2  # rounds planning versions, and loading previews, at once
+CACHE_FOLDER = "~/.chap"
+PROXY_HEIGHT = 360
+PROXY_FPS = PREVIEW_FPS
+MEZZANINE_GOP = 0.5  # seconds between keyframes
+MEZZANINE_CRF = 16
+PREVIEW_THUMBNAILS = 4
+SCORE_SAMPLES = 5
+SCORE_MARGIN = 0.1
+STREAM_SPILL_SIZE = 256 * 1024 ** 2
+AUDIO_FPS = 44100
+DAEMON_HOST = "127.0.0.1"  # only local clients
+DAEMON_PORT = 8462
+DAEMON_POLL_INTERVAL = 0.5  # seconds between log reads
+DAEMON_LOG_SIZE = 1024 ** 2  # last characters kept of each job's log
+DAEMON_FINISHED_JOBS = 32  # finished jobs kept, for their logs
+WORKER_PORT = 8463
+WORKER_SLICE = 8  # cuts per slice of a source sent to a worker
+WORKER_RETRIES = 3
+WORKER_CONNECT_TIMEOUT = 5  # seconds
+WORKER_REPLY_TIMEOUT = 60  # seconds to save a slice, plus
+WORKER_TIMEOUT_RATIO = 20  # seconds per second of its cuts
+ROUND_CHECKPOINT = 60  # seconds of a round's video saved at a time
+INTERMEDIATE_PROFILES = {
+    # extension, video codec, ffmpeg parameters, audio codec
+    "h264": ("mp4", None, [], None),
+    "h264-intra": ("mkv", "libx264", ["-g", "1", "-crf", "10"], "pcm_s16le"),
+    "ffv1": ("mkv", "ffv1", ["-level", "3", "-g", "1", "-slices", "16",
+                             "-slicecrc", "0"], "pcm_s16le"),
+    "utvideo": ("mkv", "utvideo", ["-pred", "left"], "pcm_s16le"),
+}
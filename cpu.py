@@ -0,0 +1,74 @@
+import os
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class Allocation:
+    def __init__(self, threads: int, cpus: [int]):
+        self.threads = threads
+        self.cpus = cpus
+
+
+class CpuBudget:
+    """
+    Shares the machine's CPUs between concurrent ffmpeg processes.
+
+    Each encoder gets the free CPUs divided between the encoder slots that
+    aren't in use yet; each decoder gets one CPU. CPUs return to the pool
+    when their process finishes, so encoders that start later get more.
+    When the pool is empty, processes still start, with one thread.
+    """
+
+    def __init__(self, cpus: int = None):
+        self.cpus = cpus or os.cpu_count() or 1
+        self._free = list(range(self.cpus))
+        self._encoders = 0
+        self._lock = Lock()
+
+    @contextmanager
+    def allocate(self, name: str, slots: int = 1, encoder: bool = True):
+        """slots: how many encoders are expected to run at once"""
+        with self._lock:
+            if encoder:
+                share = len(self._free) // max(1, slots - self._encoders)
+                self._encoders += 1
+            else:
+                share = 1
+            cpus = self._free[:share]
+            del self._free[:len(cpus)]
+        if encoder:
+            print("\r\n%s using %i of %i CPUs" % (
+                name, max(1, len(cpus)), self.cpus))
+        try:
+            yield Allocation(max(1, len(cpus)), cpus)
+        finally:
+            with self._lock:
+                self._free = sorted(self._free + cpus)
+                if encoder:
+                    self._encoders -= 1
+
+
+_budget = CpuBudget()
+
+
+def allocate(name: str, slots: int = 1, encoder: bool = True):
+    """Reserve CPUs for an ffmpeg process while in the context"""
+    return _budget.allocate(name, slots, encoder)
+
+
+def pin(pid: int, cpus: [int]):
+    """Restrict a process to the given CPUs, where the OS allows it"""
+    if cpus == []:
+        return
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(pid, cpus)
+        elif psutil is not None:
+            psutil.Process(pid).cpu_affinity(cpus)
+    except Exception as e:
+        print("\r\nCould not pin process %i: %s" % (pid, e))
@@ -1,23 +1,39 @@
 from abc import ABCMeta, abstractmethod
 import random
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
-from tkinter import TclError
 
-from moviepy.Clip import Clip
-from moviepy.video.io.VideoFileClip import VideoFileClip
-from moviepy.video.fx.resize import resize
+import numpy as np
 
-from utils import draw_progress_bar, SourceFile
+# moviepy and Tk are only imported to open sources and show previews, so
+# cuts can be planned without them, as by --plan
+from compilation import CUT_DTYPE, Compilation, SourceFile
 from parsing import BeatMeterConfig, OutputConfig, RoundConfig
-from preview import PreviewGUI
+from constants import DISPLAY_SIZE, PREVIEW_FPS, PREVIEW_LOOKAHEAD, \
+    PREVIEW_THUMBNAILS
+from probe import get_keyframes, get_video_info
+from scoring import Measurements, Scorer, measure
+from transcode import TranscodeCache
 
 
 def get_cutter(
     stack: ExitStack,
     output_config: OutputConfig,
-    round_config: RoundConfig
+    round_config: RoundConfig,
+    proxies: TranscodeCache = None,
+    previews=None,
+    round_index: int = 0,
+    mezzanines: TranscodeCache = None,
+    seed: int = None,
 ):
-    sources = [SourceFile(stack.enter_context(VideoFileClip(s)))
+    """
+    previews: a PreviewQueue shared by rounds planned concurrently
+    seed: of the project's random choices, so rounds are cut the same way
+    every time, or None to cut them differently
+    """
+    sources = [_get_source(stack, s, mezzanines)
                for s in round_config.sources]
     bmcfg = (round_config.beatmeter_config
              if round_config.bmcfg else None)
@@ -35,7 +51,120 @@ def get_cutter(
                   round_config.speed,
                   round_config.bpm,
                   bmcfg,
-                  sources)
+                  sources,
+                  proxies,
+                  previews,
+                  round_index,
+                  output_config.preview,
+                  output_config.score,
+                  random.Random(None if seed is None
+                                else "%i/%s" % (seed, round_config.name)))
+
+
+def _get_source(
+    stack: ExitStack,
+    filename: str,
+    mezzanines: TranscodeCache = None,
+) -> SourceFile:
+    # Cut from the source's mezzanine, if it was transcoded
+    mezzanine = mezzanines.get(filename) if mezzanines is not None else None
+    clip_filename = mezzanine or filename
+
+    def open_clip():
+        from moviepy.video.io.VideoFileClip import VideoFileClip
+        return stack.enter_context(VideoFileClip(clip_filename))
+
+    # Sources are only opened when rendering, if they can be probed
+    source = SourceFile(filename, None, open_clip, clip_filename)
+    info = get_video_info(clip_filename)
+    source.duration = (info["duration"] if info is not None
+                       else source.clip.duration)
+    return source
+
+
+def draw_progress_bar(percent: float, barLen: int = 20):
+    """
+    REQ: percent in interval [0, 1]
+    """
+    # https://stackoverflow.com/questions/3002085/
+    assert percent >= 0 and percent <= 1
+    sys.stdout.write("\r")
+    sys.stdout.write("{:<{}} {:.0f}%".format(
+        "." * int(barLen * percent), barLen, percent * 100))
+    sys.stdout.flush()
+
+
+def print_plans(output_config: OutputConfig):
+    """
+    Plan the cuts of every round, taking the first version of each, and
+    print what they would be, without opening the sources to render them.
+    Versions are still planned, as they change the random choices.
+    """
+    for r_i, round_config in enumerate(output_config.rounds):
+        with ExitStack() as stack:
+            cutter = get_cutter(stack, output_config, round_config,
+                                round_index=r_i, seed=output_config.seed)
+            compilation = cutter.get_compilation(choose=False)
+        cuts = compilation.cuts
+        lengths = cuts["stop"] - cuts["start"]
+        print("\r\nRound #%i (%s): %i cuts, %.2f-%.2fs long, from %i of %i"
+              " sources, %.1fs" % (
+                  r_i + 1, round_config.name, len(cuts),
+                  lengths.min() if len(lengths) else 0,
+                  lengths.max() if len(lengths) else 0,
+                  len(np.unique(cuts["source"])), len(compilation.sources),
+                  round_config.duration))
+        for s_i, source in enumerate(compilation.sources):
+            used = lengths[cuts["source"] == s_i]
+            print("    %4i cuts, %7.1fs of %7.1fs: %s" % (
+                len(used), used.sum(), source.duration, source.filename))
+
+
+class _Preview:
+    """
+    Readers and clips of the versions of one cut, with either prefetched
+    frames of their preview grid, or thumbnails for a contact sheet
+    """
+
+    def __init__(
+        self,
+        clips: list,
+        readers: list,
+        positions: [(int, float, float)],
+        frames=None,
+        thumbnails: list = None,
+        measurements: Measurements = None,
+    ):
+        self.clips = clips
+        self.positions = positions
+        self.frames = frames
+        self.thumbnails = thumbnails
+        self.measurements = measurements
+        self.best = 0
+        self._readers = readers
+
+    def show(self, choose):
+        """Show the preview's window, unless there's no display for it"""
+        try:
+            from tkinter import TclError
+            from viewer import ContactSheetGUI, PreviewGUI
+        except ImportError as e:
+            print("\r\nCannot show previews: %s" % e)
+            return
+        try:
+            if self.thumbnails is not None:
+                ContactSheetGUI(self.clips, self.thumbnails, choose,
+                                selected=self.best).run()
+            else:
+                PreviewGUI(self.clips, choose, frames=self.frames).run()
+        except TclError:
+            pass
+
+    def close(self):
+        if self.frames is not None:
+            self.frames.close()
+        for reader in self._readers:
+            reader.close()
 
 
 class _AbstractCutter(metaclass=ABCMeta):
@@ -49,8 +178,15 @@ class _AbstractCutter(metaclass=ABCMeta):
         speed: int,
         bpm: float,
         beatmeter_config: BeatMeterConfig,
-        sources: [VideoFileClip]
-    ) -> [Clip]:
+        sources: [SourceFile],
+        proxies: TranscodeCache = None,
+        previews=None,
+        round_index: int = 0,
+        preview_mode: str = "video",
+        score: str = "off",
+        rng: random.Random = None,
+    ):
+        """rng: makes all of the round's random choices"""
         self.versions = versions
         self.fps = fps
         self.dims = dims
@@ -59,16 +195,92 @@ class _AbstractCutter(metaclass=ABCMeta):
         self.bpm = bpm
         self.sources = sources
         self.bmcfg = beatmeter_config
-        self.all_sources_length = sum(map(lambda s: s.clip.duration, sources))
+        self.all_sources_length = sum(map(lambda s: s.duration, sources))
         self._index = 0
+        self._proxies = proxies
+        self._previews = previews
+        self._round_index = round_index
+        self.preview_mode = preview_mode
+        self.score = score
+        self._scorer = Scorer()
+        self._cut_index = 0
+        self.rng = rng or random.Random()
+        for source in sources:
+            source.start = SourceFile.get_random_start(self.rng)
 
     @abstractmethod
     def get_source_clip_index(self, length: float) -> int:
         pass
 
-    def get_compilation(self):
+    def get_compilation(self, choose: bool = True) -> Compilation:
+        """choose: preview versions, or else take the first of each cut"""
+        previewing = choose and self.versions > 1
+        chosen = []
+        cuts = self._plan_cuts()
+        planned = deque()
+        speculation = deque()
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            while True:
+                # Plan ahead, preparing previews of the next cuts meanwhile
+                lookahead = 1 + (PREVIEW_LOOKAHEAD if previewing else 0)
+                while len(planned) < lookahead:
+                    cut = next(cuts, None)
+                    if cut is None:
+                        break
+                    planned.append(cut)
+                    if previewing:
+                        speculation.append(executor.submit(
+                            self._prepare_preview, *cut[1:]))
+                if len(planned) == 0:
+                    break
+                current_time, length, candidates = planned.popleft()
+                self._cut_index += 1
+
+                self._chosen = None
+                if previewing and len(speculation) > 0:
+                    try:
+                        preview = speculation.popleft().result()
+                    except Exception as e:
+                        print("\r\nPreview failed to load: %s" % e)
+                        preview = None
+                        self.versions = 1
+                    if preview is not None:
+                        try:
+                            self.choose_version(preview)
+                        finally:
+                            preview.close()
+                    if self.versions == 1:
+                        # Previews were disabled: discard speculative work
+                        previewing = False
+                        self._discard(speculation)
+
+                # Cut from the chosen version's source
+                version = self._chosen or 0
+                i, start = candidates[version]
+                chosen.append((i, start, start + length, current_time,
+                               version))
+
+                # TODO: move progress into GUI
+                if previewing:
+                    draw_progress_bar(
+                        min(1, (current_time + length) / self.duration), 80)
+        finally:
+            self._discard(speculation)
+            executor.shutdown(wait=True)
+        if previewing:
+            print("\nDone!")
+
+        return Compilation(self.sources, np.array(chosen, dtype=CUT_DTYPE))
+
+    def _plan_cuts(self):
+        """
+        Generate the start time, length and (source index, start) candidates
+        for each cut in the round. Candidates don't depend on which version
+        is chosen, so cuts can be planned before the previous cut's choice.
+        """
         duration = self.duration
-        clips = []
 
         # Cut randomized clips from random videos in chronological order
 
@@ -124,56 +336,136 @@ class _AbstractCutter(metaclass=ABCMeta):
                 length = seconds_per_beat * max(1, current_multiple)
 
             # Cut multiple clips from various sources
-            out_clips = []
+            candidates = []
             for _ in range(self.versions):
                 # Advance all clips by simlar percentage of total duration
                 self.advance_sources(length, current_time)
 
                 # Get the next clip source
                 i = self.get_source_clip_index(length)
-                out_clip = self.sources[i].clip
-                start = self.sources[i].start
-
-                # Cut a subclip
-                out_clip = out_clip.subclip(start, start + length)
-                out_clip = resize(out_clip, self.dims)
-                out_clips.append(out_clip)
+                candidates.append((i, self.sources[i].start))
 
-            self.choose_version(out_clips)
-            clips.append(out_clips[self._chosen or 0])
+            yield current_time, length, candidates
 
             current_time += length
 
-            # TODO: move progress into GUI
-            if self.versions > 1:
-                draw_progress_bar(min(1, current_time / duration), 80)
-        if self.versions > 1:
-            print("\nDone!")
-
-        return clips
-
     @abstractmethod
     def advance_sources(self, length: float, current_time: float):
         pass
 
-    def choose_version(self, clips) -> int:
+    def get_preview_clip(
+        self,
+        readers: dict,
+        source: SourceFile,
+        start: float,
+        length: float
+    ):
+        """Cut from the source's low resolution proxy, once it is ready"""
+        from moviepy.video.io.VideoFileClip import VideoFileClip
+
+        filename = self._get_preview_filename(source)
+        if filename not in readers:
+            readers[filename] = VideoFileClip(filename, audio=False)
+        return readers[filename].subclip(start, start + length)
+
+    def _get_preview_filename(self, source: SourceFile) -> str:
+        proxy = (self._proxies.get(source.filename)
+                 if self._proxies is not None else None)
+        return proxy or source.filename
+
+    def _prepare_preview(self, length: float, candidates: [(int, float)]):
+        """Open, combine and start decoding previews of a cut's versions"""
+        from preview import FrameBuffer, make_preview_video, make_thumbnails
+
+        readers = {}
+        positions = [(i, start, start + length) for i, start in candidates]
+        try:
+            clips = [self.get_preview_clip(readers, self.sources[i], start,
+                                           length)
+                     for i, start in candidates]
+            measurements = None
+            if self.score != "off":
+                measurements = measure(clips)
+            if self.score == "auto":
+                return _Preview(clips, list(readers.values()), positions,
+                                measurements=measurements)
+            if self.preview_mode == "sheet":
+                thumbnails = []
+                for clip, (i, start) in zip(clips, candidates):
+                    # Fit all rows, and strips into half the display width
+                    height = min(DISPLAY_SIZE[1] // len(candidates),
+                                 int(DISPLAY_SIZE[0] / 2 / PREVIEW_THUMBNAILS
+                                     * clip.h / clip.w))
+                    keyframes = [
+                        t - start for t in get_keyframes(
+                            self._get_preview_filename(self.sources[i]))
+                        if start <= t < start + length
+                    ]
+                    thumbnails.append(make_thumbnails(clip, keyframes,
+                                                      height))
+                return _Preview(clips, list(readers.values()), positions,
+                                thumbnails=thumbnails,
+                                measurements=measurements)
+            frames = FrameBuffer(make_preview_video(clips), PREVIEW_FPS,
+                                 ahead=1.0, behind=0)
+        except Exception:
+            for reader in readers.values():
+                reader.close()
+            raise
+        return _Preview(clips, list(readers.values()), positions,
+                        frames=frames,
+                        measurements=measurements)
+
+    def _discard(self, speculation: deque):
+        while len(speculation) > 0:
+            future = speculation.popleft()
+            if not future.cancel():
+                try:
+                    future.result().close()
+                except Exception:
+                    pass
+
+    def choose_version(self, preview) -> int:
         self._chosen = None
+
+        # Pick the best scoring version, unless it's too close to call
+        if preview.measurements is not None:
+            scores = self._scorer.score(preview.measurements,
+                                        preview.positions)
+            preview.best = int(scores.argmax())
+            if self.score == "auto" or not self._scorer.is_close(scores):
+                self._chosen = preview.best
+                self._scorer.remember(preview.measurements,
+                                      preview.positions,
+                                      self._chosen)
+                return self._chosen
+
+        if self.versions > 1 and self._previews is not None:
+            # Wait in line with other rounds' previews
+            self._chosen = self._previews.choose(
+                (self._round_index, self._cut_index), preview)
+        elif self.versions > 1:
+            preview.show(self._choose)
         if self.versions > 1:
-            try:
-                PreviewGUI(clips, self._choose).run()
-            except TclError:
-                pass
-            if self._chosen is None:
+            if self._chosen is None and preview.measurements is not None:
+                print("\r{}".format("Preview disabled: choices scored"))
+                self.score = "auto"
+                self._chosen = preview.best
+            elif self._chosen is None:
                 print("\r{}".format("Preview disabled: choices randomized"))
                 self.versions = 1
+        if self._chosen is not None and preview.measurements is not None:
+            self._scorer.remember(preview.measurements,
+                                  preview.positions,
+                                  self._chosen)
         return self._chosen
 
     def _choose(self, version: int):
         self._chosen = version
 
     def _set_start(self, source: SourceFile, start: float, length: float):
-        random_start = SourceFile.get_random_start()
-        if source.clip.duration > 3 * random_start:
+        random_start = SourceFile.get_random_start(self.rng)
+        if source.duration > 3 * random_start:
             min_start = random_start
         else:
             min_start = 0
@@ -186,9 +478,10 @@ class _AbstractCutter(metaclass=ABCMeta):
         current_time: float
     ):
         current_progress = current_time / self.duration
-        time_in_source = current_progress * source.clip.duration
-        randomized_start = random.gauss(time_in_source, self.versions * length)
-        randomized_start = min(randomized_start, source.clip.duration - length)
+        time_in_source = current_progress * source.duration
+        randomized_start = self.rng.gauss(time_in_source,
+                                          self.versions * length)
+        randomized_start = min(randomized_start, source.duration - length)
         self._set_start(source, randomized_start, length)
 
 
@@ -197,8 +490,8 @@ class _AbstractRandomSelector(_AbstractCutter):
         i = -1
         counter = 0
         while i == -1:
-            i = random.randrange(0, len(self.sources))
-            if self.sources[i].start + length > self.sources[i].clip.duration:
+            i = self.rng.randrange(0, len(self.sources))
+            if self.sources[i].start + length > self.sources[i].duration:
                 i = -1
                 counter += 1
             if counter >= 1000:
@@ -217,9 +510,9 @@ class Interleaver(_AbstractRandomSelector):
 class Randomizer(_AbstractRandomSelector):
     def advance_sources(self, length: float, current_time: float):
         for source in self.sources:
-            max_start = source.clip.duration - length
-            randomized_start = random.uniform(0, max_start)
-            max_start = source.clip.duration - length
+            max_start = source.duration - length
+            randomized_start = self.rng.uniform(0, max_start)
+            max_start = source.duration - length
             randomized_start = min(randomized_start, max_start)
             self._set_start(source, randomized_start, length)
 
@@ -227,7 +520,7 @@ class Randomizer(_AbstractRandomSelector):
 class Sequencer(_AbstractCutter):
     def get_source_clip_index(self, length: float) -> int:
         source = self.sources[self._index]
-        if source.start + length > source.clip.duration:
+        if source.start + length > source.duration:
             print("Warning: not enough source material")
             source.start /= 2
             return self.get_source_clip_index(length)
@@ -244,7 +537,7 @@ class Sequencer(_AbstractCutter):
 class Skipper(_AbstractCutter):
     def get_source_clip_index(self, length: float) -> int:
         source = self.sources[self._index]
-        if source.start + length >= source.clip.duration:
+        if source.start + length >= source.duration:
             self._index += 1
             self._set_start(self.sources[self._index], 0, length)
         if self._index >= len(self.sources):
@@ -256,14 +549,15 @@ class Skipper(_AbstractCutter):
 
     def advance_sources(self, length: float, current_time: float):
         source = self.sources[self._index]
-        length_fraction = source.clip.duration / self.all_sources_length
+        length_fraction = source.duration / self.all_sources_length
         completed_fraction = sum(map(
-            lambda s: s.clip.duration,
+            lambda s: s.duration,
             self.sources[:self._index]))
         completed_fraction /= self.all_sources_length
         current_progress = current_time / self.duration
         current_progress_in_source = ((current_progress - completed_fraction)
                                       / length_fraction)
-        time_in_source = current_progress_in_source * source.clip.duration
-        randomized_start = random.gauss(time_in_source, self.versions * length)
+        time_in_source = current_progress_in_source * source.duration
+        randomized_start = self.rng.gauss(time_in_source,
+                                          self.versions * length)
         self._set_start(source, randomized_start, length)
@@ -0,0 +1,400 @@
+#! /usr/bin/env python3
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs, urlparse
+
+from constants import DAEMON_FINISHED_JOBS,\
+    DAEMON_HOST,\
+    DAEMON_LOG_SIZE,\
+    DAEMON_PORT
+from jobs import Job, JobGraph
+from main import configure_moviepy
+from parsing import OutputConfig
+from run import SharedCaches, get_resources, make_project
+
+
+class JobLog:
+    """
+    Text printed for a render job, read from an offset as it grows. Only
+    the last `size` characters are kept, but offsets count from the start.
+    """
+
+    def __init__(self, size: int = DAEMON_LOG_SIZE):
+        self.size = size
+        self._chunks = []
+        self._length = 0  # of the chunks
+        self._start = 0  # offset of the first character kept
+        self._lock = threading.Lock()
+
+    def write(self, text: str):
+        with self._lock:
+            self._chunks.append(text)
+            self._length += len(text)
+            if self._length > 2 * self.size:
+                self._trim()
+
+    def _trim(self):
+        text = "".join(self._chunks)[-self.size:]
+        self._start += self._length - len(text)
+        self._chunks = [text]
+        self._length = len(text)
+
+    def read(self, offset: int = 0) -> (int, str):
+        """The offset of the text kept from `offset` on, and that text"""
+        with self._lock:
+            self._trim()
+            offset = max(offset, self._start)
+            return offset, self._chunks[0][offset - self._start:]
+
+
+class LogRouter:
+    """
+    Stands in for stdout and stderr, so that what each thread prints also
+    goes to the log of the job it is working for. Threads working for no
+    job, like the shared transcoders, only print to the console, unless
+    a fallback log is capturing them.
+    """
+
+    def __init__(self, console):
+        self.console = console
+        self.fallback = None
+        self._local = threading.local()
+
+    def write(self, text: str):
+        log = getattr(self._local, "log", None) or self.fallback
+        if log is not None:
+            log.write(text)
+        return self.console.write(text)
+
+    def flush(self):
+        self.console.flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.console, name)
+
+    @contextmanager
+    def route(self, log: JobLog):
+        """Send what this thread prints to `log`, too"""
+        previous = getattr(self._local, "log", None)
+        self._local.log = log
+        try:
+            yield
+        finally:
+            self._local.log = previous
+
+
+class RenderJob:
+    """A project submitted to the service, rendered in its own job graph"""
+
+    def __init__(self, job_id: int, output_config: OutputConfig,
+                 graph: JobGraph, log: JobLog):
+        self.id = job_id
+        self.output_config = output_config
+        self.graph = graph
+        self.log = log
+        self.submitted = time.time()
+        self.finished = None
+        self.failed = None
+        self.cancelled = False
+        self.steps = None  # once finished, instead of the graph
+        self.thread = None
+
+    @property
+    def state(self) -> str:
+        # finish() drops the graph last, so read it once, as it may finish
+        graph = self.graph
+        if graph is None:
+            if not self.failed:
+                return "done"  # even if cancelled once all steps started
+            return "cancelled" if self.cancelled else "failed"
+        if any(job.started is not None for job in graph.jobs):
+            return "running"
+        return "queued"
+
+    def cancel(self):
+        graph = self.graph
+        if graph is not None:
+            graph.cancel()
+
+    def finish(self, failed: bool):
+        """Keep only a summary of the steps, dropping their results"""
+        self.steps = [_describe_step(job) for job in self.graph.jobs]
+        self.cancelled = self.graph.cancelled
+        self.failed = failed
+        self.finished = time.time()
+        self.graph = None
+
+    def describe(self, steps: bool = False) -> dict:
+        graph = self.graph
+        if graph is None:
+            job_steps = self.steps
+        else:
+            job_steps = [_describe_step(job) for job in graph.jobs]
+        ended = [step for step in job_steps
+                 if step["state"] in ["done", "failed", "skipped"]]
+        description = {
+            "id": self.id,
+            "name": self.output_config.name,
+            "state": self.state,
+            "progress": (len(ended) / len(job_steps)
+                         if job_steps != [] else 0),
+            "submitted": self.submitted,
+            "finished": self.finished,
+        }
+        if steps:
+            description["steps"] = job_steps
+        return description
+
+
+def _describe_step(job: Job) -> dict:
+    if job.failed:
+        state = "failed" if job.started is not None else "skipped"
+    elif job.finished is not None:
+        state = "done"
+    elif job.started is not None:
+        state = "running"
+    else:
+        state = "waiting"
+    return {"name": job.name, "state": state,
+            "started": job.started, "finished": job.finished}
+
+
+class RenderService:
+    """
+    Renders submitted projects, each as soon as it is submitted, in its
+    own job graph. The graphs share one pool of workers and memory
+    budget, and the sources they cut share proxies and mezzanines, which
+    stay warm from one job to the next. Jobs of higher priority projects
+    are admitted first, then those of earlier jobs. Only the last few
+    finished jobs are kept, with the summary of their steps and their logs.
+    """
+
+    def __init__(self, threads: int, memory: float, router: LogRouter):
+        self.resources = get_resources(threads, memory)
+        self.router = router
+        self.jobs = {}
+        self._stack = ExitStack()
+        self._caches = SharedCaches(self._stack)
+        self._ids = count(1)
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+
+    def submit(self, options: dict) -> RenderJob:
+        """
+        Start rendering a project from its settings, or raise ValueError
+        with what was printed while checking them
+        """
+        log = JobLog()
+
+        # Rounds load in other threads, so everything they print is kept
+        with self._submit_lock:
+            self.router.fallback = log
+            try:
+                output_config = OutputConfig(options, False)
+            except SystemExit:
+                raise ValueError("Settings are invalid", log.read()[1])
+            except Exception as err:
+                raise ValueError("Settings are invalid: %r" % err,
+                                 log.read()[1])
+            finally:
+                self.router.fallback = None
+        if output_config.rounds == []:
+            raise ValueError("No round configs provided", log.read()[1])
+        if output_config.is_interactive():
+            raise ValueError("Previewing versions needs the GUI; render"
+                             " one version, or use --score auto",
+                             log.read()[1])
+
+        graph = JobGraph(self.resources, context=lambda: self.router.route(
+            log))
+        with self._lock:
+            # Their videos would be saved over each other
+            if any(job.finished is None
+                   and job.output_config.name == output_config.name
+                   for job in self.jobs.values()):
+                raise ValueError("A project named %s is already rendering"
+                                 % output_config.name, log.read()[1])
+            job = RenderJob(next(self._ids), output_config, graph, log)
+            self.jobs[job.id] = job
+        job.thread = threading.Thread(target=self._render, args=(job,),
+                                      daemon=True)
+        job.thread.start()
+        return job
+
+    def _render(self, job: RenderJob):
+        with self.router.route(job.log):
+            print("\r\nRendering %s" % job.output_config.name)
+            try:
+                failed = make_project(job.graph, job.output_config,
+                                      self._caches, job.id)
+            except Exception as e:
+                print("\r\nERROR: %s" % e)
+                failed = None
+            if failed == []:
+                print("\r\n%s Ready!" % job.output_config.name)
+            elif job.graph.cancelled:
+                print("\r\n%s Cancelled" % job.output_config.name)
+            job.finish(failed != [])
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            finished = [job for job in self.jobs.values()
+                        if job.finished is not None]
+            for job in finished[:-DAEMON_FINISHED_JOBS]:
+                del self.jobs[job.id]
+
+    def get(self, job_id: int) -> RenderJob:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def get_jobs(self) -> [RenderJob]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def close(self):
+        """Cancel the jobs, wait for their running steps, then clean up"""
+        for job in self.get_jobs():
+            job.cancel()
+        for job in self.get_jobs():
+            job.thread.join()
+        self._stack.close()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    The service's JSON API:
+        GET /jobs                       all jobs
+        POST /jobs                      submit {"config": settings}
+        GET /jobs/<id>                  a job and its steps
+        GET /jobs/<id>/log?offset=<n>   what a job printed, from offset n
+        POST /jobs/<id>/cancel          skip a job's steps not yet started
+    """
+    service = None  # set when serving
+
+    def log_message(self, format, *args):
+        pass  # requests are polled often, so they aren't logged
+
+    def _reply(self, status: int, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _get_job(self, path: [str]) -> RenderJob:
+        job = None
+        if path[1].isdigit():
+            job = self.service.get(int(path[1]))
+        if job is None:
+            self._reply(404, {"error": "No job %s" % path[1]})
+        return job
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.strip("/").split("/")
+        if path == ["jobs"]:
+            self._reply(200, {
+                "folder": os.getcwd(),
+                "jobs": [job.describe() for job in self.service.get_jobs()],
+            })
+        elif len(path) == 2 and path[0] == "jobs":
+            job = self._get_job(path)
+            if job is not None:
+                self._reply(200, job.describe(steps=True))
+        elif len(path) == 3 and path[0] == "jobs" and path[2] == "log":
+            job = self._get_job(path)
+            if job is not None:
+                offset = parse_qs(url.query).get("offset", ["0"])[0]
+                offset = int(offset) if offset.isdigit() else 0
+                state = job.state  # before reading, so no text is missed
+                offset, text = job.log.read(offset)
+                self._reply(200, {"log": text,
+                                  "offset": offset + len(text),
+                                  "state": state})
+        else:
+            self._reply(404, {"error": "Unknown path " + url.path})
+
+    def do_POST(self):
+        # Browsers can't send JSON to other sites without asking first
+        if self.headers.get("Content-Type") != "application/json":
+            self._reply(415, {"error": "Requests must be JSON"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            data = json.loads(self.rfile.read(length) or "{}")
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            self._reply(400, {"error": "Invalid JSON"})
+            return
+        path = urlparse(self.path).path.strip("/").split("/")
+        if path == ["jobs"]:
+            try:
+                job = self.service.submit(data.get("config", {}))
+            except ValueError as err:
+                self._reply(400, {"error": err.args[0], "log": err.args[1]})
+                return
+            self._reply(201, dict(job.describe(), folder=os.getcwd()))
+        elif len(path) == 3 and path[0] == "jobs" and path[2] == "cancel":
+            job = self._get_job(path)
+            if job is not None:
+                job.cancel()
+                self._reply(200, job.describe())
+        else:
+            self._reply(404, {"error": "Unknown path " + self.path})
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description="Render projects submitted by the GUI or command line"
+                    " (--submit), keeping workers and caches between"
+                    " them. Videos are saved in the current folder.")
+    parser.add_argument(
+        "-t", "--threads",
+        help="number of active round workers on CPU, for all jobs",
+        type=int,
+        default=OutputConfig.ITEMS["threads"]["default"])
+    parser.add_argument(
+        "-m", "--memory",
+        help="memory budget in GB for rendering rounds, for all jobs"
+             " (0: use free memory)",
+        type=float,
+        default=0)
+    parser.add_argument(
+        "-p", "--port",
+        help="local port to listen on",
+        type=int,
+        default=DAEMON_PORT)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    configure_moviepy()
+    router = LogRouter(sys.stdout)
+    sys.stdout = sys.stderr = router
+    RequestHandler.service = RenderService(args.threads, args.memory, router)
+    server = ThreadingHTTPServer((DAEMON_HOST, args.port), RequestHandler)
+    server.daemon_threads = True
+    print("\r\nRender daemon listening on http://%s:%i, saving videos in %s"
+          % (DAEMON_HOST, args.port, os.getcwd()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\r\nCancelling jobs and exiting")
+    finally:
+        server.server_close()
+        RequestHandler.service.close()
+
+
+if __name__ == "__main__":
+    main()
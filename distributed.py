@@ -0,0 +1,287 @@
+import os
+import json
+import socket
+import socketserver
+import uuid
+from threading import Condition, Semaphore, Thread
+
+import numpy as np
+from moviepy.video.io.VideoFileClip import VideoFileClip
+
+from compilation import CUT_DTYPE, Compilation, SourceFile
+from constants import INTERMEDIATE_PROFILES,\
+    WORKER_CONNECT_TIMEOUT,\
+    WORKER_REPLY_TIMEOUT,\
+    WORKER_RETRIES,\
+    WORKER_SLICE,\
+    WORKER_TIMEOUT_RATIO
+from cpu import allocate
+from segments import discard_segments, keep_segments, write_segments
+
+# Messages are JSON objects, one per line. A coordinator asks a worker
+# {"type": "status"}, answered with {"slots": <renders at once>}, then
+# sends slices of cuts from one source, as {"type": "segments", "path":
+# <source>, "cuts": [[start, stop, position], ...], "filenames": [...],
+# "dims": [x, y], "fps": <fps>, "profile": <intermediate profile>,
+# "attempt": <id>}, answered with {"done": <segments saved>} or {"error":
+# <message>}. Segments are saved at the attempt's partial names, and only
+# the coordinator moves them into place, once it accepts the reply.
+
+
+def _send(stream, message: dict):
+    stream.write((json.dumps(message) + "\n").encode())
+    stream.flush()
+
+
+def _receive(stream) -> dict:
+    line = stream.readline()
+    if line == b"":
+        raise ConnectionError("connection closed")
+    return json.loads(line)
+
+
+def _find_profile(profile: list) -> (str, str, [str], str):
+    # Only known profiles are encoded, so requests can't pass ffmpeg options
+    for known in INTERMEDIATE_PROFILES.values():
+        if json.loads(json.dumps(known)) == profile:
+            return known
+    raise ValueError("unknown profile {}".format(profile))
+
+
+def _is_inside(filename: str, folder: str) -> bool:
+    folder = os.path.realpath(folder)
+    filename = os.path.realpath(filename)
+    return os.path.commonpath([filename, folder]) == folder
+
+
+class SegmentWorker(socketserver.StreamRequestHandler):
+    """
+    Saves slices of cuts as segments, for coordinators rendering rounds
+    elsewhere. Segments are only saved inside the worker's shared folder.
+    """
+    folder = None  # set when serving
+    slots = 1
+    _semaphore = None
+
+    def handle(self):
+        while True:
+            try:
+                request = _receive(self.rfile)
+            except (ConnectionError, ValueError):
+                return
+            if request.get("type") == "status":
+                _send(self.wfile, {"slots": self.slots})
+                continue
+            try:
+                with self._semaphore:
+                    reply = {"done": self._write_slice(request)}
+            except Exception as e:
+                print("\r\nSlice of %s failed: %s" % (request.get("path"), e))
+                reply = {"error": str(e)}
+            try:
+                _send(self.wfile, reply)
+            except OSError:
+                return
+
+    def _write_slice(self, request: dict) -> int:
+        path = request["path"]
+        filenames = request["filenames"]
+        for filename in filenames:
+            if not _is_inside(filename, self.folder):
+                raise ValueError("{} is outside the shared folder {}".format(
+                    filename, self.folder))
+        profile = _find_profile(request["profile"])
+        attempt = request["attempt"]
+        if not attempt.isalnum():
+            raise ValueError("invalid attempt {}".format(attempt))
+        cuts = np.array([(0, start, stop, position, 0)
+                         for start, stop, position in request["cuts"]],
+                        dtype=CUT_DTYPE)
+        source = SourceFile(path, None, lambda: VideoFileClip(path))
+        try:
+            with allocate(path, self.slots) as allocation:
+                print("\r\nDecoding %i cuts from %s..." % (len(cuts), path))
+                write_segments(source, cuts, filenames,
+                               tuple(request["dims"]), request["fps"],
+                               profile, allocation.threads, attempt)
+        finally:
+            source.close()
+        return len(filenames)
+
+
+def serve_segments(host: str, port: int, folder: str, slots: int):
+    """Run a segment worker until interrupted"""
+    SegmentWorker.folder = os.path.abspath(folder)
+    SegmentWorker.slots = slots
+    SegmentWorker._semaphore = Semaphore(slots)
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((host, port),
+                                         SegmentWorker) as server:
+        server.daemon_threads = True
+        print("\r\nSegment worker listening on %s:%i, %i at once, saving in"
+              " %s" % (host, port, slots, SegmentWorker.folder))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\r\nSegment worker exiting")
+
+
+class _Slice:
+    def __init__(self, request: dict, indices: [int], duration: float):
+        """duration: of the slice's cuts, in seconds"""
+        self.request = request
+        self.indices = indices
+        # A worker that hangs, or is cut off, is lost once this runs out
+        self.timeout = WORKER_REPLY_TIMEOUT + WORKER_TIMEOUT_RATIO * duration
+        self.attempts = 0
+        self.failed_on = set()
+
+
+class WorkerPool:
+    """
+    Segment workers, which save the cuts of rounds rendered here. Each
+    source's sweep is split into slices, sent to whichever worker is free,
+    so a round's sources decode on every worker at once. A slice that
+    fails, or takes far longer than it should, is retried, on another
+    worker if there is one. Workers must see the sources, and the folder
+    segments are saved in, at the same paths.
+    """
+
+    def __init__(self, addresses: [(str, int)]):
+        self.addresses = addresses
+        self._condition = Condition()
+        self._pending = []
+        self._given_up = []
+        self._running = 0
+        self._threads = {}  # live connections to each worker
+
+    def _connect(self, address: (str, int)) -> socket.socket:
+        return socket.create_connection(address, WORKER_CONNECT_TIMEOUT)
+
+    def _get_slots(self, address: (str, int)) -> int:
+        try:
+            with self._connect(address) as connection:
+                stream = connection.makefile("rwb")
+                _send(stream, {"type": "status"})
+                return int(_receive(stream)["slots"])
+        except (OSError, ValueError, KeyError) as e:
+            print("\r\nSegment worker %s:%i unavailable: %s" % (*address, e))
+            return 0
+
+    def write_segments(
+        self,
+        compilation: Compilation,
+        sweeps: [(int, [int])],
+        filenames: [str],
+        dims: (int, int),
+        fps: float,
+        profile: (str, str, [str], str),
+    ) -> [int]:
+        """
+        Save the cuts of each source's sweep as segments, returning the
+        indices of the cuts no worker could save
+        """
+        slices = []
+        for s_i, sweep in sweeps:
+            path = os.path.abspath(compilation.sources[s_i].path)
+            for first in range(0, len(sweep), WORKER_SLICE):
+                indices = sweep[first:first + WORKER_SLICE]
+                cuts = compilation.cuts[indices]
+                slices.append(_Slice({
+                    "type": "segments",
+                    "path": path,
+                    "cuts": [[float(cut["start"]), float(cut["stop"]),
+                              float(cut["position"])] for cut in cuts],
+                    "filenames": [os.path.abspath(filenames[c_i])
+                                  for c_i in indices],
+                    "dims": list(dims),
+                    "fps": fps,
+                    "profile": profile,
+                }, indices, float((cuts["stop"] - cuts["start"]).sum())))
+
+        workers = [(address, self._get_slots(address))
+                   for address in self.addresses]
+        workers = [(address, slots) for address, slots in workers
+                   if slots > 0]
+        print("\r\nDecoding %i cuts in %i slices on %i segment workers..." % (
+            sum(len(sweep) for _, sweep in sweeps), len(slices),
+            len(workers)))
+        self._pending = slices
+        self._given_up = []
+        self._running = 0
+        self._threads = {address: slots for address, slots in workers}
+        threads = [Thread(target=self._work, args=(address,))
+                   for address, slots in workers for _ in range(slots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        left = [c_i for piece in self._pending + self._given_up
+                for c_i in piece.indices]
+        if left != []:
+            print("\r\n%i cuts weren't saved by segment workers, decoding"
+                  " them here" % len(left))
+        return left
+
+    def _take(self, address: (str, int)) -> _Slice:
+        # Slices that failed are retried on workers they haven't failed on
+        with self._condition:
+            while True:
+                for piece in self._pending:
+                    untried = [other for other, count in self._threads.items()
+                               if count > 0 and other not in piece.failed_on]
+                    if address not in piece.failed_on or untried == []:
+                        self._pending.remove(piece)
+                        self._running += 1
+                        return piece
+                if self._pending == [] and self._running == 0:
+                    return None
+                self._condition.wait()
+
+    def _finish(self, piece: _Slice, address: (str, int), error=None,
+                lost: bool = False):
+        with self._condition:
+            self._running -= 1
+            if lost:
+                self._threads[address] -= 1
+            if error is not None:
+                print("\r\nSegment worker %s:%i failed a slice of %s: %s"
+                      % (*address, piece.request["path"], error))
+                piece.attempts += 1
+                piece.failed_on.add(address)
+                if piece.attempts < WORKER_RETRIES:
+                    self._pending.insert(0, piece)
+                else:
+                    self._given_up.append(piece)
+            self._condition.notify_all()
+
+    def _work(self, address: (str, int)):
+        connection = stream = None
+        while True:
+            piece = self._take(address)
+            if piece is None:
+                break
+            try:
+                if connection is None:
+                    connection = self._connect(address)
+                    stream = connection.makefile("rwb")
+                connection.settimeout(piece.timeout)
+                attempt = uuid.uuid4().hex
+                _send(stream, dict(piece.request, attempt=attempt))
+                reply = _receive(stream)
+            except (OSError, ValueError) as e:
+                # Its connection is closed, so a late reply is never read
+                self._finish(piece, address, e, lost=True)
+                break
+            filenames = piece.request["filenames"]
+            error = reply.get("error")
+            if error is None:
+                missing = keep_segments(filenames, attempt)
+                if missing != []:
+                    error = "%s isn't in the shared folder" % missing[0]
+            else:
+                discard_segments(filenames, attempt)
+            self._finish(piece, address, error)
+        if connection is not None:
+            connection.close()
@@ -6,7 +6,6 @@ from functools import partial
 import os.path
 
 from parsing import OutputConfig, RoundConfig
-from run import make
 from credit import AudioCredit, RoundCredits, VideoCredit
 from constants import START_DIR
 
@@ -83,7 +82,11 @@ class AbstractGUI():
         elif validation["type"] == int:
             value_min = validation["min"]
             value_max = validation["max"]
-            variable = tk.IntVar(frame)
+            # Unset numbers show as "None", which IntVar can't hold
+            if validation["default"] is None:
+                variable = tk.StringVar(frame)
+            else:
+                variable = tk.IntVar(frame)
             variable.set(value)
             box = ttk.Spinbox(frame, textvariable=variable,
                               from_=value_min, to=value_max)
@@ -240,7 +243,14 @@ class GUI(AbstractGUI):
         config = OutputConfig(config, False)
         self.update_config(config)
         self.window.destroy()
-        make(config)
+
+        # Render with the daemon, if one is running and needn't preview
+        import client
+        if not config.is_interactive() and client.is_running():
+            client.render(config)
+        else:
+            from run import make
+            make(config)
 
     def save(self):
         if self._settings_path == "":
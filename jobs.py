@@ -0,0 +1,177 @@
+import heapq
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import count
+from threading import Condition
+
+
+class Slots:
+    """
+    A resource class that runs up to `slots` jobs at once, admitting them
+    by priority then in order
+    """
+
+    def __init__(self, slots: int):
+        self._free = slots
+        self._condition = Condition()
+        self._waiting = []
+        self._arrivals = count()
+
+    @contextmanager
+    def admit(self, name: str, estimate: int = 0, priority: int = 0):
+        ticket = (priority, next(self._arrivals))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            while self._waiting[0] is not ticket or self._free == 0:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._free -= 1
+            self._condition.notify_all()  # the next job may fit too
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._free += 1
+                self._condition.notify_all()
+
+
+class Job:
+    def __init__(
+        self,
+        name: str,
+        run,
+        dependencies: ["Job"],
+        resource: str,
+        estimate: int,
+        priority: int,
+        on_failure,
+    ):
+        self.name = name
+        self.run = run
+        self.dependencies = dependencies
+        self.resource = resource
+        self.estimate = estimate
+        self.priority = priority
+        self.on_failure = on_failure
+        self.result = None
+        self.started = None  # times the step ran, once admitted
+        self.finished = None
+        self.failed = False  # or skipped
+
+
+class JobGraph:
+    """
+    Build steps, each started as soon as the steps it depends on are done
+    and its resource class admits it, so that independent steps overlap.
+
+    A step fails if it raises or returns None, and the steps that depend
+    on a failed step are skipped.
+    """
+
+    def __init__(self, resources: dict, context=None):
+        """
+        resources: resource classes by name, each with an `admit` method
+        context: returns a context manager, entered around each step
+        """
+        self.resources = resources
+        self.context = context
+        self.cancelled = False
+        self.jobs = []
+
+    def add(
+        self,
+        name: str,
+        run,
+        dependencies: [Job] = (),
+        resource: str = None,
+        estimate: int = 0,
+        priority: int = 0,
+        on_failure=None,
+    ) -> Job:
+        """
+        Add a step that calls `run()` once all `dependencies` have results.
+        Resource classes admit waiting steps with lower `priority` first.
+        If the step fails or is skipped, `on_failure()` is called instead.
+        Dependencies must be added first, so steps can't depend in a cycle.
+        """
+        dependencies = [d for d in dependencies if d is not None]
+        for dependency in dependencies:
+            if dependency not in self.jobs:
+                raise ValueError("unknown dependency {} of {}".format(
+                    dependency.name, name))
+        if resource is not None and resource not in self.resources:
+            raise ValueError("unknown resource {} of {}".format(
+                resource, name))
+        job = Job(name, run, dependencies, resource, estimate, priority,
+                  on_failure)
+        self.jobs.append(job)
+        return job
+
+    def run(self) -> [Job]:
+        """Run all steps, returning the ones that failed or were skipped"""
+        failed = []
+        done = []
+        pending = list(self.jobs)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            while pending or running:
+                # Jobs are in dependency order, so failures cascade in a pass
+                for job in list(pending):
+                    if self.cancelled or any(d in failed
+                                             for d in job.dependencies):
+                        print("\r\nSkipping %s" % job.name)
+                        self._fail(job, failed)
+                        pending.remove(job)
+                    elif all(d in done for d in job.dependencies):
+                        running[executor.submit(self._run, job)] = job
+                        pending.remove(job)
+                if running == {}:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    try:
+                        job.result = future.result()
+                    except Exception as e:
+                        print("\r\n%s failed: %s" % (job.name, e))
+                        self._fail(job, failed)
+                        continue
+                    if job.result is None:
+                        self._fail(job, failed)
+                    else:
+                        done.append(job)
+        return failed
+
+    def cancel(self):
+        """Skip the steps that haven't started; running steps finish"""
+        self.cancelled = True
+
+    def _fail(self, job: Job, failed: [Job]):
+        failed.append(job)
+        job.failed = True
+        if job.on_failure is not None:
+            job.on_failure()
+
+    def _run(self, job: Job):
+        if self.context is None:
+            return self._admit(job)
+        with self.context():
+            return self._admit(job)
+
+    def _admit(self, job: Job):
+        if job.resource is None:
+            return self._time(job)
+        resource = self.resources[job.resource]
+        with resource.admit(job.name, job.estimate, job.priority):
+            return self._time(job)
+
+    def _time(self, job: Job):
+        if self.cancelled:  # while waiting to be admitted
+            print("\r\nSkipping %s" % job.name)
+            return None
+        job.started = time.time()
+        try:
+            return job.run()
+        finally:
+            job.finished = time.time()
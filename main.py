@@ -2,34 +2,48 @@
 import os
 import sys
 
-from moviepy.config import change_settings as moviepy_change_settings
-
 from parsing import OutputConfig, parse_command_line_args
-from gui import GUI
-from run import make
 
 
-# Override moviepy's binary filepath resolution bug in Windows
-if os.name == "nt":
-    import winreg as wr  # pylint: disable=import-error
-    try:
-        with wr.OpenKey(
-                wr.HKEY_LOCAL_MACHINE,
-                "SOFTWARE\\ImageMagick\\Current") as key:
-            binary = wr.QueryValueEx(key, "BinPath")[0] + "\\magick.exe"
-            moviepy_change_settings({"IMAGEMAGICK_BINARY": binary})
-    except OSError:
-        print(OSError)
-        print("\nIs ImageMagic Installed?\n")
-        sys.exit(1)
+def configure_moviepy():
+    """Set up moviepy before rendering, which loads it"""
+    # Override moviepy's binary filepath resolution bug in Windows
+    if os.name == "nt":
+        import winreg as wr  # pylint: disable=import-error
+        from moviepy.config import change_settings as moviepy_change_settings
+        try:
+            with wr.OpenKey(
+                    wr.HKEY_LOCAL_MACHINE,
+                    "SOFTWARE\\ImageMagick\\Current") as key:
+                binary = wr.QueryValueEx(key, "BinPath")[0] + "\\magick.exe"
+                moviepy_change_settings({"IMAGEMAGICK_BINARY": binary})
+        except OSError:
+            print(OSError)
+            print("\nIs ImageMagic Installed?\n")
+            sys.exit(1)
 
 
 def main():
     args = parse_command_line_args()
     output_config = OutputConfig(args)
-    if args.execute:
+
+    # Only load what's needed: validating and planning don't render
+    if args.validate:
+        print("\r\nSettings and %i rounds are valid" % len(
+            output_config.rounds))
+    elif args.plan:
+        from cutters import print_plans
+        print_plans(output_config)
+    elif args.submit:
+        from client import render
+        render(output_config)
+    elif args.execute:
+        configure_moviepy()
+        from run import make
         make(output_config)
     else:
+        configure_moviepy()
+        from gui import GUI
         GUI(output_config)
 
 
@@ -4,11 +4,40 @@ import yaml
 import argparse
 import random
 import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from urllib.parse import unquote
 from string import ascii_letters
 
 from credit import RoundCredits
-from constants import DEFAULT_FPS
+from constants import DEFAULT_FPS, INTERMEDIATE_PROFILES, WORKER_PORT
+
+
+def _resolve(folder: str, path: str) -> str:
+    """Absolute path of `path`, if relative then to `folder`"""
+    return str(os.path.abspath(os.path.join(folder, path)))
+
+
+def _is_nonempty_folder(path: str) -> bool:
+    # Stop at the first entry, rather than listing every file
+    try:
+        with os.scandir(path) as entries:
+            return next(entries, None) is not None
+    except OSError:
+        return False
+
+
+def parse_addresses(addresses: str) -> [(str, int)]:
+    """Hosts and ports of comma separated `host[:port]` addresses"""
+    parsed = []
+    for address in addresses.split(","):
+        host, _, port = address.strip().rpartition(":")
+        if host == "":
+            host, port = port, str(WORKER_PORT)
+        if host == "" or not port.isdigit():
+            raise ValueError("invalid worker address " + address)
+        parsed.append((host, int(port)))
+    return parsed
 
 
 def get_random_name():
@@ -49,7 +78,8 @@ class BeatSection:
 
 
 class BeatMeterConfig:
-    def __init__(self, bmcfg_json: dict):
+    def __init__(self, bmcfg_json: dict, folder: str = "."):
+        """folder: where the music's path is relative to"""
         data = bmcfg_json["data"]
         self.sections = list(map(
             lambda e: BeatSection(e),
@@ -65,7 +95,7 @@ class BeatMeterConfig:
 
         if data["audio"] and data["audio"].get("#elems", False):
             music_path = unquote(data["audio"]["#elems"][0])
-            self.music = str(os.path.abspath(music_path))
+            self.music = _resolve(folder, music_path)
         else:
             self.music = None
 
@@ -97,6 +127,27 @@ class BeatMeterConfig:
                     self.duration))
 
 
+_beatmeter_configs = {}
+_beatmeter_configs_lock = Lock()
+
+
+def _read_beatmeter_config(filepath: str) -> BeatMeterConfig:
+    """
+    Parse a bmcfg file only once, for every round (of every project) that
+    uses it, unless it has changed since
+    """
+    stat = os.stat(filepath)
+    key = (filepath, stat.st_size, stat.st_mtime)
+    with _beatmeter_configs_lock:
+        if key in _beatmeter_configs:
+            return _beatmeter_configs[key]
+    with open(filepath) as bmcfg_json:
+        beatmeter_config = BeatMeterConfig(json.load(bmcfg_json),
+                                           os.path.dirname(filepath))
+    with _beatmeter_configs_lock:
+        return _beatmeter_configs.setdefault(key, beatmeter_config)
+
+
 class RoundConfig:
     # pylint: disable=no-member, access-member-before-definition
     ITEMS = {
@@ -108,6 +159,10 @@ class RoundConfig:
             "type": bool,
             "default": False,
         },
+        "_is_video_on_disk": {
+            "type": bool,
+            "default": False,
+        },
         "bpm": {
             "type": float,
             "min": 1,
@@ -174,29 +229,30 @@ class RoundConfig:
         },
     }
 
-    def __init__(self, config: dict or str, load=False):
-        settings_folder = os.path.abspath(os.getcwd())
+    def __init__(self, config: dict or str, load=False, folder: str = None):
+        """
+        Paths are relative to the round's yaml file, if given, otherwise to
+        `folder` (by default, the current folder)
+        """
+        folder = os.path.abspath(folder or os.getcwd())
         if type(config) == str:
-            round_folder = os.path.abspath(os.path.dirname(config))
-            os.chdir(round_folder)
+            config_filepath = _resolve(folder, config)
+            folder = os.path.dirname(config_filepath)
             if load:
-                round_filename = os.path.basename(config)
-                with open(round_filename) as config_file:
-                    config = yaml.load(config_file)
+                with open(config_filepath) as config_file:
+                    config = yaml.full_load(config_file)
         if config.get("bmcfg", None) is not None:
-            self.load_beatmeter_config(config)
+            self.load_beatmeter_config(config, folder)
 
         for index, source in enumerate(config.get("sources", [])):
-            config["sources"][index] = str(os.path.abspath(source))
+            config["sources"][index] = _resolve(folder, source)
 
         if "beatmeter" in config:
-            config["beatmeter"] = str(os.path.abspath(config["beatmeter"]))
+            config["beatmeter"] = _resolve(folder, config["beatmeter"])
         if "beats" in config:
-            config["beats"] = str(os.path.abspath(config["beats"]))
+            config["beats"] = _resolve(folder, config["beats"])
         if config.get("music", None) is not None:
-            config["music"] = str(os.path.abspath(config["music"]))
-
-        os.chdir(settings_folder)
+            config["music"] = _resolve(folder, config["music"])
 
         try:
             for attribute, validation in self.ITEMS.items():
@@ -224,16 +280,12 @@ class RoundConfig:
             print("WARNING: Round {}, speed not set, default 3".format(
                 self.name))
 
-    def load_beatmeter_config(self, config: dict):
-        current_folder = os.path.abspath(os.getcwd())
-        bmcfg_filepath = config["bmcfg"]
-        bmcfg_folder = os.path.abspath(os.path.dirname(bmcfg_filepath))
-        bmcfg_filename = os.path.basename(bmcfg_filepath)
-        config["bmcfg"] = str(os.path.join(bmcfg_folder, bmcfg_filename))
-        os.chdir(bmcfg_folder)
-        with open(bmcfg_filename) as bmcfg_json:
-            beatmeter_config = BeatMeterConfig(json.load(bmcfg_json))
-        os.chdir(current_folder)
+    def load_beatmeter_config(self, config: dict, folder: str = "."):
+        """folder: where the bmcfg file's path is relative to"""
+        bmcfg_filepath = _resolve(folder, config["bmcfg"])
+        bmcfg_folder = os.path.dirname(bmcfg_filepath)
+        config["bmcfg"] = bmcfg_filepath
+        beatmeter_config = _read_beatmeter_config(bmcfg_filepath)
         self.beatmeter_config = beatmeter_config
         config["music"] = beatmeter_config.music
         config["bpm"] = beatmeter_config.bpm
@@ -252,9 +304,7 @@ class RoundConfig:
         for src in self.sources:
             if not os.path.isfile(src):
                 raise ValueError("source file {} does not exist".format(src))
-        if (self.beatmeter and
-            (not os.path.isdir(self.beatmeter)
-             or os.listdir(self.beatmeter) == [])):
+        if self.beatmeter and not _is_nonempty_folder(self.beatmeter):
             raise ValueError(
                 "beatmeter folder {} does not exist or is empty".format(
                     self.beatmeter))
@@ -309,9 +359,53 @@ class OutputConfig:
             "default": 1,
             "help": "number of versions"
         },
+        "preview": {
+            "type": str,
+            "choices": ["video", "sheet"],
+            "default": "video",
+            "help": "preview versions as videos or a contact sheet"
+        },
+        "score": {
+            "type": str,
+            "choices": ["off", "assist", "auto"],
+            "default": "off",
+            "short": None,
+            "help": "pick best scoring versions: only preview close calls"
+                    " (assist) or never preview (auto)"
+        },
+        "seed": {
+            "type": int,
+            "min": 0,
+            "max": 2 ** 32 - 1,
+            "default": None,
+            "short": None,
+            "help": "seed of the random choices of cuts, to cut rounds the"
+                    " same way every time (default: a new one each round)"
+        },
+        "mezzanine": {
+            "type": bool,
+            "default": False,
+            "short": None,
+            "help": "transcode sources once to output size and fps, for"
+                    " faster cutting, cached for every project"
+        },
+        "order": {
+            "type": str,
+            "choices": ["source", "timeline"],
+            "default": "source",
+            "help": "decode cuts source by source, each in one forward"
+                    " sweep, or in timeline order (no temporary files)"
+        },
+        "workers": {
+            "type": str,
+            "default": "",
+            "short": None,
+            "help": "decode cuts source by source with segment workers at"
+                    " these comma separated host[:port] addresses"
+        },
         "cache": {
             "type": str,
-            "choices": ["all", "round"],
+            "choices": ["all", "round", "stream", "auto"],
             "default": "round",
             "help": "memory usage before dumping to disk"
         },
@@ -322,6 +416,29 @@ class OutputConfig:
             "default": 1,
             "help": "number of active round workers on CPU"
         },
+        "pin": {
+            "type": bool,
+            "default": False,
+            "short": None,
+            "help": "pin streamed part encoders to their own CPUs"
+        },
+        "memory": {
+            "type": float,
+            "min": 0,
+            "max": 1024,
+            "default": 0,
+            "help": "memory budget in GB for rendering rounds"
+                    " (0: use free memory)"
+        },
+        "priority": {
+            "type": int,
+            "min": -100,
+            "max": 100,
+            "default": 0,
+            "short": None,
+            "help": "rendering priority in a batch of projects (higher"
+                    " first)"
+        },
         "assemble": {
             "type": bool,
             "default": False,
@@ -332,6 +449,13 @@ class OutputConfig:
             "default": False,
             "help": "save output losslessly"
         },
+        "intermediate": {
+            "type": str,
+            "choices": list(INTERMEDIATE_PROFILES),
+            "default": "h264",
+            "help": "format of round, title and credits videos; lossless"
+                    " ones are encoded once into the final video"
+        },
         "delete": {
             "type": bool,
             "default": False,
@@ -354,21 +478,21 @@ class OutputConfig:
         if type(args) != dict:
             args = args.__dict__
 
-        current_folder = os.path.abspath(os.getcwd())
+        # Round files are relative to the settings file, if there is one
+        settings_folder = os.path.abspath(os.getcwd())
         settings_filepath = args["_settings"]
+        file_contents = dict()
         if settings_filepath != "":
             if not os.path.exists(settings_filepath):
                 print("Settings file ({}) not found".format(
                     settings_filepath
                 ))
                 sys.exit(1)
-            os.chdir(os.path.abspath(os.path.dirname(settings_filepath)))
+            settings_folder = os.path.dirname(
+                os.path.abspath(settings_filepath))
             if load:
-                settings_filename = os.path.basename(settings_filepath)
-                with open(settings_filename) as settings_filehandle:
+                with open(settings_filepath) as settings_filehandle:
                     file_contents = yaml.full_load(settings_filehandle)
-        else:
-            file_contents = dict()
 
         if type(file_contents) == OutputConfig:
             self.__dict__.update(file_contents.__dict__)
@@ -380,20 +504,14 @@ class OutputConfig:
                     value = args_value  # overwrite settings with cmd args
                 value = None if value is None else validation["type"](value)
                 if attribute == "rounds":
-                    for r_i, r in enumerate(value):
-                        if type(r) == str or type(r) == dict:
-                            value[r_i] = RoundConfig(r, True)
-                        elif type(r) == RoundConfig:
-                            value[r_i] = RoundConfig(r, False)
-                        else:
-                            print("ERROR: Settings invalid round: {}".format(
-                                repr(r)
-                            ))
-                            sys.exit(1)
+                    # Load rounds (and their bmcfg files) in parallel
+                    with ThreadPoolExecutor() as executor:
+                        value = list(executor.map(
+                            lambda r: _load_round(r, settings_folder),
+                            value))
                 self.__setattr__(attribute, value)
             if self.name is None:
                 self.name = get_random_name()
-        os.chdir(current_folder)
         try:
             self.validate()
         except ValueError as err:
@@ -416,10 +534,32 @@ class OutputConfig:
             print("Cannot delete intermediate files; none will be created")
             self.delete = False
 
+        if self.cache == "stream" and not self.assemble:
+            print("Cannot stream rounds; not assembling video")
+            self.cache = "round"
+
+        if self.cache == "auto" and not self.assemble:
+            print("Cannot keep rounds in memory; not assembling video")
+            self.cache = "round"
+
+        if self.cache == "stream" and self.raw:
+            print("Cannot stream raw video; saving each round instead")
+            self.cache = "round"
+
+        if self.workers != "" and self.order != "source":
+            print("Cannot use segment workers; not decoding source by source")
+            self.workers = ""
+        if self.workers != "":
+            parse_addresses(self.workers)
+
         for r in self.rounds:
             if r.name in [r2.name for r2 in self.rounds if r2 is not r]:
                 raise ValueError("round names must be unique: " + r.name)
 
+    def is_interactive(self) -> bool:
+        """Whether versions are previewed, which needs a window"""
+        return self.versions > 1 and self.score != "auto"
+
     def save(self):
         with open(self._settings, "w") as settings_filehandle:
             yaml.dump(self, settings_filehandle, sort_keys=False)
@@ -430,6 +570,23 @@ class OutputConfig:
         return OutputConfig(attributes, False)
 
 
+def _load_round(r, folder: str) -> RoundConfig:
+    if type(r) == str or type(r) == dict:
+        return RoundConfig(r, True, folder)
+    elif type(r) == RoundConfig:
+        return RoundConfig(r, False, folder)
+    print("ERROR: Settings invalid round: {}".format(repr(r)))
+    sys.exit(1)
+
+
+def _validate_round(r: RoundConfig) -> Exception:
+    try:
+        r.validate()
+    except (ValueError, KeyError) as err:
+        return err
+    return None
+
+
 def _validate(item: str, data, validation: dict):
     if data is None:
         return
@@ -452,13 +609,14 @@ def _validate(item: str, data, validation: dict):
                 "invalid choice for {} ({}); must be one of [{}]".format(
                     item, data, ", ".join(choices)))
     elif item == "rounds":
-        for i, d in enumerate(data):
-            try:
-                d.validate()
-            except ValueError as err:
+        # Rounds are validated in parallel, and reported in order
+        with ThreadPoolExecutor() as executor:
+            errors = list(executor.map(_validate_round, data))
+        for i, err in enumerate(errors):
+            if isinstance(err, ValueError):
                 print("ERROR: Round {} invalid value: {}".format(i + 1, err))
                 sys.exit(1)
-            except KeyError as err:
+            elif isinstance(err, KeyError):
                 print("ERROR: Round {} missing field: {}".format(i + 1, err))
                 sys.exit(1)
     elif item == "credits":
@@ -470,22 +628,39 @@ def parse_command_line_args() -> dict:
     for attribute, validation in OutputConfig.ITEMS.items():
         if attribute == "rounds":
             continue
-        short_name = "-" + (attribute[1]
-                            if attribute == "_settings"
-                            else attribute[0])
+        short_name = validation.get("short", "-" + (
+            attribute[1] if attribute == "_settings" else attribute[0]))
         name = "--" + attribute
         _help = validation["help"]
         _type = validation["type"]
         default = validation["default"]
         action = "store_true" if _type is bool else "store"
-        parser.add_argument(short_name, name, help=_help,
+        names = [short_name, name] if short_name is not None else [name]
+        parser.add_argument(*names, help=_help,
                             action=action, default=default)
 
-    parser.add_argument(
+    # Ways to run without the GUI
+    commands = parser.add_mutually_exclusive_group()
+    commands.add_argument(
         "-e", "--execute",
         help="Execute directly, without GUI.",
         action="store_true",
         default=False)
+    commands.add_argument(
+        "--validate",
+        help="Check the settings and rounds, then exit.",
+        action="store_true",
+        default=False)
+    commands.add_argument(
+        "--plan",
+        help="Print the cuts each round would have, then exit.",
+        action="store_true",
+        default=False)
+    commands.add_argument(
+        "--submit",
+        help="Render with the running render daemon, without GUI.",
+        action="store_true",
+        default=False)
 
     parser.add_argument(
         "rounds",
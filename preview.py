@@ -1,179 +1,201 @@
 import PIL.Image
-import PIL.ImageTk
-import time
-import tkinter
 import math
+from concurrent.futures import Future
+from contextlib import AbstractContextManager
+from itertools import count
+from queue import PriorityQueue
+from threading import Condition, Thread
 # from moviepy.decorators import convert_masks_to_RGB, requires_duration
 from moviepy.video.VideoClip import VideoClip
 from moviepy.video.compositing.CompositeVideoClip import clips_array
 from moviepy.video.fx.resize import resize
 
-from constants import DISPLAY_SIZE
+from constants import DISPLAY_SIZE, PREVIEW_THUMBNAILS
 
 
-class ResizingCanvas(tkinter.Canvas):
-    # from https://stackoverflow.com/questions/22835289/
-    def __init__(self, parent, **kwargs):
-        tkinter.Canvas.__init__(self, parent, **kwargs)
-        self.bind("<Configure>", self.on_resize)
-        self.height = self.winfo_reqheight()
-        self.width = self.winfo_reqwidth()
+class FrameBuffer:
+    """
+    Decodes frames of a video on a background thread into a ring buffer,
+    holding frames ahead of the playhead (wrapping around, for looping)
+    and recently shown frames behind it (for scrubbing back).
+    """
 
-    def on_resize(self, event):
-        # determine the ratio of old width/height to new width/height
-        wscale = float(event.width)/self.width
-        hscale = float(event.height)/self.height
-        self.width = event.width
-        self.height = event.height
-        # resize the canvas
-        self.config(width=self.width, height=self.height)
-        # rescale all the objects tagged with the "all" tag
-        self.scale("all", 0, 0, wscale, hscale)
-
-
-class PreviewGUI:
     def __init__(self,
-                 clips: [VideoClip],
-                 choose: lambda: int,
-                 display_size: (int, int) = DISPLAY_SIZE,
-                 fps: int = 15):
-        self.window = tkinter.Tk()
-        self.window.title("Preview: Choose which version to use")
-        self.display_size = display_size
-        self._choose = choose
+                 video: VideoClip,
+                 fps: int,
+                 ahead: float = 2.0,
+                 behind: float = 1.0):
+        self.video = video
         self.fps = fps
-        self.update_id = None
-        self.is_full_screen = False
-        self.num_versions = len(clips)
-
-        # Create a canvas that can fit the above video source size
-        self.canvas = ResizingCanvas(self.window,
-                                     width=display_size[0],
-                                     height=display_size[1],
-                                     highlightthickness=0)
-        self.canvas.pack(fill=tkinter.BOTH, expand=tkinter.YES)
-
-        # Add handlers to canvas for input
-        for key in [str(k) for k in range(1, len(clips) + 1)]:
-            self.window.bind(key, self.on_number_key)
-        self.window.bind("<Button-1>", self.on_click)
-        self.window.bind("<Escape>", self.exit)
-        self.window.bind('f', self.toggle_full_screen)
-        self.window.bind('r', self.refresh_sources)
-        self.window.bind("<Left>", self.scrub_backward)
-        self.window.bind("<Right>", self.scrub_forward)
-        self.window.bind("<Key-space>", lambda e: self.pause()
-                         if self.is_playing else self.play())
-
-        # Prepare the clips by combining them into a composite clip
-        self.square_size = math.ceil(math.sqrt(len(clips)))
-        segments = [
-            [
-                resize(clips[i + j], 1 / self.square_size)
-                for j in range(self.square_size)
-                if i + j < len(clips)
-            ] for i in range(0, len(clips), self.square_size)
-        ]
-
-        self.native_video = resize(clips_array(segments), self.display_size)
-        # TODO: fix fullscreen
-        # self.fullscreen_video = resize(
-        #   clips_array(segments), height=self.window.winfo_screenheight())
-        self.video = self.native_video
-
-        self.dt = 1.0 / fps
-        self.t = 0
-        self.is_playing = False
-        self.display()
-
-    def run(self):
-        self.play()
-        self.window.mainloop()
-        self.window.destroy()
-
-    def play(self):
-        self.is_playing = True
-        self.t0 = time.time() - self.t
-        self.update()
-
-    def pause(self):
-        self.is_playing = False
-        if self.update_id is not None:
-            self.window.after_cancel(self.update_id)
-
-    def scrub_backward(self, _: tkinter.Event = None):
-        adjust = 5.0 if self.is_playing else 1.0 / self.fps
-        if adjust > self.t:
-            adjust = self.t
-        self.t0 += adjust
-        self.t -= adjust
-        self.display()
-
-    def scrub_forward(self, _: tkinter.Event = None):
-        adjust = 5.0 if self.is_playing else 1.0 / self.fps
-        remainder = self.video.duration - self.t
-        if adjust > remainder:
-            adjust = remainder
-
-        self.t0 -= adjust
-        self.t += adjust
-        self.display()
-
-    def exit(self, _: tkinter.Event = None):
-        self.pause()
-        self.window.quit()
-
-    def on_click(self, event: tkinter.Event):
-        x_dim, y_dim = self.display_size
-        x = math.floor(event.x / x_dim * self.square_size)
-        y = math.floor(event.y / y_dim * self.square_size)
-        choice = y * self.square_size + x
-        if choice < 0 or choice > self.num_versions:
-            return
-        else:
-            self._choose(choice)
-            self.exit(event)
-
-    def on_number_key(self, event):
-        self._choose(int(event.char) - 1)
-        self.exit(event)
-
-    def toggle_full_screen(self, _: tkinter.Event = None):
-        pass
+        self.num_frames = max(1, int(video.duration * fps))
+        self._frames = {}
+        self._position = 0
+        self._is_running = True
+        self._condition = Condition()
+        self.set_window(ahead, behind)
+        self._thread = Thread(target=self._decode, daemon=True)
+        self._thread.start()
+
+    def set_window(self, ahead: float, behind: float):
+        """Set how many seconds to buffer ahead of and behind the playhead"""
+        with self._condition:
+            self._ahead = max(1, int(ahead * self.fps))
+            self._behind = int(behind * self.fps)
+            self._condition.notify_all()
+
+    def get(self, index: int) -> PIL.Image.Image:
         """
-        self.is_full_screen = not self.is_full_screen
-        self.window.attributes("-fullscreen", self.is_full_screen)
-        self.video = (self.fullscreen_video if self.is_full_screen
-                      else self.native_video)
+        Move the playhead to the frame, without waiting for it. If it isn't
+        buffered yet, get the latest frame before it, as when decoding falls
+        behind playing, or None (as after scrubbing out of the window).
         """
-
-    def refresh_sources(self, _: tkinter.Event = None):
-        # TODO: refresh source clips
-        # self.video = self.assemble_video(self.callback())
-        pass
-
-    def display(self):
-        self.frame = self.video.get_frame(self.t)
-        self.photo = PIL.ImageTk.PhotoImage(
-            image=PIL.Image.fromarray(self.frame))
-        self.canvas.create_image(0, 0, image=self.photo, anchor=tkinter.NW)
-        self.canvas.update()
-
-    def update(self):
-        if not self.is_playing:
-            return
-
-        # Get the current frame from the video source
-        start = time.time()
-        self.t = start - self.t0
-        if self.t >= self.video.duration:  # Repeat clips on loop
-            self.t0 = time.time()
-            self.t = 0
-
-        self.display()
-
-        # Repeat update after delay, respecting framerate
-        stop = time.time()
-        lost_time = stop - start
-        wait = max(0, int(1000 * (self.dt - lost_time)))
-        self.update_id = self.window.after(wait, self.update)
+        index %= self.num_frames
+        with self._condition:
+            self._position = index
+            self._condition.notify_all()
+            earlier = [i for i in self._frames
+                       if (index - i) % self.num_frames <= self._ahead]
+            if earlier == []:
+                return None
+            return self._frames[min(
+                earlier, key=lambda i: (index - i) % self.num_frames)]
+
+    def is_buffered(self, index: int) -> bool:
+        with self._condition:
+            return index % self.num_frames in self._frames
+
+    def close(self):
+        with self._condition:
+            self._is_running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self._frames = {}
+
+    def _get_window(self) -> [int]:
+        """Frame indices to buffer, most urgent first"""
+        if self.num_frames <= self._ahead + self._behind + 1:
+            ahead, behind = self.num_frames, 0
+        else:
+            ahead, behind = self._ahead + 1, self._behind
+        return [(self._position + i) % self.num_frames
+                for i in range(ahead)] + \
+               [(self._position - i) % self.num_frames
+                for i in range(1, behind + 1)]
+
+    def _decode(self):
+        while True:
+            with self._condition:
+                index = None
+                while self._is_running and index is None:
+                    window = self._get_window()
+                    index = next(
+                        (i for i in window if i not in self._frames), None)
+                    if index is None:
+                        self._condition.wait()
+                if not self._is_running:
+                    return
+
+            # Only this thread reads from the video, outside of the lock
+            try:
+                image = PIL.Image.fromarray(self.video.get_frame(
+                    index / self.fps))
+            except Exception as e:
+                print("\r\nPreview failed to decode frame: %s" % e)
+                with self._condition:
+                    self._is_running = False
+                    self._condition.notify_all()
+                return
+
+            with self._condition:
+                # Evict frames that fell out of the window meanwhile
+                window = set(self._get_window())
+                for stale_index in list(self._frames.keys()):
+                    if stale_index not in window:
+                        del self._frames[stale_index]
+                self._frames[index] = image
+                self._condition.notify_all()
+
+
+def make_preview_video(
+    clips: [VideoClip],
+    display_size: (int, int) = DISPLAY_SIZE
+) -> VideoClip:
+    """Combine the clips into a grid, each scaled straight to its cell"""
+    square_size = math.ceil(math.sqrt(len(clips)))
+    cell_size = (display_size[0] // square_size,
+                 display_size[1] // square_size)
+    segments = [
+        [
+            resize(clips[i + j], cell_size)
+            for j in range(square_size)
+            if i + j < len(clips)
+        ] for i in range(0, len(clips), square_size)
+    ]
+
+    video = clips_array(segments)
+    if tuple(video.size) != tuple(display_size):
+        video = resize(video, display_size)
+    return video
+
+
+def make_thumbnails(
+    clip: VideoClip,
+    keyframes: [float],
+    height: int,
+    count: int = PREVIEW_THUMBNAILS,
+) -> [PIL.Image.Image]:
+    """
+    Grab evenly spaced frames from a clip, moved to the nearest keyframe
+    (times relative to the clip), where the reader can seek cheaply.
+    Without a keyframe for each thumbnail, they stay evenly spaced.
+    """
+    times = [clip.duration * (k + 0.5) / count for k in range(count)]
+    snapped = sorted(set(min(keyframes, key=lambda k: abs(k - t))
+                         for t in times)) if keyframes != [] else []
+    if len(snapped) == count:
+        times = snapped
+    thumbnails = []
+    for t in times:
+        image = PIL.Image.fromarray(clip.get_frame(t))
+        width = max(1, round(image.width * height / image.height))
+        thumbnails.append(image.resize((width, height)))
+    return thumbnails
+
+
+class PreviewQueue(AbstractContextManager):
+    """
+    Shows the previews of all rounds one at a time, on a single thread.
+    Pending previews are shown in order of their (round, cut) keys, so
+    every round can plan its cuts concurrently.
+    """
+
+    _STOP = (math.inf,)
+
+    def __init__(self):
+        self._queue = PriorityQueue()
+        self._counter = count()  # tie-breaker, so previews aren't compared
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __exit__(self, *args, **kwargs):
+        self._queue.put((self._STOP, next(self._counter), None, None))
+        self._thread.join()
+
+    def choose(self, key: tuple, preview) -> int:
+        """Wait in line to preview, and return the chosen version (or None)"""
+        future = Future()
+        self._queue.put((key, next(self._counter), preview, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            key, _, preview, future = self._queue.get()
+            if key == self._STOP:
+                return
+            chosen = []
+            try:
+                preview.show(chosen.append)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            future.set_result(chosen[-1] if chosen != [] else None)
@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import subprocess
+from threading import Lock
+
+from constants import CACHE_FOLDER
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ProbeCache:
+    """
+    Media file metadata from ffprobe, cached on disk by path, size and
+    modification time, so each file is only ever probed once.
+    """
+
+    def __init__(self, filename: str = os.path.join(CACHE_FOLDER,
+                                                    "probes.json")):
+        self.filename = os.path.expanduser(filename)
+        self._entries = None
+        self._lock = Lock()
+
+    def get(self, filename: str, field: str, compute):
+        key = _get_key(filename)
+        with self._lock:
+            entry = self._load().get(key, {})
+            if field in entry:
+                return entry[field]
+        value = compute(filename)
+        with self._lock:
+            self._load().setdefault(key, {})[field] = value
+            self._save()
+        return value
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.filename):
+                try:
+                    with open(self.filename) as cache_filehandle:
+                        self._entries = json.load(cache_filehandle)
+                except ValueError:
+                    print("\r\nWARNING: ignoring corrupt probe cache %s"
+                          % self.filename)
+        return self._entries
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = self.filename + ".part"
+        with open(temp_filename, "w") as cache_filehandle:
+            json.dump(self._entries, cache_filehandle)
+        os.replace(temp_filename, self.filename)
+
+
+_cache = ProbeCache()
+
+
+def _get_key(filename: str) -> str:
+    stat = os.stat(filename)
+    return "{}|{}|{}".format(
+        os.path.abspath(filename), stat.st_size, stat.st_mtime)
+
+
+def _ffprobe(filename: str, args: [str]) -> str:
+    command = ["ffprobe", "-v", "quiet", "-select_streams", "v:0"] + args
+    return subprocess.run(command + [filename],
+                          check=True,
+                          capture_output=True,
+                          text=True).stdout
+
+
+def _probe_keyframes(filename: str) -> [float]:
+    # Only packet headers are read, no frames are decoded
+    output = _ffprobe(filename, [
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+    ])
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ["", "N/A"]:
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+
+def _probe_video(filename: str) -> dict:
+    output = json.loads(_ffprobe(filename, [
+        "-show_entries", "stream=width,height:format=duration",
+        "-of", "json",
+    ]))
+    stream = output["streams"][0]
+    return {
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "duration": float(output["format"]["duration"]),
+    }
+
+
+def get_video_info(filename: str) -> dict:
+    """Width, height and duration of the video stream of a file"""
+    try:
+        return _cache.get(filename, "video", _probe_video)
+    except (OSError, subprocess.CalledProcessError, KeyError, IndexError,
+            ValueError) as e:
+        print("\r\nProbing (%s) failed: %s" % (filename, e))
+        return None
+
+
+def _hash_content(filename: str) -> str:
+    digest = hashlib.sha1()
+    with open(filename, "rb") as content_filehandle:
+        for chunk in iter(lambda: content_filehandle.read(HASH_CHUNK_SIZE),
+                          b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_content_hash(filename: str) -> str:
+    """SHA-1 of a file's contents, only read again if the file changes"""
+    return _cache.get(filename, "sha1", _hash_content)
+
+
+def get_keyframes(filename: str) -> [float]:
+    """Times (in seconds) of the keyframes of the video stream of a file"""
+    try:
+        return _cache.get(filename, "keyframes", _probe_keyframes)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("\r\nProbing (%s) failed: %s" % (filename, e))
+        return []
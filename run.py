@@ -1,31 +1,63 @@
 import os
 import sys
+import json
+import random
+import shutil
+import hashlib
 from contextlib import ExitStack, AbstractContextManager
-from concurrent.futures import ThreadPoolExecutor
-from threading import Thread, Lock, Semaphore
+from functools import partial
 import gc
 from math import ceil
 
+import numpy as np
 from moviepy.video import VideoClip
 from moviepy.audio.AudioClip import CompositeAudioClip
 from moviepy.audio.fx.volumex import volumex
 from moviepy.audio.io.AudioFileClip import AudioFileClip
 from moviepy.video.compositing.concatenate import concatenate_videoclips
-from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
 from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
 from moviepy.video.io.VideoFileClip import VideoFileClip
 from moviepy.video.fx.resize import resize
 
-from constants import TRANSITION_DURATION, FFMPEG_PRESET
+from constants import AUDIO_FPS,\
+    CACHE_FOLDER,\
+    FADE_DURATION,\
+    TRANSITION_DURATION,\
+    FFMPEG_PRESET,\
+    INTERMEDIATE_PROFILES,\
+    PREVIEW_ROUNDS,\
+    ROUND_CHECKPOINT
+from compilation import CUT_DTYPE, Compilation
+from compositor import composite_round
 from cutters import get_cutter
-from credit import make_credits
+from cpu import allocate
+from distributed import WorkerPool
+from preview import PreviewQueue
 from utils import get_black_clip,\
     get_round_name,\
+    make_credits,\
     make_metadata_file,\
     make_text_screen,\
     make_background,\
     crossfade
-from parsing import OutputConfig
+from parsing import OutputConfig, RoundConfig, parse_addresses
+from jobs import Job, JobGraph, Slots
+from segments import SourceReaders,\
+    cut_round,\
+    extract_segments,\
+    get_partial_name,\
+    join_segments
+from scheduler import MemoryScheduler,\
+    SpillCache,\
+    estimate_audio_memory,\
+    estimate_round_memory,\
+    estimate_screen_memory
+from stream import OrderedStream,\
+    StreamPart,\
+    copy_part,\
+    encode_part,\
+    mux_stream
+from transcode import TranscodeCache, get_mezzanine_args, get_proxy_args
 
 
 class StackList(AbstractContextManager):
@@ -43,165 +75,659 @@ class StackList(AbstractContextManager):
         return self._stacks[index]
 
 
-class ThreadWithReturnValue(Thread):
-    def __init__(self, group=None, target=None, name=None, daemon=False,
-                 args=(), kwargs={}, Verbose=None):
-        super().__init__(group, target, name, args, kwargs, daemon=daemon)
-        self._return = None
+def _write_video_file(
+    video: VideoClip,
+    filename: str,
+    output_config: OutputConfig,
+    threads: int,
+):
+    _, codec, ffmpeg_params, audio_codec = _get_profile(output_config)
+    video.write_videofile(
+        filename,
+        fps=output_config.fps,
+        codec=codec,
+        audio_codec=audio_codec,
+        preset=FFMPEG_PRESET,
+        threads=threads,
+        ffmpeg_params=ffmpeg_params,
+    )
 
-    def run(self):
-        try:
-            if self._target:
-                self._return = self._target(*self._args, **self._kwargs)
-        finally:
-            # Avoid a refcycle if the thread is running a function with
-            # an argument that has a member that points to the thread.
-            del self._target, self._args, self._kwargs
 
-    def join(self, *args):
-        Thread.join(self, *args)
-        return self._return
+def _write_video_parts(
+    video: VideoClip,
+    filename: str,
+    output_config: OutputConfig,
+    threads: int,
+    folder: str,
+):
+    # Parts start on frames, and are joined without encoding again. Their
+    # audio is encoded whole, as audio frames don't end on video frames.
+    fps = output_config.fps
+    frames = len(np.arange(0, video.duration, 1.0 / fps))
+    step = ceil(ROUND_CHECKPOINT * fps)
+    ext = os.path.splitext(filename)[1]
+    audio_ext, audio_codec = _get_audio_ext_codec(output_config)
+    filenames = [os.path.join(folder, "part%05i%s" % (p_i, ext))
+                 for p_i in range(ceil(frames / step))]
+    saved = [name for name in filenames if os.path.exists(name)]
+    if saved != []:
+        print("\r\nReusing %i of %i parts of %s saved in %s" % (
+            len(saved), len(filenames), filename, folder))
+    for p_i, part_filename in enumerate(filenames):
+        if part_filename in saved:
+            continue
+        first = p_i * step
+        last = min(first + step, frames)
+        part = video.subclip(first / fps, min(last / fps, video.duration))
+        # Half a frame short, so that only the part's frames are written
+        part = part.set_duration((last - first - 0.5) / fps).without_audio()
+        partial_filename = get_partial_name(part_filename)
+        _write_video_file(part, partial_filename, output_config, threads)
+        os.replace(partial_filename, part_filename)
+    audio_filename = None
+    if video.audio is not None:
+        audio_filename = os.path.join(folder, "audio." + audio_ext)
+        video.audio.write_audiofile(audio_filename,
+                                    fps=AUDIO_FPS,
+                                    codec=audio_codec,
+                                    logger=None)
+    join_segments(filenames, filename, audio_filename)
+    shutil.rmtree(folder, True)
 
 
 def _write_video(
     stack: ExitStack,
-    max_threads_semaphore: Semaphore,
     video: VideoClip,
     filename: str,
-    codec: str,
-    fps: float,
-    ext: str,
+    output_config: OutputConfig,
+    checkpoints: str = None,
+    keep_on_failure: bool = False,
 ):
-    max_threads_semaphore.acquire()
+    """
+    checkpoints: a folder to save the video in parts, kept if writing
+    fails, so that writing it again resumes after the last part saved
+    keep_on_failure: leave the video files open if writing fails, so the
+    video can still be rendered from memory
+    """
+    audio_ext, _ = _get_audio_ext_codec(output_config)
     try:
-        video.write_videofile(
-            filename,
-            fps=fps,
-            codec=codec,
-            preset=FFMPEG_PRESET,
-        )
+        with allocate(filename, output_config.threads) as allocation:
+            if checkpoints is None:
+                _write_video_file(video, filename, output_config,
+                                  allocation.threads)
+            else:
+                _write_video_parts(video, filename, output_config,
+                                   allocation.threads, checkpoints)
     except Exception as e:
         print("\r\nVideo (%s) failed to write: maybe not enough memory/disk"
               % filename)
         print(e)
         if os.path.exists(filename):
             os.remove(filename)
-        temp_mp3_filename = filename[:-4] + "TEMP_MPY_wvf_snd.mp3"
-        if os.path.exists(temp_mp3_filename):
-            os.remove(temp_mp3_filename)
+        temp_audio_filename = (os.path.splitext(filename)[0]
+                               + "TEMP_MPY_wvf_snd." + audio_ext)
+        if os.path.exists(temp_audio_filename):
+            os.remove(temp_audio_filename)
         filename = None
     finally:
-        stack.close()  # close all video files for this round
-        max_threads_semaphore.release()
+        if filename is not None or not keep_on_failure:
+            stack.close()  # close all video files for this round
     return filename
 
 
-def _get_ext_codec(is_raw: bool):
-    return ("avi" if is_raw else "mp4", "png" if is_raw else None)
+def _stream_video(
+    stack: ExitStack,
+    video: VideoClip,
+    part: StreamPart,
+    output_config: OutputConfig,
+):
+    name = "Part %i" % (part.index + 1)
+    try:
+        with allocate(name, output_config.threads) as allocation:
+            return encode_part(video,
+                               part,
+                               output_config.fps,
+                               allocation.threads,
+                               allocation.cpus if output_config.pin else [])
+    finally:
+        stack.close()  # close all video files for this part
+
+
+def _get_profile(output_config: OutputConfig) -> (str, str, [str], str):
+    """Extension, codecs and ffmpeg parameters of intermediate videos"""
+    intermediate = output_config.intermediate
+    if output_config.raw and intermediate == "h264":
+        intermediate = "ffv1"  # raw output must be lossless
+    return INTERMEDIATE_PROFILES[intermediate]
+
+
+def _is_encoded_again(output_config: OutputConfig) -> bool:
+    """Whether intermediate videos are encoded into the final video"""
+    return not output_config.raw and output_config.intermediate != "h264"
+
+
+def _get_output_ext(output_config: OutputConfig) -> str:
+    if _is_encoded_again(output_config):
+        return "mp4"
+    return _get_profile(output_config)[0]
+
+
+def _get_segment_profile(output_config: OutputConfig):
+    """Intra-frame profile of the cuts decoded from each source in turn"""
+    if output_config.intermediate == "h264":
+        return INTERMEDIATE_PROFILES["h264-intra"]
+    return _get_profile(output_config)
+
+
+def _get_audio_ext_codec(output_config: OutputConfig):
+    _, _, _, audio_codec = _get_profile(output_config)
+    return ("wav" if audio_codec == "pcm_s16le" else "mp3", audio_codec)
+
+
+def _get_round_artifact_names(
+    output_config: OutputConfig,
+    round_config: RoundConfig
+) -> (str, str, str):
+    """Video stream, mixed audio stream and audio settings of a round"""
+    ext, _, _, _ = _get_profile(output_config)
+    audio_ext, _ = _get_audio_ext_codec(output_config)
+    return (
+        get_round_name(output_config.name, round_config.name + "_Video", ext),
+        get_round_name(output_config.name, round_config.name + "_Audio",
+                       audio_ext),
+        get_round_name(output_config.name, round_config.name + "_Audio",
+                       "json"),
+    )
+
+
+def _get_file_signature(filename: str):
+    if filename is None or not os.path.exists(filename):
+        return None
+    stat = os.stat(filename)
+    return [filename, stat.st_size, stat.st_mtime]
+
+
+def _get_checkpoint_names(
+    output_config: OutputConfig,
+    round_config: RoundConfig
+) -> (str, str, str):
+    """Plan, segments folder and video parts folder of a round"""
+    return (
+        get_round_name(output_config.name, round_config.name + "_Plan",
+                       "json"),
+        get_round_name(output_config.name, round_config.name + "_Segments",
+                       "parts"),
+        get_round_name(output_config.name, round_config.name + "_Video",
+                       "parts"),
+    )
+
+
+def _remove_checkpoints(output_config: OutputConfig,
+                        round_config: RoundConfig):
+    for name in _get_checkpoint_names(output_config, round_config):
+        if os.path.isdir(name):
+            shutil.rmtree(name, True)
+        elif os.path.exists(name):
+            os.remove(name)
+
+
+def _get_plan_signature(output_config: OutputConfig,
+                        round_config: RoundConfig) -> dict:
+    signature = {
+        "seed": output_config.seed,
+        "versions": output_config.versions,
+        "score": output_config.score,
+        "dims": [output_config.xdim, output_config.ydim],
+        "fps": output_config.fps,
+        "cut": round_config.cut,
+        "duration": round_config.duration,
+        "speed": round_config.speed,
+        "bpm": round_config.bpm,
+        "bmcfg": _get_file_signature(round_config.bmcfg),
+        "sources": [_get_file_signature(source)
+                    for source in round_config.sources],
+    }
+    return json.loads(json.dumps(signature))  # as it is saved
+
+
+def _load_plan(filename: str, signature: dict) -> np.ndarray:
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as plan_filehandle:
+        try:
+            plan = json.load(plan_filehandle)
+        except ValueError:
+            return None
+    if plan.get("signature") != signature:
+        return None
+    return np.array([tuple(cut) for cut in plan["cuts"]], dtype=CUT_DTYPE)
+
+
+def _save_plan(filename: str, signature: dict, seed: int,
+               cuts: np.ndarray):
+    partial_filename = get_partial_name(filename)
+    with open(partial_filename, "w") as plan_filehandle:
+        json.dump({"signature": signature,
+                   "seed": seed,
+                   "cuts": cuts.tolist()}, plan_filehandle)
+    os.replace(partial_filename, filename)
+
+
+def _open_checkpoints(folder: str, signature: dict) -> str:
+    """A folder of checkpoints, emptied unless they were saved the same way"""
+    signature = json.loads(json.dumps(signature))
+    filename = os.path.join(folder, "checkpoint.json")
+    try:
+        with open(filename) as checkpoint_filehandle:
+            is_current = json.load(checkpoint_filehandle) == signature
+    except (OSError, ValueError):
+        is_current = False
+    if not is_current:
+        shutil.rmtree(folder, True)
+        os.makedirs(folder)
+        with open(filename, "w") as checkpoint_filehandle:
+            json.dump(signature, checkpoint_filehandle)
+    return folder
+
+
+def _get_cuts_signature(output_config: OutputConfig,
+                        compilation: Compilation) -> dict:
+    return {
+        "cuts": hashlib.sha1(compilation.cuts.tobytes()).hexdigest(),
+        "sources": [source.path for source in compilation.sources],
+        "dims": [output_config.xdim, output_config.ydim],
+        "fps": output_config.fps,
+        "profile": _get_segment_profile(output_config),
+    }
+
+
+def _get_audio_signature(round_config: RoundConfig) -> dict:
+    return {
+        "audio_level": round_config.audio_level,
+        "beats": _get_file_signature(round_config.beats),
+        "music": _get_file_signature(round_config.music),
+    }
+
+
+def _is_audio_current(signature_filename: str, round_config: RoundConfig):
+    if not os.path.exists(signature_filename):
+        return False
+    with open(signature_filename) as signature_filehandle:
+        try:
+            signature = json.load(signature_filehandle)
+        except ValueError:
+            return False
+    return signature == _get_audio_signature(round_config)
+
+
+def _get_music_audio(stack: ExitStack, round_config: RoundConfig):
+    """Combine the beats and music tracks of a round, if it has any"""
+    audio = [
+        stack.enter_context(AudioFileClip(clip))
+        for clip in [
+            round_config.beats,
+            round_config.music,
+        ]
+        if clip is not None
+    ]
+    return CompositeAudioClip(audio) if audio != [] else None
+
+
+def _mix_audio(music_audio, source_audio, level: float):
+    if level > 1:
+        music_audio = volumex(music_audio, 1 / level)
+    else:
+        source_audio = volumex(source_audio, level)
+    return CompositeAudioClip([music_audio, source_audio])
+
+
+def _write_round_audio(
+    output_config: OutputConfig,
+    round_config: RoundConfig,
+    video_filename: str,
+):
+    """
+    Mix the music and beats into the source audio of a round video stream,
+    then remux it with the (unchanged) video stream into the round video.
+    """
+    filename = get_round_name(output_config.name, round_config.name,
+                              _get_profile(output_config)[0])
+    _, audio_filename, signature_filename = _get_round_artifact_names(
+        output_config, round_config)
+    _, audio_codec = _get_audio_ext_codec(output_config)
+
+    print("\r\nMixing audio for round %s..." % round_config.name)
+    with ExitStack() as stack:
+        try:
+            source_audio = stack.enter_context(AudioFileClip(video_filename))
+            audio = source_audio
+            music_audio = _get_music_audio(stack, round_config)
+            if music_audio is not None:
+                # Music starts after the fade in, and stops with the round
+                music_audio = music_audio.set_duration(
+                    round_config.duration).set_start(FADE_DURATION)
+                audio = _mix_audio(music_audio,
+                                   source_audio,
+                                   round_config.audio_level)
+            audio = audio.set_duration(source_audio.duration)
+            audio.write_audiofile(audio_filename,
+                                  fps=source_audio.fps,
+                                  codec=audio_codec)
+        except Exception as e:
+            print("\r\nAudio (%s) failed to write" % audio_filename)
+            print(e)
+            if os.path.exists(audio_filename):
+                os.remove(audio_filename)
+            return None
+
+    # Remux, copying both the video and the newly mixed audio streams
+    command = "ffmpeg {} {} {} {} {}".format(
+        '-v quiet -y',
+        '-i "%s"' % video_filename,
+        '-i "%s"' % audio_filename,
+        '-map 0:v:0 -map 1:a:0 -c copy',
+        '"%s"' % filename,
+    )
+    if os.system(command) != 0:
+        print("\r\nVideo (%s) failed to remux" % filename)
+        if os.path.exists(filename):
+            os.remove(filename)
+        return None
+
+    with open(signature_filename, "w") as signature_filehandle:
+        json.dump(_get_audio_signature(round_config), signature_filehandle)
+    return filename
+
+
+def _remix_round(output_config: OutputConfig, r_i: int):
+    """Only remix the audio of a round whose video stream has been saved"""
+    round_config = output_config.rounds[r_i]
+    video_filename, _, _ = _get_round_artifact_names(output_config,
+                                                     round_config)
+    filename = _write_round_audio(output_config,
+                                  round_config,
+                                  video_filename)
+    round_config._is_on_disk = filename is not None
+    return filename
+
+
+def _plan_round(
+    stack: ExitStack,
+    output_config: OutputConfig,
+    r_i: int,
+    proxies: TranscodeCache = None,
+    previews: PreviewQueue = None,
+    mezzanines: TranscodeCache = None,
+) -> Compilation:
+    """
+    Choose a round's cuts, or reload those chosen by an earlier run that
+    didn't finish the round. Each plan is saved with the seed of its random
+    choices, so that an interrupted round resumes with the same cuts.
+    """
+    round_config = output_config.rounds[r_i]
+    plan_filename, _, _ = _get_checkpoint_names(output_config, round_config)
+    signature = _get_plan_signature(output_config, round_config)
+    cuts = _load_plan(plan_filename, signature)
+    seed = output_config.seed
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+
+    # Get list of clips cut from sources using chosen cutter
+    # TODO: get duration, bpm from music track; generate beatmeter
+    print("\r\nLoading sources for round #%i..." % (r_i + 1))
+    cutter = get_cutter(stack, output_config, round_config, proxies,
+                        previews, r_i, mezzanines, seed)
+    if cuts is not None:
+        print("\r\nReloaded plan of round #%i from %s"
+              % (r_i + 1, plan_filename))
+        return Compilation(cutter.sources, cuts)
+    print("\r\nShuffling input videos for round #%i..." % (r_i+1))
+    compilation = cutter.get_compilation()
+    if output_config.versions > 1:
+        print("\r\nVersions chosen for round #%i" % (r_i + 1))
+    _save_plan(plan_filename, signature, seed, compilation.cuts)
+    return compilation
+
+
+def _cut_round(
+    stack: ExitStack,
+    output_config: OutputConfig,
+    r_i: int,
+    compilation: Compilation,
+) -> VideoClip:
+    dims = (output_config.xdim, output_config.ydim)
+    if output_config.order == "timeline":
+        readers = SourceReaders(compilation, dims)
+        stack.callback(_report_readers, r_i, readers)
+        return cut_round(readers)
+
+    # Segments are kept until the round is saved, to resume it if it isn't
+    round_config = output_config.rounds[r_i]
+    _, folder, _ = _get_checkpoint_names(output_config, round_config)
+    _open_checkpoints(folder, _get_cuts_signature(output_config,
+                                                  compilation))
+    print("\r\nDecoding sources for round #%i..." % (r_i + 1))
+    workers = None
+    if output_config.workers != "":
+        workers = WorkerPool(parse_addresses(output_config.workers))
+    return extract_segments(stack,
+                            compilation,
+                            dims,
+                            output_config.fps,
+                            _get_segment_profile(output_config),
+                            folder,
+                            output_config.threads,
+                            workers)
+
+
+def _report_readers(r_i: int, readers: SourceReaders):
+    readers.close()
+    print("\r\nRound #%i had at most %i of %i sources open at once" % (
+        r_i + 1, readers.peak, len(readers.compilation.sources)))
 
 
 def make_round(
     stack: ExitStack,
     output_config: OutputConfig,
     r_i: int,
-    cutter_lock: Lock,
-    max_threads_semaphore: Semaphore
+    compilation: Compilation = None,
+    beatmeter: VideoClip = None,
+    part: StreamPart = None,
+    spills: SpillCache = None,
+    mezzanines: TranscodeCache = None,
 ):
-    max_threads_semaphore.acquire()
+    """Render a round, planning its cuts first unless they are chosen"""
     round_config = output_config.rounds[r_i]
-    ext, codec = _get_ext_codec(output_config.raw)
+    if compilation is None:
+        compilation = _plan_round(stack, output_config, r_i,
+                                  mezzanines=mezzanines)
+    round_video = _cut_round(stack, output_config, r_i, compilation)
+    checkpoints = None
+    if output_config.cache == "round":
+        _, _, folder = _get_checkpoint_names(output_config, round_config)
+        checkpoints = _open_checkpoints(folder, dict(
+            _get_cuts_signature(output_config, compilation),
+            profile=_get_profile(output_config),
+            beatmeter=_get_file_signature(round_config.beatmeter),
+            bmcfg=_get_file_signature(round_config.bmcfg)))
+    round_video = _render_round(stack, output_config, r_i, round_video,
+                                beatmeter, checkpoints)
+    if part is not None:
+        round_video = _stream_video(stack, round_video, part,
+                                    output_config)
+    elif spills is not None:
+        # Rounds render concurrently, and open their sources lazily, so the
+        # memory of each one can't be told apart: spill by their estimates
+        size = estimate_round_memory(output_config, round_config)
+        ext, _, _, _ = _get_profile(output_config)
+        spills.add(round_video, size, partial(
+            _write_video,
+            stack,
+            round_video,
+            get_round_name(output_config.name, round_config.name, ext),
+            output_config,
+            keep_on_failure=True))
+    gc.collect()  # Free as much memory as possible
+    return round_video
+
+
+def _get_round_length(round_config: RoundConfig) -> float:
+    # Rounds fade in from black and out to black
+    return round_config.duration + 2 * FADE_DURATION
+
+
+def _wait_mezzanine(mezzanines: TranscodeCache, source: str) -> str:
+    mezzanine = mezzanines.wait(source)
+    if mezzanine is None:
+        print("\r\nCutting from %s itself, without a mezzanine" % source)
+        return source
+    return mezzanine
+
+
+def _add_round_jobs(
+    graph: JobGraph,
+    stack: ExitStack,
+    output_config: OutputConfig,
+    r_i: int,
+    proxies: TranscodeCache,
+    previews: PreviewQueue,
+    stream: OrderedStream = None,
+    spills: SpillCache = None,
+    mezzanines: TranscodeCache = None,
+    transcodes: [Job] = (),
+) -> Job:
+    """transcodes: jobs making the mezzanines of the round's sources"""
+    round_config = output_config.rounds[r_i]
+    name = "Round " + str(r_i + 1)
+    # Parts are the title, then each round's transition and round, then credits
+    part = None
+    on_failure = None
+    if stream is not None:
+        part = stream.part(2 + 2 * r_i)
+        on_failure = partial(part.fail, RuntimeError(name + " failed"))
 
     # Skip rounds that have been saved
     if round_config._is_on_disk:
-        name = get_round_name(output_config.name, round_config.name, ext)
-        max_threads_semaphore.release()
-        return name
+        ext, _, _, _ = _get_profile(output_config)
+        filename = get_round_name(output_config.name, round_config.name, ext)
+        if part is not None:
+            return graph.add(name,
+                             lambda: copy_part(
+                                 filename,
+                                 part,
+                                 _is_encoded_again(output_config)),
+                             resource="io",
+                             on_failure=on_failure)
+        return graph.add(name, lambda: filename)
+
+    if round_config._is_video_on_disk:
+        def remix_round():
+            filename = _remix_round(output_config, r_i)
+            if part is not None and filename is not None:
+                return copy_part(filename, part,
+                                 _is_encoded_again(output_config))
+            return filename
+        return graph.add(name,
+                         remix_round,
+                         resource="io",
+                         estimate=estimate_audio_memory(round_config),
+                         on_failure=on_failure)
 
     # Assemble beatmeter video from beat images
-    bmcfg = (round_config.beatmeter_config
-             if round_config.bmcfg else None)
+    beatmeter = None
     if round_config.beatmeter is not None:
-        print("\r\nAssembling beatmeter #{}...".format(r_i + 1))
-        beatmeter_thread = ThreadWithReturnValue(
-            target=lambda: make_beatmeter(
+        bmcfg = (round_config.beatmeter_config
+                 if round_config.bmcfg else None)
+
+        def assemble_beatmeter():
+            print("\r\nAssembling beatmeter #{}...".format(r_i + 1))
+            return make_beatmeter(
                 stack,
                 round_config.beatmeter,
                 bmcfg.fps if bmcfg else output_config.fps,
                 round_config.duration,
                 (output_config.xdim, output_config.ydim),
-            ),
-            daemon=True,
-        )
-        beatmeter_thread.start()
+            )
+        beatmeter = graph.add("Round %i beatmeter" % (r_i + 1),
+                              assemble_beatmeter,
+                              resource="decode")
 
-    # Get list of clips cut from sources using chosen cutter
-    # TODO: get duration, bpm from music track; generate beatmeter
-    print("\r\nLoading sources for round #%i..." % (r_i + 1))
-    cutter = get_cutter(stack, output_config, round_config)
-    print("\r\nShuffling input videos for round #%i..." % (r_i+1))
+    # Versions are chosen (in turn with other rounds' choices) before
+    # admission, so that other rounds render in the meantime. Otherwise,
+    # sources are only opened once the round is admitted.
+    plan = None
     if output_config.versions > 1:
-        # Await previous cutter, if still previewing
-        cutter_lock.acquire()
-        # TODO: pass in cutter lock to release on preview exit
-        clips = cutter.get_compilation()
-        cutter_lock.release()
-    else:
-        clips = cutter.get_compilation()
-
-    # Assemble audio from music and beats
-    audio = None
-    if (round_config.music is not None
-            or round_config.beats is not None):
-        audio = [
-            stack.enter_context(AudioFileClip(clip))
-            for clip in [
-                round_config.beats,
-                round_config.music,
-            ]
-            if clip is not None
-        ]
+        plan = graph.add("Round %i versions" % (r_i + 1),
+                         lambda: _plan_round(stack, output_config, r_i,
+                                             proxies, previews, mezzanines),
+                         dependencies=transcodes,
+                         resource="plan",
+                         priority=r_i)
 
-    # Concatenate this round's video clips together and add audio
-    round_video = concatenate_videoclips(clips)
-    if audio is not None:
-        beat_audio = CompositeAudioClip(audio)
-        level = round_config.audio_level
-        if level > 1:
-            beat_audio = volumex(beat_audio, 1 / level)
-        else:
-            round_video = volumex(round_video, level)
-        audio = CompositeAudioClip([beat_audio, round_video.audio])
-        round_video = round_video.set_audio(audio)
+    return graph.add(
+        name,
+        lambda: make_round(stack,
+                           output_config,
+                           r_i,
+                           plan.result if plan is not None else None,
+                           beatmeter.result if beatmeter is not None
+                           else None,
+                           part,
+                           spills,
+                           mezzanines),
+        dependencies=[plan, beatmeter] + list(transcodes),
+        resource="encode",
+        estimate=estimate_round_memory(output_config, round_config),
+        priority=part.index if part is not None else 0,
+        on_failure=on_failure)
 
-    # Add beatmeter, if supplied
-    if round_config.beatmeter is not None:
-        # Wait for beatmeter, if it exists
-        print("\r\nWaiting for beatmeter #%i..." % (r_i + 1))
-        beatmeter = beatmeter_thread.join()
-        round_video = CompositeVideoClip([round_video, beatmeter])
-    round_video = round_video.set_duration(round_config.duration)
-
-    # Fade in and out
-    round_video = crossfade([
-        get_black_clip((output_config.xdim, output_config.ydim)),
-        round_video,
-        get_black_clip((output_config.xdim, output_config.ydim)),
-    ])
+
+def _render_round(
+    stack: ExitStack,
+    output_config: OutputConfig,
+    r_i: int,
+    round_video: VideoClip,
+    beatmeter: VideoClip,
+    checkpoints: str = None,
+):
+    """checkpoints: a folder to save the round's video in parts"""
+    round_config = output_config.rounds[r_i]
+
+    # Add audio from music and beats, unless it is mixed in after saving
+    if output_config.cache != "round":
+        music_audio = _get_music_audio(stack, round_config)
+        if music_audio is not None:
+            round_video = round_video.set_audio(_mix_audio(
+                music_audio,
+                round_video.audio,
+                round_config.audio_level))
+
+    # Add beatmeter, if supplied, and fade in and out
+    round_video = composite_round(round_video,
+                                  beatmeter,
+                                  round_config.duration,
+                                  (output_config.xdim, output_config.ydim))
 
     if output_config.cache == "round":
-        # Save each round video to disk
-        filename = get_round_name(output_config.name, round_config.name, ext)
-        filename = _write_video(stack,
-                                round_video,
-                                filename,
-                                codec,
-                                output_config.fps,
-                                ext)
+        # Save each round's video stream to disk, then mix in its audio
+        video_filename, _, _ = _get_round_artifact_names(output_config,
+                                                         round_config)
+        video_filename = _write_video(stack,
+                                      round_video,
+                                      video_filename,
+                                      output_config,
+                                      checkpoints)
+        round_config._is_video_on_disk = video_filename is not None
+        if video_filename is not None:
+            _remove_checkpoints(output_config, round_config)
+        filename = None
+        if video_filename is not None:
+            filename = _write_round_audio(output_config,
+                                          round_config,
+                                          video_filename)
         round_config._is_on_disk = filename is not None
-        max_threads_semaphore.release()
         return filename
-    else:  # output_config.cache == "all":
-        max_threads_semaphore.release()
+    else:  # output_config.cache == "all", "auto" or "stream":
         return round_video  # Store round in memory instead
 
 
@@ -286,14 +812,14 @@ def make_credits_video(stack: ExitStack, output_config: OutputConfig):
     credits_video = None
     if credits_data_list != []:
         print("\r\nAssembling Credits...")
-        if output_config.cache == "all":
+        if output_config.cache in ["all", "auto"]:
             credits_video = make_credits(credits_data_list,
                                          output_config.xdim,
                                          output_config.ydim,
                                          stroke_color=None,
                                          gap=30)
         else:
-            ext, _ = _get_ext_codec(output_config.raw)
+            ext, _, _, _ = _get_profile(output_config)
             credits_video_filename = "%s_Credits.%s" % (output_name, ext)
             if os.path.exists(credits_video_filename):
                 print("\r\nReloaded %s from disk" % credits_video_filename)
@@ -310,252 +836,576 @@ def make_credits_video(stack: ExitStack, output_config: OutputConfig):
     return credits_video
 
 
-def make(output_config: OutputConfig):
-    ext, codec = _get_ext_codec(output_config.raw)
-    output_name = output_config.name
-    max_threads = output_config.threads
-    credits_data_list = [r.credits for r in output_config.rounds]
+def _add_screen_job(
+    graph: JobGraph,
+    stack: ExitStack,
+    output_config: OutputConfig,
+    name: str,
+    filename: str,
+    make_video,
+    part: StreamPart = None,
+) -> Job:
+    """Make a title, transition or credits video, unless it is saved"""
+    if output_config.cache in ["all", "auto"]:
+        return graph.add(name, make_video)  # Store video in memory instead
 
-    if output_config.rounds == []:
-        print("\r\nERROR: No round configs provided")
-        sys.exit(1)
+    if output_config.cache == "stream":
+        # Make the video first, as the chapter metadata needs its duration
+        video = graph.add(name, make_video)
+        # Earlier parts are encoded first, so later ones wait less in memory
+        graph.add(name + " stream",
+                  lambda: _stream_video(stack,
+                                        video.result,
+                                        part,
+                                        output_config),
+                  dependencies=[video],
+                  resource="encode",
+                  estimate=estimate_screen_memory(output_config),
+                  priority=part.index,
+                  on_failure=partial(part.fail,
+                                     RuntimeError(name + " failed")))
+        return video
 
-    round_configs = output_config.rounds
-    for round_config in round_configs:
-        name = get_round_name(output_name, round_config.name, ext)
-        if os.path.exists(name):
-            round_config._is_on_disk = True
-            print("\r\nReloaded round %s from disk" % name)
+    if os.path.exists(filename):
+        # If it exists, don't remake it
+        print("\r\nReloaded %s from disk" % filename)
+        return graph.add(name, lambda: filename)
 
-    with StackList(len(round_configs) + 2) as stacks:
-        # Shuffle clips for each round and attach beatmeters
-        rounds = []
-        with ThreadPoolExecutor(max_workers=max_threads) as executor:
-            # Make each round with a worker thread
-            cutter_lock = Lock()
-            thread_count = Semaphore(max_threads)
-            rounds = executor.map(lambda a: make_round(*a), [
-                (stacks[r_i], output_config, r_i, cutter_lock, thread_count)
-                for r_i in range(len(round_configs))
-            ])
-            rounds = [r if type(r) is str else r.result() for r in rounds]
-
-        # Check that all intermediate videos were output correctly
-        ok = True
-        for r_i, r in enumerate(rounds):
-            if r is None:
-                ok = False
-                print("\r\nERROR: Round %i was not prepared" % r_i)
-        if not ok:
-            sys.exit(1)
+    return graph.add(
+        name,
+        lambda: _write_video(stack,
+                             make_video(),
+                             filename,
+                             output_config),
+        resource="encode",
+        estimate=estimate_screen_memory(output_config))
 
-        print("\r\nAll Rounds prepared")
-        gc.collect()  # Free as much memory as possible
-
-        if output_config.assemble and output_config.cache == "all":
-            credits_video = make_credits_video(stacks[-1], output_config)
-            main_title_video = make_title_video(stacks[-2], output_config)
-            round_transitions = [
-                make_transition_video(stacks[r_i], output_config, r_i)
-                for r_i in range(len(rounds))
-            ]
-
-            print("\r\nBeginning Final Assembly")
-
-            # Reload rounds from output files, if not still in memory
-            rounds = [
-                stacks[r_i].enter_context(VideoFileClip(r))
-                if type(r) is str else r for r, r_i in enumerate(rounds)
-            ]
-
-            # Gather together all the videos
-            all_video = [None] * 2 * len(rounds)
-            all_video[0::2] = round_transitions
-            all_video[1::2] = rounds
-            all_video = [main_title_video] + all_video
-            if credits_video is not None:
-                all_video.append(credits_video)
-
-            # Output final video
-            temp_video_name = "%s_TEMP.%s" % (output_name, ext)
-            concatenate_videoclips(all_video).write_videofile(
-                temp_video_name,
-                codec=codec,
-                fps=output_config.fps,
-                preset=FFMPEG_PRESET,
-                threads=output_config.threads,
-            )
 
-            # Prepare metadata file for chapter markers
-            metadata_filename = output_name + ".ffmd"
-            make_metadata_file(metadata_filename,
-                               output_name,
-                               [video.duration for video in all_video],
-                               credits_data_list)
-
-            # Add metadata
-            # TODO: don't duplicate output file
-            command = "ffmpeg {} {} {} {} {}".format(
-                '-v quiet -stats -y',
-                '-i "concat:%s"' % temp_video_name,
-                '-i "%s"' % metadata_filename,
-                '-c copy -map_metadata 1',
-                '"%s.%s"' % (output_name, ext),
-            )
-            os.system(command)
+def _write_metadata(output_config: OutputConfig, parts: list):
+    """Prepare metadata file for chapter markers"""
+    round_lengths = []
+    for part in parts:
+        if type(part) is str:
+            with VideoFileClip(part) as video_file:
+                round_lengths.append(video_file.duration)
+        elif type(part) is float:
+            round_lengths.append(part)
+        else:
+            round_lengths.append(part.duration)
+    metadata_filename = output_config.name + ".ffmd"
+    make_metadata_file(metadata_filename,
+                       output_config.name,
+                       round_lengths,
+                       [r.credits for r in output_config.rounds])
+    return metadata_filename
 
-    if output_config.assemble and output_config.cache != "all":
-        print("\r\nWriting Round Transitions and Main Title")
-        # Write temporary videos using multiple workers
-        with StackList(len(rounds) + 2) as stacks, ThreadPoolExecutor(
-                max_workers=max_threads) as executor:
 
-            # Write credits, if they exist
-            thread_count = Semaphore(1)  # Use only one thread for now
-            credits_video_filename = "%s_Credits.%s" % (output_name, ext)
-            if not os.path.exists(credits_video_filename):
-                # If it exists, don't remake it
-                credits_video = make_credits_video(stacks[-1], output_config)
-                if credits_video is not None:
-                    credits_future = executor.submit(_write_video,
-                                                     stacks[-1],
-                                                     thread_count,
-                                                     credits_video,
-                                                     credits_video_filename,
-                                                     codec,
-                                                     output_config.fps,
-                                                     ext)
-                else:
-                    credits_future = None
-            else:
-                print("\r\nReloaded Credits video from disk")
-                credits_future = credits_video_filename
-
-            # Write main title screen video
-            main_title_filename = "{}_Title.{}".format(output_name, ext)
-            if not os.path.exists(main_title_filename):
-                # If it exists, don't remake it
-                main_title_video = make_title_video(stacks[-2], output_config)
-                main_title_future = executor.submit(_write_video,
-                                                    stacks[-2],
-                                                    thread_count,
-                                                    main_title_video,
-                                                    main_title_filename,
-                                                    codec,
-                                                    output_config.fps,
-                                                    ext)
-            else:
-                print("\r\nReloaded Main Title video from disk")
-                main_title_future = main_title_filename
-
-            thread_count = Semaphore(max_threads)
-            # Write round transitions
-            round_title_futures = []
-            for r_i in range(len(rounds)):
-                round_title_filename = get_round_name(
-                    output_name,
-                    round_configs[r_i].name + "_Title",
-                    ext)
-                # If they exist, don't remake them
-                if not os.path.exists(round_title_filename):
-                    round_transition_video = make_transition_video(
-                        stacks[r_i], output_config, r_i)
-                    round_title_futures.append(executor.submit(
-                        _write_video,
-                        stacks[r_i],
-                        thread_count,
-                        round_transition_video,
-                        round_title_filename,
-                        codec,
-                        output_config.fps,
-                        ext))
-                else:
-                    print("\r\nReloaded Round %i (%s) from disk" %
-                          (r_i + 1, round_title_filename))
-                    round_title_futures.append(round_title_filename)
-
-            print("\r\nWaiting for all parts to finish...")
-            if credits_future is not None:
-                credits_video_filename = (credits_future
-                                          if type(credits_future) == str
-                                          else credits_future.result())
-            else:
-                credits_video_filename = None
-            main_title_filename = (main_title_future
-                                   if type(main_title_future) == str
-                                   else main_title_future.result())
-            transition_filenames = [transition_future
-                                    if type(transition_future) == str
-                                    else transition_future.result()
-                                    for transition_future
-                                    in round_title_futures]
-
-        # Assemble list of videos to concatenate
-        intermediate_filenames = [None] * 2 * len(rounds)
-        intermediate_filenames[0::2] = transition_filenames
-        intermediate_filenames[1::2] = rounds
-        intermediate_filenames = [main_title_filename] + intermediate_filenames
-        if credits_video_filename is not None:
-            intermediate_filenames.append(credits_video_filename)
-
-        # Check that all intermediate videos were output correctly
-        ok = True
-        for f_i, filename in enumerate(intermediate_filenames):
-            if filename is None:
-                round_index = (f_i + 1) // 2
-                if f_i == 0:
-                    video_name = "Main Title"
-                elif credits_video and f_i == len(intermediate_filenames) - 1:
-                    video_name = "Credits"
-                elif f_i % 2 == 1:  # If this is a round transition
-                    video_name = "Round %i Intro" % round_index
-                else:
-                    video_name = "Round " + str(round_index)
-                ok = False
-                print("\r\nVideo %s was not prepared" % video_name)
-        if not ok:
-            sys.exit(1)
+def _write_all(
+    stack: ExitStack,
+    output_config: OutputConfig,
+    parts: list,
+    metadata_filename: str,
+):
+    """Encode all videos, stored in memory, into the final video"""
+    output_name = output_config.name
+    ext = _get_output_ext(output_config)
+    codec, ffmpeg_params, audio_codec = None, [], None
+    if output_config.raw:
+        _, codec, ffmpeg_params, audio_codec = _get_profile(output_config)
+    print("\r\nBeginning Final Assembly")
 
-        print("\r\nBeginning final assembly")
-        # Output intermediate filenames to file for FFMpeg
-        filelist_filename = "%s_inputs.txt" % output_name
-        with open(filelist_filename, "w") as filelist_handle:
-            # TODO: Don't use inputs.txt intermediate file
-            filelist_handle.writelines([
-                "file '%s'\n" % intermediate_filename.replace("'", "\\'")
-                for intermediate_filename in intermediate_filenames
-            ])
-
-        # Prepare metadata file for chapter markers
-        round_lengths = []
-        for filename in intermediate_filenames:
-            with VideoFileClip(filename) as video_file:
-                round_lengths.append(video_file.duration)
-        metadata_filename = output_name + ".ffmd"
-        make_metadata_file(metadata_filename,
-                           output_name,
-                           round_lengths,
-                           credits_data_list)
+    # Reload rounds from output files, if not still in memory
+    all_video = [
+        stack.enter_context(VideoFileClip(part))
+        if type(part) is str else part for part in parts
+    ]
+
+    # Output final video
+    temp_video_name = "%s_TEMP.%s" % (output_name, ext)
+    with allocate(temp_video_name) as allocation:
+        concatenate_videoclips(all_video).write_videofile(
+            temp_video_name,
+            codec=codec,
+            audio_codec=audio_codec,
+            fps=output_config.fps,
+            preset=FFMPEG_PRESET,
+            threads=allocation.threads,
+            ffmpeg_params=ffmpeg_params,
+        )
+
+    # Add metadata
+    # TODO: don't duplicate output file
+    filename = "%s.%s" % (output_name, ext)
+    command = "ffmpeg {} {} {} {} {}".format(
+        '-v quiet -stats -y',
+        '-i "concat:%s"' % temp_video_name,
+        '-i "%s"' % metadata_filename,
+        '-c copy -map_metadata 1',
+        '"%s"' % filename,
+    )
+    return filename if os.system(command) == 0 else None
+
+
+def _concat(
+    output_config: OutputConfig,
+    intermediate_filenames: [str],
+    metadata_filename: str,
+):
+    """Copy all videos, saved on disk, into the final video"""
+    output_name = output_config.name
+    ext = _get_output_ext(output_config)
+    print("\r\nBeginning final assembly")
+
+    # Output intermediate filenames to file for FFMpeg
+    filelist_filename = "%s_inputs.txt" % output_name
+    with open(filelist_filename, "w") as filelist_handle:
+        # TODO: Don't use inputs.txt intermediate file
+        filelist_handle.writelines([
+            "file '%s'\n" % intermediate_filename.replace("'", "\\'")
+            for intermediate_filename in intermediate_filenames
+        ])
+
+    filename = "%s.%s" % (output_name, ext)
+    with allocate(filename) as allocation:
+        # Lossless intermediate videos get their only lossy encode here
+        codecs = '-c copy'
+        if _is_encoded_again(output_config):
+            codecs = '-c:v libx264 -preset {} -pix_fmt yuv420p {} {}'.format(
+                FFMPEG_PRESET,
+                '-c:a libmp3lame',
+                '-threads %i' % allocation.threads)
 
         command = "ffmpeg {} {} {} {} {}".format(
             '-v quiet -stats -y -f concat -safe 0',
             '-i "%s"' % filelist_filename,
             '-i "%s"' % metadata_filename,
-            '-c copy -map_metadata 1',
-            '"%s.%s"' % (output_name, ext),
+            codecs + ' -map_metadata 1',
+            '"%s"' % filename,
         )
-        os.system(command)
-        intermediate_filenames.append(metadata_filename)
-        intermediate_filenames.append(filelist_filename)
-    elif output_config.cache == "all":
-        intermediate_filenames = [temp_video_name, metadata_filename]
+        return filename if os.system(command) == 0 else None
+
+
+def _add_assembly_jobs(
+    graph: JobGraph,
+    stacks: StackList,
+    output_config: OutputConfig,
+    rounds: [Job],
+    stream: OrderedStream = None,
+    spills: SpillCache = None,
+    first_job: int = 0,
+) -> [Job]:
+    """
+    Add title, transitions, credits and final video; return the parts
+    first_job: index of the project's first job in the graph, which other
+    projects' jobs may come before
+    """
+    output_name = output_config.name
+    ext, _, _, _ = _get_profile(output_config)
+    num_rounds = len(rounds)
+    stream_parts = [None] * (2 * num_rounds + 2)
+    if stream is not None:
+        stream_parts = [stream.part(p_i) for p_i in range(len(stream_parts))]
+
+    # Titles don't depend on any rounds, so they are made alongside them
+    main_title = _add_screen_job(
+        graph,
+        stacks[-3],
+        output_config,
+        "Main Title",
+        "{}_Title.{}".format(output_name, ext),
+        partial(make_title_video, stacks[-3], output_config),
+        stream_parts[0])
+    round_transitions = [
+        _add_screen_job(
+            graph,
+            stacks[num_rounds + r_i],
+            output_config,
+            "Round %i Intro" % (r_i + 1),
+            get_round_name(output_name,
+                           output_config.rounds[r_i].name + "_Title",
+                           ext),
+            partial(make_transition_video,
+                    stacks[num_rounds + r_i],
+                    output_config,
+                    r_i),
+            stream_parts[1 + 2 * r_i])
+        for r_i in range(num_rounds)
+    ]
+    credits = _add_screen_job(
+        graph,
+        stacks[-2],
+        output_config,
+        "Credits",
+        "%s_Credits.%s" % (output_name, ext),
+        partial(make_credits_video, stacks[-2], output_config),
+        stream_parts[-1])
+
+    # Gather together all the videos
+    parts = [None] * 2 * num_rounds
+    parts[0::2] = round_transitions
+    parts[1::2] = rounds
+    parts = [main_title] + parts + [credits]
+
+    if output_config.cache == "stream":
+        # Round lengths are known in advance, so the final video can start
+        # as soon as the title, transitions and credits are made
+        round_lengths = dict(zip(rounds, map(_get_round_length,
+                                             output_config.rounds)))
+        metadata = graph.add(
+            "Chapter metadata",
+            lambda: _write_metadata(output_config, [
+                round_lengths[part] if part in round_lengths
+                else part.result for part in parts]),
+            dependencies=[part for part in parts if part not in rounds],
+            resource="io")
+        graph.add(
+            "Final video",
+            lambda: mux_stream(stream,
+                               metadata.result,
+                               "%s.%s" % (output_name,
+                                          _get_output_ext(output_config))),
+            dependencies=[metadata])
+        return parts
+
+    metadata = graph.add(
+        "Chapter metadata",
+        lambda: _write_metadata(output_config,
+                                [part.result for part in parts]),
+        dependencies=parts,
+        resource="io")
+    if output_config.cache in ["all", "auto"]:
+        graph.add(
+            "Final video",
+            lambda: _write_all(stacks[-1],
+                               output_config,
+                               [spills.resolve(part.result)
+                                if spills is not None else part.result
+                                for part in parts],
+                               metadata.result),
+            dependencies=parts + [metadata],
+            resource="encode",
+            estimate=sum(job.estimate
+                         for job in graph.jobs[first_job:]))
+    else:
+        graph.add(
+            "Final video",
+            lambda: _concat(output_config,
+                            [part.result for part in parts],
+                            metadata.result),
+            dependencies=parts + [metadata],
+            resource="io")
+    return parts
+
+
+def _reload_rounds(output_config: OutputConfig):
+    """Mark the rounds (or their videos) saved by earlier runs"""
+    ext, _, _, _ = _get_profile(output_config)
+    for round_config in output_config.rounds:
+        name = get_round_name(output_config.name, round_config.name, ext)
+        video_name, _, signature_name = _get_round_artifact_names(
+            output_config, round_config)
+        if os.path.exists(name) and (not os.path.exists(video_name)
+                                     or _is_audio_current(signature_name,
+                                                          round_config)):
+            round_config._is_on_disk = True
+            print("\r\nReloaded round %s from disk" % name)
+        elif os.path.exists(video_name):
+            round_config._is_video_on_disk = True
+            print("\r\nReloaded round video %s from disk" % video_name)
+
+
+def get_resources(threads: int, memory: float) -> dict:
+    """Resource classes for job graphs, which may share them"""
+    # Each resource class limits how many of its jobs run at once:
+    # encoding by threads and memory, decoding by CPUs, and copying
+    # by disk. Rounds choose their versions a few at a time, in order,
+    # as each one keeps sources and previews open while it is planned.
+    return {
+        "encode": MemoryScheduler(threads, memory),
+        "decode": Slots(os.cpu_count() or 1),
+        "io": Slots(2),
+        "plan": Slots(PREVIEW_ROUNDS),
+    }
+
+
+class SharedCaches:
+    """
+    Low resolution proxies, mezzanines and previews, shared by all the
+    projects rendered at once, so each source is only transcoded once
+    """
+
+    def __init__(self, stack: ExitStack):
+        self._stack = stack
+        self._proxies = None
+        self._mezzanines = {}
+        self._previews = None
+
+    def get_proxies(self) -> TranscodeCache:
+        if self._proxies is None:
+            self._proxies = self._stack.enter_context(
+                TranscodeCache(get_proxy_args()))
+        return self._proxies
+
+    def get_mezzanines(self, output_config: OutputConfig) -> TranscodeCache:
+        """Mezzanines in the project's output size and frame rate"""
+        key = (output_config.xdim, output_config.ydim, output_config.fps)
+        if key not in self._mezzanines:
+            self._mezzanines[key] = self._stack.enter_context(TranscodeCache(
+                get_mezzanine_args(key[:2], output_config.fps),
+                os.path.join(CACHE_FOLDER, "mezzanines"),
+                ext="mkv",
+                by_content=True))
+        return self._mezzanines[key]
+
+    def get_previews(self) -> PreviewQueue:
+        if self._previews is None:
+            self._previews = self._stack.enter_context(PreviewQueue())
+        return self._previews
+
+
+class Project:
+    """A project's jobs in a job graph, and what is left to do after them"""
+
+    def __init__(self, output_config: OutputConfig, jobs: [Job],
+                 rounds: [Job], parts: [Job], spills: SpillCache,
+                 rendered: [int]):
+        """rendered: indices of the rounds that weren't saved before"""
+        self.output_config = output_config
+        self.jobs = jobs
+        self.rounds = rounds
+        self.parts = parts
+        self.spills = spills
+        self.rendered = rendered
+
+
+def _add_project_jobs(
+    graph: JobGraph,
+    stacks: StackList,
+    output_config: OutputConfig,
+    caches: SharedCaches,
+) -> Project:
+    round_configs = output_config.rounds
+    first_job = len(graph.jobs)
+    rendered = [r_i for r_i, round_config in enumerate(round_configs)
+                if not round_config._is_on_disk]
+    sources = [
+        source
+        for round_config in round_configs
+        if not (round_config._is_on_disk
+                or round_config._is_video_on_disk)
+        for source in round_config.sources
+    ]
+
+    # Start making low resolution sources for previews in the background
+    proxies = None
+    if output_config.versions > 1:
+        proxies = caches.get_proxies()
+        proxies.submit(sources)
+
+    # Transcode sources to mezzanines, shared by all projects
+    mezzanines = None
+    if output_config.mezzanine:
+        mezzanines = caches.get_mezzanines(output_config)
+        mezzanines.submit(sources)
+
+    # Show previews of all rounds one at a time, in order
+    previews = None
+    if output_config.versions > 1:
+        previews = caches.get_previews()
+
+    # Stream all videos, in order, straight into the final video
+    stream = None
+    if output_config.cache == "stream":
+        stream = stacks[-1].enter_context(
+            OrderedStream(2 * len(round_configs) + 2))
+
+    # Keep rounds in memory while it lasts, then save them to disk
+    spills = None
+    if output_config.cache == "auto":
+        spills = SpillCache(output_config.memory)
+
+    transcodes = {}
+    if mezzanines is not None:
+        for source in dict.fromkeys(sources):
+            transcodes[source] = graph.add(
+                "Mezzanine of " + source,
+                partial(_wait_mezzanine, mezzanines, source))
+    rounds = [
+        _add_round_jobs(graph, stacks[r_i], output_config, r_i,
+                        proxies, previews, stream, spills, mezzanines,
+                        [transcodes[source]
+                         for source in round_configs[r_i].sources
+                         if source in transcodes])
+        for r_i in range(len(round_configs))
+    ]
+    parts = []
+    if output_config.assemble:
+        parts = _add_assembly_jobs(graph, stacks, output_config, rounds,
+                                   stream, spills, first_job)
+    return Project(output_config, graph.jobs[first_job:], rounds, parts,
+                   spills, rendered)
+
+
+def _finish_project(project: Project):
+    output_config = project.output_config
+    output_name = output_config.name
+    parts = project.parts
+    if not output_config.assemble:
+        print("\r\nAll Rounds prepared")
+    elif output_config.cache in ["all", "auto"]:
+        temp_video_name = "%s_TEMP.%s" % (output_name,
+                                          _get_output_ext(output_config))
+        intermediate_filenames = [temp_video_name,
+                                  output_name + ".ffmd"]
+        if project.spills is not None:
+            intermediate_filenames += project.spills.get_filenames()
+    elif output_config.cache == "stream":
+        intermediate_filenames = [output_name + ".ffmd"]
+    else:
+        intermediate_filenames = [part.result for part in parts]
+        intermediate_filenames.append(output_name + ".ffmd")
+        intermediate_filenames.append("%s_inputs.txt" % output_name)
+        for round_config in output_config.rounds:
+            intermediate_filenames += _get_round_artifact_names(
+                output_config, round_config)
+
+    # Checkpoints are only kept to resume rounds that weren't finished
+    for round_config in output_config.rounds:
+        _remove_checkpoints(output_config, round_config)
 
     # Delete intermediate files
-    if output_config.delete or output_config.cache == "all":
+    if output_config.assemble and (output_config.delete
+                                   or output_config.cache != "round"):
         # TODO: no intermediate files with cache == "all"
         print("\r\nDeleting Files")
         for intermediate_filename in intermediate_filenames:
             if os.path.exists(intermediate_filename):
                 os.remove(intermediate_filename)
 
+
+def _prioritize(project: Project, order: int):
+    # Higher priority projects first, then earlier ones
+    for job in project.jobs:
+        job.priority = (-project.output_config.priority, order, job.priority)
+
+
+def make_project(
+    graph: JobGraph,
+    output_config: OutputConfig,
+    caches: SharedCaches,
+    order: int = 0,
+) -> [Job]:
+    """
+    Render a project with its own job graph, returning the steps that
+    failed. Graphs sharing resources admit the jobs of higher priority
+    projects first, then those of projects with a lower `order`.
+    """
+    _reload_rounds(output_config)
+
+    # One stack per round and per transition, then title, credits and shared
+    with StackList(2 * len(output_config.rounds) + 3) as stacks:
+        project = _add_project_jobs(graph, stacks, output_config, caches)
+        _prioritize(project, order)
+        failed = graph.run()
+
+    # Check that all videos were output correctly
+    for job in failed:
+        print("\r\nERROR: %s was not prepared" % job.name)
+    if failed == []:
+        _finish_project(project)
+    return failed
+
+
+def make(output_config: OutputConfig):
+    output_name = output_config.name
+
+    if output_config.rounds == []:
+        print("\r\nERROR: No round configs provided")
+        sys.exit(1)
+
+    with ExitStack() as shared_stack:
+        graph = JobGraph(get_resources(output_config.threads,
+                                       output_config.memory))
+        failed = make_project(graph, output_config,
+                              SharedCaches(shared_stack))
+    if failed != []:
+        sys.exit(1)
     print("\r\n%s Ready! CH Assembly Program exiting." % output_name)
+
+
+def _report_throughput(projects: [Project], failed: [Job]):
+    """Print how much video each project made, and how fast"""
+    print("\r\nBatch summary:")
+    total_length = 0
+    for project in projects:
+        round_configs = project.output_config.rounds
+        made = [r_i for r_i in project.rendered
+                if project.rounds[r_i] not in failed]
+        length = sum(_get_round_length(round_configs[r_i]) for r_i in made)
+        total_length += length
+        ran = [job for job in project.jobs if job.started is not None]
+        elapsed = (max(job.finished for job in ran)
+                   - min(job.started for job in ran)) if ran != [] else 0
+        errors = len([job for job in project.jobs if job in failed])
+        print("  %s: %i of %i rounds made, %.1fs of video in %.1fs"
+              " (%.2fx realtime)%s" % (
+                  project.output_config.name, len(made),
+                  len(project.rendered), length, elapsed,
+                  length / elapsed if elapsed > 0 else 0,
+                  ", %i steps FAILED" % errors if errors > 0 else ""))
+    ran = [job for project in projects for job in project.jobs
+           if job.started is not None]
+    if ran != []:
+        elapsed = (max(job.finished for job in ran)
+                   - min(job.started for job in ran))
+        print("  Total: %.1fs of video in %.1fs (%.2fx realtime)" % (
+            total_length, elapsed,
+            total_length / elapsed if elapsed > 0 else 0))
+
+
+def make_batch(output_configs: [OutputConfig], threads: int, memory: float):
+    """
+    Render several projects at once, as one job graph: their rounds share
+    one pool of workers and memory budget, and their sources share proxies
+    and mezzanines. Jobs of projects with a higher priority are admitted
+    first, then those of earlier projects.
+    """
+    names = [output_config.name for output_config in output_configs]
+    for name in dict.fromkeys(names):
+        if names.count(name) > 1:
+            print("\r\nERROR: More than one project is named %s" % name)
+            sys.exit(1)
+    for output_config in output_configs:
+        if output_config.rounds == []:
+            print("\r\nSkipping %s: no round configs provided"
+                  % output_config.name)
+    output_configs = [output_config for output_config in output_configs
+                      if output_config.rounds != []]
+    for output_config in output_configs:
+        _reload_rounds(output_config)
+
+    # Shared caches are closed last, after every project's stacks
+    with ExitStack() as shared_stack, ExitStack() as project_stacks:
+        caches = SharedCaches(shared_stack)
+        graph = JobGraph(get_resources(threads, memory))
+        projects = []
+        for p_i, output_config in enumerate(output_configs):
+            stacks = project_stacks.enter_context(
+                StackList(2 * len(output_config.rounds) + 3))
+            project = _add_project_jobs(graph, stacks, output_config, caches)
+            for job in project.jobs:
+                job.name = "%s: %s" % (output_config.name, job.name)
+            _prioritize(project, p_i)
+            projects.append(project)
+        failed = graph.run()
+
+    for project in projects:
+        project_failed = [job for job in project.jobs if job in failed]
+        for job in project_failed:
+            print("\r\nERROR: %s was not prepared" % job.name)
+        if project_failed == []:
+            _finish_project(project)
+            print("\r\n%s Ready!" % project.output_config.name)
+    _report_throughput(projects, failed)
+    if failed != []:
+        sys.exit(1)
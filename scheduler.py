@@ -0,0 +1,262 @@
+import os
+import heapq
+from itertools import count
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+from parsing import OutputConfig, RoundConfig
+from probe import get_video_info
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+GB = 1024 ** 3
+BASE_MEMORY = 256 * 1024 ** 2  # interpreter, moviepy and ffmpeg processes
+READER_FRAMES = 8  # decoded frames held by each open source (and its ffmpeg)
+OUTPUT_FRAMES = 16  # compositing, resizing, fading and encoding buffers
+CUT_MEMORY = 256 * 1024  # clip objects of each cut
+AUDIO_MEMORY = 44100 * 2 * 8  # one second of stereo float64 audio
+FREE_MEMORY_SHARE = 0.8  # leave some free memory for everything else
+RECHECK_INTERVAL = 1.0  # seconds between checks of free memory
+
+
+def get_available_memory() -> int:
+    """Free system memory in bytes, or None if it is unknown"""
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open("/proc/meminfo") as meminfo_filehandle:
+            for line in meminfo_filehandle:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _get_rss(pid: str) -> int:
+    with open("/proc/%s/status" % pid) as status_filehandle:
+        for line in status_filehandle:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def get_process_memory() -> int:
+    """
+    Resident memory in bytes of this process and its child (ffmpeg)
+    processes, or None if it is unknown
+    """
+    if psutil is not None:
+        process = psutil.Process()
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass  # finished since it was listed
+        return total
+    if not os.path.isdir("/proc/self"):
+        return None
+    pid = str(os.getpid())
+    total = _get_rss(pid)
+    for child in os.listdir("/proc"):
+        try:
+            with open("/proc/%s/stat" % child) as stat_filehandle:
+                # The parent pid follows the (parenthesised) command name
+                if stat_filehandle.read().rpartition(")")[2].split()[1] == pid:
+                    total += _get_rss(child)
+        except (OSError, IndexError):
+            pass  # not a process, or finished since it was listed
+    return total
+
+
+def estimate_round_memory(
+    output_config: OutputConfig,
+    round_config: RoundConfig
+) -> int:
+    """Rough peak memory in bytes needed to render a round"""
+    output_frame = output_config.xdim * output_config.ydim * 3
+    source_frames = 0
+    for source in round_config.sources:
+        info = None if output_config.mezzanine else get_video_info(source)
+        if info is None:  # assume sources (or mezzanines) as big as output
+            source_frames += output_frame
+        else:
+            source_frames += info["width"] * info["height"] * 3
+    cut_length = 4 * 60 / round_config.bpm * 2 ** (3 - round_config.speed)
+    cuts = round_config.duration / cut_length
+    return int(BASE_MEMORY
+               + READER_FRAMES * source_frames
+               + OUTPUT_FRAMES * output_frame
+               + CUT_MEMORY * cuts
+               + AUDIO_MEMORY * round_config.duration
+               * (len(round_config.sources) + 2))
+
+
+def estimate_screen_memory(output_config: OutputConfig) -> int:
+    """Rough peak memory in bytes needed to render a title or credits"""
+    output_frame = output_config.xdim * output_config.ydim * 3
+    return int(BASE_MEMORY + OUTPUT_FRAMES * output_frame)
+
+
+def estimate_audio_memory(round_config: RoundConfig) -> int:
+    """Rough peak memory in bytes needed to remix the audio of a round"""
+    return int(BASE_MEMORY + AUDIO_MEMORY * round_config.duration * 3)
+
+
+class MemoryScheduler:
+    """
+    Admits rounds for rendering, by priority then in order, while their
+    estimated peak memory fits in the budget: the configured limit and a
+    share of free system memory, whichever is smaller. At most
+    `max_threads` rounds are admitted at once, and a round is always
+    admitted when no other round is running, so every round eventually
+    runs, even one bigger than the budget.
+    """
+
+    def __init__(self, max_threads: int, limit: float = 0):
+        """limit: memory budget in GB, or 0 for free system memory only"""
+        self.max_threads = max_threads
+        self.limit = int(limit * GB) if limit > 0 else None
+        self._condition = Condition()
+        self._waiting = []
+        self._arrivals = count()
+        self._running = 0
+        self._in_use = 0
+
+    def _get_budget(self) -> int:
+        budget = self.limit
+        available = get_available_memory()
+        if available is not None:
+            # Admitted rounds may not have allocated their memory yet
+            available = self._in_use + int(available * FREE_MEMORY_SHARE)
+            budget = available if budget is None else min(budget, available)
+        return budget
+
+    def _can_admit(self, estimate: int, budget: int) -> bool:
+        if self._running == 0:
+            return True
+        return (self._running < self.max_threads
+                and (budget is None or self._in_use + estimate <= budget))
+
+    @contextmanager
+    def admit(self, name: str, estimate: int, priority: int = 0):
+        """Wait until the job fits, then hold its memory until it is done"""
+        ticket = (priority, next(self._arrivals))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            reported = False
+            while True:
+                budget = self._get_budget()
+                if (self._waiting[0] is ticket
+                        and self._can_admit(estimate, budget)):
+                    break
+                if not reported and self._waiting[0] is ticket:
+                    print("\r\n%s waiting to start: %s" % (
+                        name, self._describe(estimate, budget)))
+                    reported = True
+                self._condition.wait(RECHECK_INTERVAL)
+            heapq.heappop(self._waiting)
+            print("\r\n%s admitted: %s" % (
+                name, self._describe(estimate, budget)))
+            self._running += 1
+            self._in_use += estimate
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._in_use -= estimate
+                self._condition.notify_all()
+
+    def _describe(self, estimate: int, budget: int) -> str:
+        description = "needs ~%.1fGB, %.1fGB in use by %i running" % (
+            estimate / GB, self._in_use / GB, self._running)
+        if budget is not None:
+            description += ", budget %.1fGB" % (budget / GB)
+            if estimate > budget and self._running == 0:
+                description += " (exceeded, running alone)"
+        return description
+
+
+class _Spillable:
+    def __init__(self, video, size: int, spill):
+        self.video = video
+        self.size = size
+        self.spill = spill
+        self.filename = None
+        self.spilling = False
+
+
+class SpillCache:
+    """
+    Keeps finished videos in memory while this process and its ffmpeg
+    processes use less memory than the budget. Past it, the biggest videos
+    are written to disk, to be reloaded from there when they are needed.
+    """
+
+    def __init__(self, limit: float = 0):
+        """limit: memory budget in GB, or 0 for a share of system memory"""
+        self.limit = int(limit * GB) if limit > 0 else None
+        self._entries = []
+        self._lock = Lock()
+
+    def _get_budget(self, in_use: int) -> int:
+        budget = self.limit
+        available = get_available_memory()
+        if available is not None:
+            available = int((in_use + available) * FREE_MEMORY_SHARE)
+            budget = available if budget is None else min(budget, available)
+        return budget
+
+    def add(self, video, size: int, spill):
+        """
+        size: estimated memory in bytes of the video, to spill the biggest
+        first (memory in use is measured for the whole process)
+        spill: writes the video to disk, returning its file name or None
+        """
+        with self._lock:
+            self._entries.append(_Spillable(video, size, spill))
+        self.enforce()
+
+    def enforce(self):
+        """Spill videos to disk until memory use is within budget"""
+        while True:
+            with self._lock:
+                in_memory = [entry for entry in self._entries
+                             if entry.filename is None and not entry.spilling]
+                in_use = get_process_memory()
+                if in_use is None:
+                    in_use = sum(entry.size for entry in in_memory)
+                budget = self._get_budget(in_use)
+                if in_memory == [] or budget is None or in_use <= budget:
+                    return
+                entry = max(in_memory, key=lambda entry: entry.size)
+                entry.spilling = True
+            print("\r\nUsing %.1fGB of %.1fGB memory budget, saving a"
+                  " %.1fGB video to disk" % (
+                      in_use / GB, budget / GB, entry.size / GB))
+            filename = entry.spill()
+            with self._lock:
+                entry.filename = filename
+                if filename is None:
+                    # Keep the video in memory, without retrying the spill
+                    self._entries.remove(entry)
+                    return
+
+    def resolve(self, video):
+        """The file a video was spilled to, or the video if in memory"""
+        with self._lock:
+            for entry in self._entries:
+                if entry.video is video and entry.filename is not None:
+                    return entry.filename
+        return video
+
+    def get_filenames(self) -> [str]:
+        with self._lock:
+            return [entry.filename for entry in self._entries
+                    if entry.filename is not None]
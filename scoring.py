@@ -0,0 +1,127 @@
+import numpy as np
+
+from constants import SCORE_MARGIN, SCORE_SAMPLES
+
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+SAMPLE_SIZE = (36, 64)  # rows, columns of downscaled frames
+SIGNATURE_BLOCKS = (6, 8)  # rows, columns of frame signatures
+BLACK_LEVEL = 16 / 255
+SCENE_CUT_LEVEL = 0.25  # mean luma change between samples of one shot
+REPETITION_HISTORY = 32  # number of earlier picks to compare against
+OVERLAP_HISTORY = 4096  # number of earlier picks not to overlap
+
+
+class Measurements:
+    """Cheap per-version metrics, computed together for all versions"""
+
+    def __init__(self, luma: np.ndarray):
+        """
+        luma: (versions, samples, rows, columns) array in [0, 1]
+        """
+        self.brightness = luma.mean(axis=(1, 2, 3))
+        self.black = (luma.mean(axis=(2, 3)) < BLACK_LEVEL).mean(axis=1)
+
+        # Variance of the Laplacian is high for sharp frames
+        laplacian = (luma[..., :-2, 1:-1] + luma[..., 2:, 1:-1]
+                     + luma[..., 1:-1, :-2] + luma[..., 1:-1, 2:]
+                     - 4 * luma[..., 1:-1, 1:-1])
+        self.sharpness = laplacian.var(axis=(2, 3)).mean(axis=1)
+
+        if luma.shape[1] > 1:
+            changes = np.abs(np.diff(luma, axis=1)).mean(axis=(2, 3))
+        else:
+            changes = np.zeros((luma.shape[0], 1), dtype=luma.dtype)
+        self.motion = np.median(changes, axis=1)
+        self.scene_cuts = (changes > SCENE_CUT_LEVEL).any(axis=1)
+
+        # Zero mean, unit length block averages, compared by dot product
+        rows, columns = SIGNATURE_BLOCKS
+        blocks = luma.mean(axis=1).reshape(
+            luma.shape[0], rows, luma.shape[2] // rows,
+            columns, luma.shape[3] // columns).mean(axis=(2, 4))
+        blocks = blocks.reshape(luma.shape[0], -1)
+        blocks -= blocks.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(blocks, axis=1, keepdims=True)
+        self.signatures = blocks / np.maximum(norms, 1e-6)
+
+
+def measure(clips: list, samples: int = SCORE_SAMPLES) -> Measurements:
+    """Sample a few downscaled frames of each clip and measure them"""
+    frames = np.empty((len(clips), samples) + SAMPLE_SIZE + (3,),
+                      dtype=np.uint8)
+    for c_i, clip in enumerate(clips):
+        for s_i in range(samples):
+            frame = clip.get_frame(clip.duration * (s_i + 0.5) / samples)
+            # Nearest neighbour downscale, to the same size for every clip
+            rows = np.linspace(0, frame.shape[0] - 1, SAMPLE_SIZE[0])
+            columns = np.linspace(0, frame.shape[1] - 1, SAMPLE_SIZE[1])
+            frames[c_i, s_i] = frame[np.ix_(rows.astype(int),
+                                            columns.astype(int))][..., :3]
+    return Measurements(frames.astype(np.float32) @ LUMA_WEIGHTS / 255)
+
+
+def _normalize(values: np.ndarray) -> np.ndarray:
+    spread = values.max() - values.min()
+    if spread <= 0:
+        return np.zeros_like(values, dtype=np.float32)
+    return (values - values.min()) / spread
+
+
+class Scorer:
+    """
+    Scores the versions of each cut, remembering earlier picks so that
+    versions repeating them score lower.
+    """
+
+    def __init__(self, margin: float = SCORE_MARGIN):
+        self.margin = margin
+        self._signatures = np.zeros((0, np.prod(SIGNATURE_BLOCKS)),
+                                    dtype=np.float32)
+        self._positions = np.zeros((0, 3))  # source index, start, end
+
+    def score(
+        self,
+        measurements: Measurements,
+        positions: [(int, float, float)]
+    ) -> np.ndarray:
+        """positions: (source index, start, end) of each version"""
+        similarity = (measurements.signatures @ self._signatures.T).max(
+            axis=1, initial=0)
+        repetition = np.clip((similarity - 0.5) / 0.5, 0, 1)
+        # Versions by earlier picks, overlapping them in the same source
+        positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+        picked = self._positions[np.newaxis]
+        positions = positions[:, np.newaxis]
+        overlaps = ((positions[..., 0] == picked[..., 0])
+                    & (positions[..., 1] < picked[..., 2])
+                    & (picked[..., 1] < positions[..., 2])).any(axis=1)
+        repetition = np.maximum(repetition, overlaps)
+
+        return (0.35 * _normalize(measurements.motion)
+                + 0.25 * _normalize(measurements.sharpness)
+                - 0.5 * np.abs(measurements.brightness - 0.45)
+                - 1.0 * measurements.black
+                - 0.5 * measurements.scene_cuts
+                - 0.5 * repetition)
+
+    def is_close(self, scores: np.ndarray) -> bool:
+        """Whether the best two versions are too close to call"""
+        if len(scores) < 2:
+            return False
+        best, second = np.sort(scores)[-1:-3:-1]
+        return best - second < self.margin
+
+    def remember(
+        self,
+        measurements: Measurements,
+        positions: [(int, float, float)],
+        chosen: int
+    ):
+        self._signatures = np.concatenate([
+            self._signatures[-(REPETITION_HISTORY - 1):],
+            measurements.signatures[chosen:chosen + 1]
+        ])
+        self._positions = np.concatenate([
+            self._positions[-(OVERLAP_HISTORY - 1):],
+            [positions[chosen]]
+        ])
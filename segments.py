@@ -0,0 +1,343 @@
+import os
+import subprocess
+import wave
+from contextlib import ExitStack
+from itertools import groupby
+from math import ceil
+from threading import Lock
+
+import numpy as np
+from moviepy.audio.io.AudioFileClip import AudioFileClip
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from moviepy.video.fx.resize import resize
+from moviepy.video.VideoClip import VideoClip
+
+from compilation import Compilation, SourceFile
+from constants import AUDIO_FPS, FFMPEG_PRESET
+from cpu import allocate
+from timeline import concatenate_lazily
+
+FRAME_TOLERANCE = 1e-6  # frames of float error at cut boundaries
+
+
+class SourceReaders:
+    """
+    Makes the clips of a compilation's cuts as they are rendered. Each
+    source is opened for its first cut, and closed once rendering passes
+    its last cut, so that long rounds don't keep every decoder open to
+    the end. Sources needed again, as when audio is written before video,
+    are opened again.
+    """
+
+    def __init__(self, compilation: Compilation, dims: (int, int)):
+        self.compilation = compilation
+        self.dims = dims
+        self.peak = 0
+        sources = compilation.cuts["source"]
+        self._last_uses = {
+            int(s_i): int(np.flatnonzero(sources == s_i)[-1])
+            for s_i in np.unique(sources)
+        }
+        self._clips = {}
+        self._lock = Lock()
+
+    def get_clip(self, c_i: int) -> VideoClip:
+        with self._lock:
+            self._close_passed(c_i)
+            clip = self._clips.get(c_i)
+            if clip is None:
+                cut = self.compilation.cuts[c_i]
+                source = self.compilation.sources[cut["source"]]
+                clip = resize(source.clip.subclip(cut["start"], cut["stop"]),
+                              self.dims)
+                self._clips[c_i] = clip
+                self.peak = max(self.peak, sum(
+                    source.is_open for source in self.compilation.sources))
+            return clip
+
+    def _close_passed(self, c_i: int):
+        for passed in [p for p in self._clips if p < c_i]:
+            del self._clips[passed]
+        for s_i, last_use in self._last_uses.items():
+            if last_use < c_i:
+                self.compilation.sources[s_i].close()
+
+    def close(self):
+        with self._lock:
+            self._clips = {}
+            for source in self.compilation.sources:
+                source.close()
+
+
+def cut_round(readers: SourceReaders) -> VideoClip:
+    """The cuts, one after another, decoded in timeline order"""
+    cuts = readers.compilation.cuts
+    return concatenate_lazily((cuts["stop"] - cuts["start"]).tolist(),
+                              readers.get_clip)
+
+
+def get_partial_name(filename: str, attempt: str = "") -> str:
+    """
+    Where a file is written, until it is complete
+    attempt: tells apart the files of attempts writing the same file
+    """
+    folder, basename = os.path.split(filename)
+    if attempt != "":
+        basename = attempt + "_" + basename
+    return os.path.join(folder, "partial_" + basename)
+
+
+def _get_frames(cut: np.void, fps: float) -> (int, int):
+    # The round's frames, from the first to just after the last, in the cut
+    stop = cut["position"] + cut["stop"] - cut["start"]
+    return (ceil(cut["position"] * fps - FRAME_TOLERANCE),
+            ceil(stop * fps - FRAME_TOLERANCE))
+
+
+def _count_samples(first: int, last: int, fps: float) -> int:
+    # Sample counts follow the round's frames, so joined audio can't drift
+    return round(last * AUDIO_FPS / fps) - round(first * AUDIO_FPS / fps)
+
+
+def get_audio_name(filename: str) -> str:
+    """Where the audio of a segment is saved, beside its video"""
+    return os.path.splitext(filename)[0] + ".wav"
+
+
+def keep_segments(filenames: [str], attempt: str = "") -> [str]:
+    """
+    Move the segments an attempt saved to their filenames, returning the
+    filenames it didn't save
+    """
+    missing = []
+    for filename in filenames:
+        # The video goes last, as it marks the segment saved
+        names = [get_audio_name(filename), filename]
+        partial_names = [get_partial_name(name, attempt) for name in names]
+        if not all(os.path.exists(name) for name in partial_names):
+            missing.append(filename)
+            continue
+        for partial_name, name in zip(partial_names, names):
+            os.replace(partial_name, name)
+    return missing
+
+
+def discard_segments(filenames: [str], attempt: str):
+    """Delete what a finished attempt saved of the segments"""
+    for filename in filenames:
+        for name in [get_audio_name(filename), filename]:
+            partial_name = get_partial_name(name, attempt)
+            if os.path.exists(partial_name):
+                os.remove(partial_name)
+
+
+def _write_audio(
+    source: SourceFile,
+    start: float,
+    samples: int,
+    filename: str,
+):
+    audio = source.clip.audio
+    with wave.open(filename, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(AUDIO_FPS)
+        for offset in range(0, samples, AUDIO_FPS):
+            count = min(AUDIO_FPS, samples - offset)
+            if audio is None:
+                chunk = np.zeros((count, 2))
+            else:
+                tt = start + np.arange(offset, offset + count) / AUDIO_FPS
+                chunk = np.asarray(audio.get_frame(tt)).reshape(count, -1)
+                chunk = chunk[:, [0, -1]]  # mono to stereo
+            wav.writeframes((32767 * np.clip(chunk, -1, 1)).astype(
+                "<i2").tobytes())
+
+
+def write_segments(
+    source: SourceFile,
+    cuts: np.ndarray,
+    filenames: [str],
+    dims: (int, int),
+    fps: float,
+    profile: (str, str, [str], str),
+    threads: int,
+    attempt: str = "",
+):
+    """
+    Save the frames of the round in each cut, in the order given, with
+    their audio. One encoder writes all the cuts, splitting its output at
+    their first frames, so `profile` must be intra-frame. Each segment only
+    appears at its filename once it is complete, so it can be kept.
+
+    attempt: leave the segments at this attempt's partial names, for
+    keep_segments, so that attempts at the same cuts can't mix
+    """
+    frames = [_get_frames(cut, fps) for cut in cuts]
+    splits = np.cumsum([last - first for first, last in frames])
+    prefix = os.path.splitext(get_partial_name(filenames[0], attempt))[0]
+    pattern = prefix.replace("%", "%%") + "_%05d." + profile[0]
+    partial_filenames = [pattern % i for i in range(len(cuts))]
+    _, codec, ffmpeg_params, _ = profile
+    codec_params = ["-c:v", codec]
+    if codec == "libx264":
+        codec_params += ["-preset", FFMPEG_PRESET]
+        if dims[0] % 2 == 0 and dims[1] % 2 == 0:
+            codec_params += ["-pix_fmt", "yuv420p"]
+    command = [
+        "ffmpeg", "-v", "quiet", "-y",
+        "-f", "rawvideo", "-pix_fmt", "rgb24",
+        "-s", "%ix%i" % tuple(dims),
+        "-r", str(fps), "-i", "-",
+    ] + codec_params + ffmpeg_params + [
+        "-threads", str(threads),
+        # A split after the last frame is never reached, so there's always
+        # one, and the segment muxer doesn't fall back to splitting by time
+        "-f", "segment", "-segment_frames", ",".join(map(str, splits)),
+        "-reset_timestamps", "1", pattern,
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    failed = True
+    try:
+        for cut, filename, (first, last) in zip(cuts, filenames, frames):
+            # Start on a frame of the round, so joined segments don't drift
+            start = cut["start"] + first / fps - cut["position"]
+            _write_audio(source, start, _count_samples(first, last, fps),
+                         get_partial_name(get_audio_name(filename), attempt))
+            clip = resize(source.clip.subclip(start,
+                                              start + (last - first) / fps),
+                          dims)
+            for f_i in range(last - first):
+                frame = clip.get_frame(f_i / fps)
+                process.stdin.write(
+                    np.asarray(frame[:, :, :3], dtype="uint8").tobytes())
+        failed = False
+    except BrokenPipeError:
+        pass  # ffmpeg has exited, and says why below
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            failed = True
+        if failed:
+            process.kill()
+        process.wait()
+        written = [name for name in partial_filenames if os.path.exists(name)]
+        if failed or process.returncode != 0:
+            # The last segment written may have been cut short
+            for name in written[-1:]:
+                os.remove(name)
+            written = written[:-1]
+        for partial_filename, filename in zip(written, filenames):
+            os.replace(partial_filename, get_partial_name(filename, attempt))
+        if attempt == "":
+            keep_segments(filenames[:len(written)])
+    if process.returncode != 0:
+        raise RuntimeError("ffmpeg exited with %i" % process.returncode)
+
+
+def join_segments(
+    filenames: [str],
+    filename: str,
+    audio_filename: str = None,
+):
+    """
+    Copy videos of the same format, one after another, into one.
+    audio_filename: audio to copy in place of theirs
+    """
+    list_filename = os.path.splitext(filename)[0] + ".txt"
+    with open(list_filename, "w") as list_filehandle:
+        for segment_filename in filenames:
+            list_filehandle.write("file '%s'\n" % os.path.abspath(
+                segment_filename).replace("'", "'\\''"))
+    command = ["ffmpeg", "-v", "quiet", "-y",
+               "-f", "concat", "-safe", "0", "-i", list_filename]
+    if audio_filename is not None:
+        command += ["-i", audio_filename, "-map", "0:v:0", "-map", "1:a:0"]
+    partial_filename = get_partial_name(filename)
+    command += ["-c", "copy", partial_filename]
+    try:
+        subprocess.run(command, check=True)
+    finally:
+        os.remove(list_filename)
+    os.replace(partial_filename, filename)
+
+
+def _write_list(filename: str, filenames: [str], durations: [float]):
+    # ffmpeg reads the files one after another, as if they were one, and
+    # knows its duration from theirs
+    with open(filename, "w") as list_filehandle:
+        list_filehandle.write("ffconcat version 1.0\n")
+        for segment_filename, duration in zip(filenames, durations):
+            list_filehandle.write("file %s\nduration %r\n" % (
+                os.path.basename(segment_filename), duration))
+
+
+def extract_segments(
+    stack: ExitStack,
+    compilation: Compilation,
+    dims: (int, int),
+    fps: float,
+    profile: (str, str, [str], str),
+    folder: str,
+    slots: int = 1,
+    workers=None,
+) -> VideoClip:
+    """
+    Decode each source in one forward sweep, saving its cuts as segments
+    (in an intra-frame `profile`), then read the segments in timeline order.
+    Sources are never read backwards, so their readers only restart to
+    skip far ahead, instead of decoding again from earlier keyframes.
+
+    Segments are read where they are saved, not copied into one file, so
+    they must be kept in `folder` until the round is rendered. Segments
+    saved there by an earlier run of the same compilation are kept, so an
+    interrupted round resumes.
+
+    workers: a WorkerPool, to save the segments in slices of each sweep,
+    in the shared `folder`. Segments it can't save are saved here instead.
+    """
+    ext = profile[0]
+    cuts = compilation.cuts
+    filenames = [os.path.join(folder, "segment%05i.%s" % (c_i, ext))
+                 for c_i in range(len(cuts))]
+    # Cuts shorter than a frame don't show in the round
+    used = [c_i for c_i, cut in enumerate(cuts)
+            if len(range(*_get_frames(cut, fps))) > 0]
+    saved = [c_i for c_i in used if os.path.exists(filenames[c_i])]
+    if saved != []:
+        print("\r\nReusing %i of %i segments saved in %s" % (
+            len(saved), len(used), folder))
+    sweep_order = np.lexsort((cuts["start"], cuts["source"]))
+    is_used = set(used) - set(saved)
+    sweeps = [(s_i, list(sweep)) for s_i, sweep in groupby(
+        [c_i for c_i in sweep_order if c_i in is_used],
+        key=lambda c_i: cuts[c_i]["source"])]
+    if workers is not None and sweeps != []:
+        left = set(workers.write_segments(compilation, sweeps, filenames,
+                                          dims, fps, profile))
+        sweeps = [(s_i, [c_i for c_i in sweep if c_i in left])
+                  for s_i, sweep in sweeps]
+        sweeps = [(s_i, sweep) for s_i, sweep in sweeps if sweep != []]
+    for s_i, sweep in sweeps:
+        source = compilation.sources[s_i]
+        with allocate(source.filename, slots) as allocation:
+            print("\r\nDecoding %i cuts from %s..." % (len(sweep),
+                                                       source.filename))
+            write_segments(source, cuts[sweep],
+                           [filenames[c_i] for c_i in sweep], dims, fps,
+                           profile, allocation.threads)
+        source.close()  # its cuts are all saved
+
+    # Read one after another, by one reader for the video and one for audio
+    frames = [_get_frames(cuts[c_i], fps) for c_i in used]
+    video_filename = os.path.join(folder, "cuts.ffconcat")
+    _write_list(video_filename, [filenames[c_i] for c_i in used],
+                [(last - first) / fps for first, last in frames])
+    audio_filename = os.path.join(folder, "audio.ffconcat")
+    _write_list(audio_filename,
+                [get_audio_name(filenames[c_i]) for c_i in used],
+                [_count_samples(first, last, fps) / AUDIO_FPS
+                 for first, last in frames])
+    video = stack.enter_context(VideoFileClip(video_filename, audio=False))
+    return video.set_audio(stack.enter_context(AudioFileClip(audio_filename)))
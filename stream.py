@@ -0,0 +1,335 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import AbstractContextManager
+from threading import Condition, Thread
+
+from moviepy.video.VideoClip import VideoClip
+
+from constants import AUDIO_FPS, FFMPEG_PRESET, STREAM_SPILL_SIZE
+from cpu import pin
+
+CHUNK_SIZE = 1024 * 1024
+LOG_SIZE = 4096  # last bytes of the muxer's log, kept to say why it failed
+
+
+class StreamPart:
+    """Writable end of one part of an OrderedStream"""
+
+    def __init__(self, stream: "OrderedStream", index: int):
+        self._stream = stream
+        self.index = index
+
+    def write(self, data: bytes):
+        self._stream._write(self.index, data)
+
+    def close(self):
+        self._stream._finish(self.index)
+
+    def fail(self, error: Exception):
+        self._stream._fail(self.index, error)
+
+
+class OrderedStream(AbstractContextManager):
+    """
+    Parts written concurrently, in any order, are written to one output in
+    order. The earliest unfinished part is written straight through; later
+    parts are kept in memory, and spill to disk past `spill_size` bytes.
+    Once a part or the output fails, writing any part raises.
+    """
+
+    def __init__(self, num_parts: int, spill_size: int = STREAM_SPILL_SIZE):
+        self.spill_size = spill_size
+        self._condition = Condition()
+        self._output = None
+        self._head = 0
+        self._buffers = [None] * num_parts
+        self._sizes = [0] * num_parts
+        self._finished = [False] * num_parts
+        self._is_flushing = False
+        self._error = None
+
+    def __exit__(self, *args, **kwargs):
+        with self._condition:
+            for buffer in self._buffers:
+                if buffer is not None:
+                    buffer.close()
+            self._buffers = [None] * len(self._buffers)
+
+    def part(self, index: int) -> StreamPart:
+        return StreamPart(self, index)
+
+    def start(self, output):
+        """Write all parts to `output`, then return when they are done"""
+        with self._condition:
+            self._output = output
+        self._advance()
+        with self._condition:
+            while self._head < len(self._buffers) and self._error is None:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+
+    def _write(self, index: int, data: bytes):
+        with self._condition:
+            if self._error is not None:
+                raise RuntimeError("Stream failed: %s" % self._error)
+            # Until earlier parts are flushed, the head part is buffered
+            is_direct = (index == self._head
+                         and self._output is not None
+                         and not self._is_flushing
+                         and self._buffers[index] is None)
+            if not is_direct:
+                self._buffer(index, data)
+                return
+        # Only the head part is written straight through, outside of the
+        # lock, so parts that are buffering never wait for the output
+        self._copy(lambda: self._output.write(data))
+
+    def _buffer(self, index: int, data: bytes):
+        if self._buffers[index] is None:
+            self._buffers[index] = tempfile.SpooledTemporaryFile(
+                max_size=self.spill_size)
+        self._buffers[index].write(data)
+        if self._sizes[index] <= self.spill_size < (
+                self._sizes[index] + len(data)):
+            print("\r\nPart %i is far ahead, buffering it on disk"
+                  % (index + 1))
+        self._sizes[index] += len(data)
+
+    def _copy(self, write):
+        try:
+            write()
+        except (OSError, ValueError) as e:  # as when the output has closed
+            with self._condition:
+                if self._error is None:
+                    self._error = RuntimeError("output failed: %s" % e)
+                self._condition.notify_all()
+            raise
+
+    def _finish(self, index: int):
+        with self._condition:
+            self._finished[index] = True
+        self._advance()
+
+    def _fail(self, index: int, error: Exception):
+        with self._condition:
+            self._error = error
+            self._condition.notify_all()
+
+    def _advance(self):
+        # Flush buffered parts in order, up to the first unfinished one.
+        # One thread flushes at a time, outside of the lock, while what the
+        # head part writes meanwhile is buffered, and flushed after.
+        with self._condition:
+            if self._output is None or self._is_flushing:
+                return
+            self._is_flushing = True
+        while True:
+            with self._condition:
+                buffer = None
+                while (self._error is None
+                       and self._head < len(self._buffers)):
+                    buffer = self._buffers[self._head]
+                    self._buffers[self._head] = None
+                    if buffer is not None or not self._finished[self._head]:
+                        break
+                    self._head += 1
+                self._condition.notify_all()
+                if buffer is None:
+                    self._is_flushing = False
+                    return
+            try:
+                buffer.seek(0)
+                self._copy(lambda: shutil.copyfileobj(buffer, self._output,
+                                                      CHUNK_SIZE))
+            except (OSError, ValueError):
+                with self._condition:
+                    self._is_flushing = False
+                return  # the stream has failed
+            finally:
+                buffer.close()
+
+
+def _pipe_output(process: subprocess.Popen, part: StreamPart,
+                 errors: list):
+    # Once the part can't be written, the process is stopped, and the rest
+    # of its output is dropped, so that it never blocks on a full pipe
+    for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):
+        if errors != []:
+            continue
+        try:
+            part.write(chunk)
+        except Exception as e:
+            errors.append(e)
+            process.kill()
+
+
+def _close_input(process: subprocess.Popen):
+    try:
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+
+
+def _run_part(
+    command: [str],
+    part: StreamPart,
+    write_input=None,
+    cpus: [int] = [],
+):
+    # Output is read in another thread, so neither pipe can fill up
+    process = subprocess.Popen(command,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    pin(process.pid, cpus)
+    errors = []
+    reader = Thread(target=_pipe_output, args=(process, part, errors),
+                    daemon=True)
+    reader.start()
+    try:
+        if write_input is not None:
+            write_input(process.stdin)
+    except BrokenPipeError:
+        pass  # ffmpeg has exited, and says why below
+    finally:
+        _close_input(process)
+        reader.join()
+        process.wait()
+    if errors != []:
+        raise errors[0]
+    if process.returncode != 0:
+        raise RuntimeError("ffmpeg exited with %i" % process.returncode)
+
+
+def encode_part(
+    video: VideoClip,
+    part: StreamPart,
+    fps: float,
+    threads: int = 0,
+    cpus: [int] = [],
+):
+    """Encode a video into a part of an ordered MPEG-TS stream"""
+    try:
+        with tempfile.TemporaryDirectory() as temp_folder:
+            if video.audio is not None:
+                audio_filename = os.path.join(temp_folder, "audio.wav")
+                video.audio.write_audiofile(audio_filename,
+                                            fps=AUDIO_FPS,
+                                            codec="pcm_s16le",
+                                            logger=None)
+                audio_input = ["-i", audio_filename]
+            else:
+                audio_input = ["-f", "lavfi", "-i",
+                               "anullsrc=r=%i:cl=stereo" % AUDIO_FPS]
+            command = [
+                "ffmpeg", "-v", "quiet", "-y",
+                "-f", "rawvideo", "-pix_fmt", "rgb24",
+                "-s", "%ix%i" % tuple(video.size),
+                "-r", str(fps), "-i", "-",
+            ] + audio_input + [
+                "-map", "0:v:0", "-map", "1:a:0",
+                "-t", str(video.duration),
+                "-c:v", "libx264", "-preset", FFMPEG_PRESET,
+                "-pix_fmt", "yuv420p",
+                "-c:a", "libmp3lame",
+                "-threads", str(threads),
+                "-f", "mpegts", "-",
+            ]
+
+            def write_frames(stdin):
+                for frame in video.iter_frames(fps=fps, dtype="uint8"):
+                    stdin.write(frame[:, :, :3].tobytes())
+            _run_part(command, part, write_frames, cpus)
+    except Exception as e:
+        part.fail(e)
+        raise
+    part.close()
+    return part.index
+
+
+def copy_part(filename: str, part: StreamPart, encode: bool = False):
+    """Copy a saved video into a part of an ordered MPEG-TS stream"""
+    codecs = ["-c", "copy"]
+    if encode:  # for codecs that MPEG-TS can't carry
+        codecs = ["-c:v", "libx264", "-preset", FFMPEG_PRESET,
+                  "-pix_fmt", "yuv420p", "-c:a", "libmp3lame"]
+    command = ["ffmpeg", "-v", "quiet", "-y", "-i", filename,
+               "-map", "0:v:0", "-map", "0:a:0"] + codecs + [
+               "-f", "mpegts", "-"]
+    try:
+        _run_part(command, part)
+    except Exception as e:
+        part.fail(e)
+        raise
+    part.close()
+    return part.index
+
+
+class _MuxerInput:
+    """
+    Input of a muxer, which says why the muxer failed once it can't be
+    written. The muxer's log is shown as it comes, keeping its end.
+    """
+
+    def __init__(self, process: subprocess.Popen):
+        self._process = process
+        self._log = b""
+        self._reader = Thread(target=self._read_log, daemon=True)
+        self._reader.start()
+
+    def _read_log(self):
+        # Read as it comes, as progress lines end without a line feed
+        while True:
+            data = os.read(self._process.stderr.fileno(), CHUNK_SIZE)
+            if data == b"":
+                return
+            sys.stderr.write(data.decode(errors="replace"))
+            sys.stderr.flush()
+            self._log = (self._log + data)[-LOG_SIZE:]
+
+    def write(self, data: bytes):
+        try:
+            self._process.stdin.write(data)
+        except OSError:
+            raise OSError(self.describe_failure())
+
+    def close(self):
+        _close_input(self._process)
+        self._process.wait()
+        self._reader.join()
+
+    def describe_failure(self) -> str:
+        self.close()
+        # Errors, without the progress lines around them
+        lines = [line.strip() for line in self._log.decode(
+            errors="replace").replace("\r", "\n").split("\n")]
+        errors = [line for line in lines
+                  if line != "" and not line.startswith("frame=")
+                  and not line.startswith("size=")]
+        if self._process.returncode < 0:
+            status = "was killed by signal %i" % -self._process.returncode
+        else:
+            status = "exited with %i" % self._process.returncode
+        return "muxer %s: %s" % (status, " ".join(errors[-5:]) or "no error")
+
+
+def mux_stream(stream: OrderedStream, metadata_filename: str, filename: str):
+    """Copy all parts of a stream, in order, into the final video"""
+    command = ["ffmpeg", "-v", "error", "-stats", "-y",
+               "-f", "mpegts", "-i", "-",
+               "-i", metadata_filename,
+               "-map", "0", "-c", "copy", "-map_metadata", "1",
+               filename]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output = _MuxerInput(process)
+    try:
+        stream.start(output)
+    finally:
+        output.close()
+    if process.returncode != 0:
+        raise RuntimeError(output.describe_failure())
+    return filename
@@ -0,0 +1,159 @@
+import os
+import hashlib
+import subprocess
+from contextlib import AbstractContextManager
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from threading import Lock
+
+from constants import CACHE_FOLDER, PROXY_HEIGHT, PROXY_FPS,\
+    MEZZANINE_CRF, MEZZANINE_GOP
+from cpu import allocate
+from probe import get_content_hash
+
+
+def get_proxy_args(height: int = PROXY_HEIGHT, fps: float = PROXY_FPS):
+    """Small, silent, short-GOP video that is cheap to seek and decode"""
+    return [
+        "-an",
+        "-vf", "scale=-2:%i" % height,
+        "-r", str(fps),
+        "-c:v", "libx264",
+        "-preset", "ultrafast",
+        "-tune", "fastdecode",
+        "-g", str(int(fps) // 3 or 1),
+        "-crf", "28",
+        "-threads", "1",
+    ]
+
+
+def get_mezzanine_args(dims: (int, int), fps: float):
+    """
+    Output size, constant frame rate video with short GOPs, that is cheap
+    to seek and decode, whatever the codec and frame rate of the source
+    """
+    return [
+        "-vf", "scale=%i:%i" % dims,
+        "-r", str(fps),
+        "-vsync", "cfr",
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-g", str(max(1, round(fps * MEZZANINE_GOP))),
+        "-crf", str(MEZZANINE_CRF),
+        "-pix_fmt", "yuv420p",
+        "-c:a", "pcm_s16le",
+        "-ar", "44100",
+        "-threads", "2",
+    ]
+
+
+def _get_cache_key(
+    filename: str,
+    args: [str],
+    by_content: bool = False,
+) -> str:
+    if by_content:
+        # Copies of a file share a key, wherever they are and whatever
+        # their names
+        source = get_content_hash(filename)
+    else:
+        stat = os.stat(filename)
+        source = "{}|{}|{}".format(
+            os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    key = "{}|{}".format(source, " ".join(args))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _transcode(source: str, target: str, args: [str]) -> str:
+    # Write to a temporary file, so interrupted transcodes are never reused
+    temp_target = target + ".part" + os.path.splitext(target)[1]
+    command = ["ffmpeg", "-v", "quiet", "-y", "-i", source] + args
+    try:
+        with allocate(source, encoder=False):
+            subprocess.run(command + [temp_target], check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("\r\nTranscoding (%s) failed: %s" % (source, e))
+        if os.path.exists(temp_target):
+            os.remove(temp_target)
+        return None
+    os.replace(temp_target, target)
+    return target
+
+
+class TranscodeCache(AbstractContextManager):
+    """
+    Transcodes source files in the background, caching the results on disk.
+
+    Each transcode runs in its own ffmpeg process; the worker threads only
+    wait on them, so at most `max_workers` ffmpeg processes run at once.
+    """
+
+    def __init__(
+        self,
+        args: [str],
+        folder: str = os.path.join(CACHE_FOLDER, "proxies"),
+        max_workers: int = None,
+        ext: str = "mp4",
+        by_content: bool = False,
+    ):
+        """by_content: cache by the contents of files, not their paths"""
+        self.args = args
+        self.ext = ext
+        self.by_content = by_content
+        self.folder = os.path.expanduser(folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or max(1, (os.cpu_count() or 2) // 2))
+        self._futures = {}
+        self._targets = {}
+        self._lock = Lock()
+
+    def __exit__(self, *args, **kwargs):
+        # Abandon transcodes that haven't started; finished ones are cached
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_filename(self, filename: str) -> str:
+        return os.path.join(self.folder, "{}.{}".format(
+            _get_cache_key(filename, self.args, self.by_content), self.ext))
+
+    def submit(self, filenames: [str]):
+        """Queue each file for transcoding, in order, unless cached"""
+        with self._lock:
+            for filename in filenames:
+                filename = os.path.abspath(filename)
+                if filename in self._futures or not os.path.isfile(filename):
+                    continue
+                self._futures[filename] = self._executor.submit(
+                    self._get_or_transcode, filename)
+
+    def get(self, filename: str) -> str:
+        """Return the transcoded file, or None if it is not ready yet"""
+        with self._lock:
+            future = self._futures.get(os.path.abspath(filename))
+        if future is None or not future.done() or future.cancelled():
+            return None
+        return future.result()
+
+    def wait(self, filename: str) -> str:
+        """Return the transcoded file once it is ready, or None if failed"""
+        with self._lock:
+            future = self._futures.get(os.path.abspath(filename))
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except CancelledError:
+            return None
+
+    def _get_or_transcode(self, filename: str) -> str:
+        try:
+            target = self.get_filename(filename)
+        except OSError as e:
+            print("\r\nTranscoding (%s) failed: %s" % (filename, e))
+            return None
+        # Copies of a file share a target, which is only transcoded once
+        with self._lock:
+            target_lock = self._targets.setdefault(target, Lock())
+        with target_lock:
+            if os.path.exists(target):
+                return target
+            return _transcode(filename, target, self.args)
@@ -1,28 +1,16 @@
-import sys
-import random
-
 from contextlib import ExitStack
 
+import numpy as np
 from moviepy import Clip
 from moviepy.audio.AudioClip import AudioClip
 from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
 from moviepy.video.compositing.transitions import crossfadein
+from moviepy.video.fx.resize import resize
 from moviepy.video.io.VideoFileClip import VideoFileClip
-from moviepy.video.VideoClip import TextClip, VideoClip, ColorClip
-
-from constants import FADE_DURATION, TRANSITION_DURATION
-
+from moviepy.video.VideoClip import ImageClip, TextClip, VideoClip, ColorClip
 
-class SourceFile:
-
-    @staticmethod
-    def get_random_start():
-        """Skip first 15-25 seconds"""
-        return 15 + random.random() * 10
-
-    def __init__(self, clip):
-        self.start = SourceFile.get_random_start()
-        self.clip = clip
+from constants import CREDIT_DISPLAY_TIME, FADE_DURATION, TRANSITION_DURATION
+from credit import RoundCredits
 
 
 def get_black_clip(dims: (int, int), duration=2 * FADE_DURATION):
@@ -34,6 +22,8 @@ def get_round_name(basename: str, rname: str, ext: str):
 
 
 def blank_audio(t: float):
+    if np.ndim(t) > 0:  # a chunk of times, as when writing audio
+        return np.zeros((len(t), 2))
     return [0, 0]
 
 
@@ -85,16 +75,144 @@ def crossfade(
     return CompositeVideoClip(videos)
 
 
-def draw_progress_bar(percent: float, barLen: int = 20):
+def _make_credit_texts(credit: str, first=""):
+    num_lines = credit.count("\n")
+    return [
+        [first, credit],
+        *([["\n", ""]] * num_lines),
+        ["\n", "\n"]
+    ]
+
+
+def _make_round_credits(
+    round_credits: RoundCredits,
+    round_index: int,
+    width: int,
+    height: int,
+    color: str = 'white',
+    stroke_color: str = 'black',
+    stroke_width: str = 2,
+    font: str = 'Impact-Normal',
+    fontsize: int = 60,
+    gap: int = 0
+) -> Clip:
+    texts = []
+    texts += [["\n", "\n"]] * 16
+    if round_credits.audio != []:
+        texts += _make_credit_texts(
+            str(round_credits.audio[0]),
+            "ROUND {} MUSIC".format(round_index + 1))
+        for audio_credit in round_credits.audio[1:]:
+            texts += _make_credit_texts(str(audio_credit))
+    if round_credits.video != []:
+        texts += _make_credit_texts(
+            str(round_credits.video[0]),
+            "ROUND {} VIDEOS".format(round_index + 1))
+        for video_credit in round_credits.video[1:]:
+            texts += _make_credit_texts(str(video_credit))
+    texts += [["\n", "\n"]] * 2
+
+    # Make two columns for the credits
+    left, right = ("".join(t) for t in zip(*texts))
+    left, right = [TextClip(txt, color=color, stroke_color=stroke_color,
+                            stroke_width=stroke_width, font=font,
+                            fontsize=fontsize, align=al)
+                   for txt, al in [(left, 'East'), (right, 'West')]]
+    # Combine the columns
+    cc = CompositeVideoClip([left, right.set_position((left.w + gap, 0))],
+                            size=(left.w + right.w + gap, right.h),
+                            bg_color=None)
+
+    scaled = resize(cc, width=width)  # Scale to the required size
+
+    # Transform the whole credit clip into an ImageClip
+    credits_video = ImageClip(scaled.get_frame(0))
+    mask = ImageClip(scaled.mask.get_frame(0), ismask=True)
+
+    lines_per_second = height / CREDIT_DISPLAY_TIME
+
+    def scroll(t): return ("center", -lines_per_second * t)
+    credits_video = credits_video.set_position(scroll)
+    credits_duration = credits_video.h / lines_per_second
+    credits_video = credits_video.set_duration(credits_duration)
+
+    return credits_video.set_mask(mask)
+
+
+def make_credits(
+        credits_data: [RoundCredits],
+        width: int,
+        height: int,
+        color: str = 'white',
+        stroke_color: str = 'black',
+        stroke_width: str = 2,
+        font: str = 'Impact-Normal',
+        fontsize: int = 60,
+        gap: int = 0
+) -> Clip:
     """
-    REQ: percent in interval [0, 1]
+
+    Parameters
+    -----------
+
+    credits_data
+      A list of RoundCredits objects
+
+    width
+      Total width of the credits text in pixels
+
+    gap
+      Horizontal gap in pixels between the jobs and the names
+
+    color
+      Color of the text. See ``TextClip.list('color')``
+      for a list    of acceptable names.
+
+    font
+      Name of the font to use. See ``TextClip.list('font')`` for
+      the list of fonts you can use on your computer.
+
+    fontsize
+      Size of font to use
+
+    stroke_color
+      Color of the stroke (=contour line) of the text. If ``None``,
+      there will be no stroke.
+
+    stroke_width
+      Width of the stroke, in pixels. Can be a float, like 1.5.
+
+
+    Returns
+    ---------
+
+    image
+      An ImageClip instance that looks like this and can be scrolled
+      to make some credits:
+
+          Executive Story Editor    MARCEL DURAND
+             Associate Producers    MARTIN MARCEL
+                                    DIDIER MARTIN
+                Music Supervisor    JEAN DIDIER
+
     """
-    # https://stackoverflow.com/questions/3002085/
-    assert percent >= 0 and percent <= 1
-    sys.stdout.write("\r")
-    sys.stdout.write("{:<{}} {:.0f}%".format(
-        "." * int(barLen * percent), barLen, percent * 100))
-    sys.stdout.flush()
+    credits_videos = []
+    for round_index, round_credits in enumerate(credits_data):
+        if round_credits is None:
+            continue
+        credits_videos.append(_make_round_credits(
+            round_credits,
+            round_index,
+            width * 0.7,
+            height,
+            color=color,
+            stroke_color=stroke_color,
+            stroke_width=stroke_width,
+            font=font,
+            fontsize=fontsize,
+            gap=gap
+        ))
+    return crossfade([get_black_clip((width, height)), *credits_videos])
 
 
 def get_time_components(time_in_seconds: float) -> (int, int, int, int):
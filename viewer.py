@@ -0,0 +1,348 @@
+import PIL.Image
+import PIL.ImageTk
+import time
+import tkinter
+import math
+from moviepy.video.VideoClip import VideoClip
+from moviepy.video.fx.resize import resize
+
+from constants import DISPLAY_SIZE, PREVIEW_FPS
+from preview import FrameBuffer, make_preview_video
+
+
+class ResizingCanvas(tkinter.Canvas):
+    # from https://stackoverflow.com/questions/22835289/
+    def __init__(self, parent, **kwargs):
+        tkinter.Canvas.__init__(self, parent, **kwargs)
+        self.bind("<Configure>", self.on_resize)
+        self.height = self.winfo_reqheight()
+        self.width = self.winfo_reqwidth()
+
+    def on_resize(self, event):
+        # determine the ratio of old width/height to new width/height
+        wscale = float(event.width)/self.width
+        hscale = float(event.height)/self.height
+        self.width = event.width
+        self.height = event.height
+        # resize the canvas
+        self.config(width=self.width, height=self.height)
+        # rescale all the objects tagged with the "all" tag
+        self.scale("all", 0, 0, wscale, hscale)
+
+
+class PreviewGUI:
+    def __init__(self,
+                 clips: [VideoClip],
+                 choose: lambda: int,
+                 display_size: (int, int) = DISPLAY_SIZE,
+                 fps: int = PREVIEW_FPS,
+                 frames: FrameBuffer = None):
+        self.window = tkinter.Tk()
+        self.window.title("Preview: Choose which version to use")
+        self.display_size = display_size
+        self._choose = choose
+        self.fps = fps
+        self.update_id = None
+        self.display_id = None
+        self.is_full_screen = False
+        self.num_versions = len(clips)
+
+        # Create a canvas that can fit the above video source size
+        self.canvas = ResizingCanvas(self.window,
+                                     width=display_size[0],
+                                     height=display_size[1],
+                                     highlightthickness=0)
+        self.canvas.pack(fill=tkinter.BOTH, expand=tkinter.YES)
+
+        # Add handlers to canvas for input
+        for key in [str(k) for k in range(1, len(clips) + 1)]:
+            self.window.bind(key, self.on_number_key)
+        self.window.bind("<Button-1>", self.on_click)
+        self.window.bind("<Escape>", self.exit)
+        self.window.bind('f', self.toggle_full_screen)
+        self.window.bind('r', self.refresh_sources)
+        self.window.bind("<Left>", self.scrub_backward)
+        self.window.bind("<Right>", self.scrub_forward)
+        self.window.bind("<Key-space>", lambda e: self.pause()
+                         if self.is_playing else self.play())
+
+        # Prepare the clips by combining them into a composite clip,
+        # unless that was already done (and is already being decoded)
+        self.square_size = math.ceil(math.sqrt(len(clips)))
+        if frames is None:
+            frames = FrameBuffer(make_preview_video(clips, display_size), fps)
+        else:
+            frames.set_window(2.0, 1.0)
+        # TODO: fix fullscreen
+        # self.fullscreen_video = resize(
+        #   clips_array(segments), height=self.window.winfo_screenheight())
+        self.native_video = frames.video
+        self.video = self.native_video
+        self.frames = frames
+        self.photo = None
+
+        self.dt = 1.0 / fps
+        self.t = 0
+        self.is_playing = False
+        self.display()
+
+    def run(self):
+        self.play()
+        self.window.mainloop()
+        self.frames.close()
+        self.window.destroy()
+
+    def play(self):
+        self.is_playing = True
+        self.t0 = time.time() - self.t
+        self.update()
+
+    def pause(self):
+        self.is_playing = False
+        if self.update_id is not None:
+            self.window.after_cancel(self.update_id)
+
+    def scrub_backward(self, _: tkinter.Event = None):
+        adjust = 5.0 if self.is_playing else 1.0 / self.fps
+        if adjust > self.t:
+            adjust = self.t
+        self.t0 += adjust
+        self.t -= adjust
+        self.display()
+
+    def scrub_forward(self, _: tkinter.Event = None):
+        adjust = 5.0 if self.is_playing else 1.0 / self.fps
+        remainder = self.video.duration - self.t
+        if adjust > remainder:
+            adjust = remainder
+
+        self.t0 -= adjust
+        self.t += adjust
+        self.display()
+
+    def exit(self, _: tkinter.Event = None):
+        self.pause()
+        if self.display_id is not None:
+            self.window.after_cancel(self.display_id)
+        self.window.quit()
+
+    def on_click(self, event: tkinter.Event):
+        x_dim, y_dim = self.display_size
+        x = math.floor(event.x / x_dim * self.square_size)
+        y = math.floor(event.y / y_dim * self.square_size)
+        choice = y * self.square_size + x
+        if choice < 0 or choice > self.num_versions:
+            return
+        else:
+            self._choose(choice)
+            self.exit(event)
+
+    def on_number_key(self, event):
+        self._choose(int(event.char) - 1)
+        self.exit(event)
+
+    def toggle_full_screen(self, _: tkinter.Event = None):
+        pass
+        """
+        self.is_full_screen = not self.is_full_screen
+        self.window.attributes("-fullscreen", self.is_full_screen)
+        self.video = (self.fullscreen_video if self.is_full_screen
+                      else self.native_video)
+        """
+
+    def refresh_sources(self, _: tkinter.Event = None):
+        # TODO: refresh source clips
+        # self.video = self.assemble_video(self.callback())
+        pass
+
+    def display(self):
+        index = min(int(self.t * self.fps), self.frames.num_frames - 1)
+        image = self.frames.get(index)
+
+        # Frames are never waited for; while paused, show it once decoded
+        if self.display_id is not None:
+            self.window.after_cancel(self.display_id)
+            self.display_id = None
+        if not self.is_playing and not self.frames.is_buffered(index):
+            self.display_id = self.window.after(int(1000 * self.dt),
+                                                self.display)
+        if image is None:
+            return
+        if self.photo is None:
+            self.photo = PIL.ImageTk.PhotoImage(image=image)
+            self.canvas.create_image(0, 0, image=self.photo,
+                                     anchor=tkinter.NW)
+        else:
+            self.photo.paste(image)  # Update the one canvas image in place
+        self.canvas.update()
+
+    def update(self):
+        if not self.is_playing:
+            return
+
+        # Get the current frame from the video source
+        start = time.time()
+        self.t = start - self.t0
+        if self.t >= self.video.duration:  # Repeat clips on loop
+            self.t0 = time.time()
+            self.t = 0
+
+        self.display()
+
+        # Repeat update after delay, respecting framerate
+        stop = time.time()
+        lost_time = stop - start
+        wait = max(0, int(1000 * (self.dt - lost_time)))
+        self.update_id = self.window.after(wait, self.update)
+
+
+class ContactSheetGUI:
+    """
+    Shows a strip of thumbnails for each version, one version per row.
+    Hovering over (or selecting with Up/Down) a row plays that version
+    beside the strips, unless hover-to-play is toggled off with 'h'.
+    """
+
+    LABEL_WIDTH = 60
+
+    def __init__(self,
+                 clips: [VideoClip],
+                 thumbnails: [[PIL.Image.Image]],
+                 choose: lambda: int,
+                 display_size: (int, int) = DISPLAY_SIZE,
+                 fps: int = PREVIEW_FPS,
+                 selected: int = 0):
+        self.window = tkinter.Tk()
+        self.window.title("Contact sheet: Choose which version to use")
+        self._choose = choose
+        self.clips = clips
+        self.fps = fps
+        self.num_versions = len(clips)
+        self.row_height = display_size[1] // self.num_versions
+        self.strip_width = self.LABEL_WIDTH + max(
+            sum(image.width for image in strip) for strip in thumbnails)
+        self.pane_size = (max(1, display_size[0] - self.strip_width),
+                          display_size[1])
+        self.canvas = tkinter.Canvas(self.window,
+                                     width=display_size[0],
+                                     height=display_size[1],
+                                     background="black",
+                                     highlightthickness=0)
+        self.canvas.pack(fill=tkinter.BOTH, expand=tkinter.YES)
+
+        # Draw the strips, keeping references to their images
+        self.photos = []
+        for v_i, strip in enumerate(thumbnails):
+            y = v_i * self.row_height
+            self.canvas.create_text(self.LABEL_WIDTH // 2,
+                                    y + self.row_height // 2,
+                                    text=str(v_i + 1),
+                                    fill="white",
+                                    font="Impact 24")
+            x = self.LABEL_WIDTH
+            for image in strip:
+                self.photos.append(PIL.ImageTk.PhotoImage(image=image))
+                self.canvas.create_image(x, y, image=self.photos[-1],
+                                         anchor=tkinter.NW)
+                x += image.width
+        self.highlight = self.canvas.create_rectangle(
+            0, 0, self.strip_width, self.row_height,
+            outline="yellow", width=3)
+
+        # Add handlers to canvas for input
+        for key in [str(k) for k in range(1, len(clips) + 1)]:
+            self.window.bind(key, self.on_number_key)
+        self.window.bind("<Button-1>", self.on_click)
+        self.window.bind("<Motion>", self.on_motion)
+        self.window.bind("<Up>", lambda e: self.select(self.selected - 1))
+        self.window.bind("<Down>", lambda e: self.select(self.selected + 1))
+        self.window.bind("<Return>", self.on_return)
+        self.window.bind("<Escape>", self.exit)
+        self.window.bind('h', self.toggle_hover_play)
+
+        self.is_hover_playing = True
+        self.frames = None
+        self.photo = None
+        self.update_id = None
+        self.selected = selected
+        self.select(selected)
+
+    def run(self):
+        self.window.mainloop()
+        self.stop_playing()
+        self.window.destroy()
+
+    def exit(self, _: tkinter.Event = None):
+        self.stop_playing()
+        self.window.quit()
+
+    def select(self, version: int):
+        self.selected = version % self.num_versions
+        y = self.selected * self.row_height
+        self.canvas.coords(self.highlight,
+                           0, y, self.strip_width, y + self.row_height)
+        if self.is_hover_playing:
+            self.play(self.selected)
+
+    def on_motion(self, event: tkinter.Event):
+        row = event.y // self.row_height
+        if (event.x < self.strip_width and 0 <= row < self.num_versions
+                and row != self.selected):
+            self.select(row)
+
+    def on_click(self, event: tkinter.Event):
+        row = event.y // self.row_height
+        if event.x < self.strip_width and 0 <= row < self.num_versions:
+            self._choose(row)
+            self.exit(event)
+
+    def on_return(self, event: tkinter.Event):
+        self._choose(self.selected)
+        self.exit(event)
+
+    def on_number_key(self, event: tkinter.Event):
+        self._choose(int(event.char) - 1)
+        self.exit(event)
+
+    def toggle_hover_play(self, _: tkinter.Event = None):
+        self.is_hover_playing = not self.is_hover_playing
+        if self.is_hover_playing:
+            self.play(self.selected)
+        else:
+            self.stop_playing()
+
+    def play(self, version: int):
+        self.stop_playing()
+        clip = self.clips[version]
+        scale = min(self.pane_size[0] / clip.w, self.pane_size[1] / clip.h)
+        self.frames = FrameBuffer(
+            resize(clip, (int(clip.w * scale), int(clip.h * scale))),
+            self.fps)
+        self.t0 = time.time()
+        self.update()
+
+    def stop_playing(self):
+        if self.update_id is not None:
+            self.window.after_cancel(self.update_id)
+            self.update_id = None
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+
+    def update(self):
+        start = time.time()
+        image = self.frames.get(int((start - self.t0) * self.fps))
+        if image is not None:
+            if self.photo is None or self.photo.width() != image.width \
+                    or self.photo.height() != image.height:
+                self.canvas.delete("pane")
+                self.photo = PIL.ImageTk.PhotoImage(image=image)
+                self.canvas.create_image(self.strip_width, 0,
+                                         image=self.photo,
+                                         anchor=tkinter.NW,
+                                         tags="pane")
+            else:
+                self.photo.paste(image)
+        lost_time = time.time() - start
+        wait = max(0, int(1000 * (1.0 / self.fps - lost_time)))
+        self.update_id = self.window.after(wait, self.update)
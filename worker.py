@@ -0,0 +1,46 @@
+#! /usr/bin/env python3
+import os
+import argparse
+
+from constants import WORKER_PORT
+from main import configure_moviepy
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description="Save segments of rounds rendered elsewhere, with"
+                    " --workers, in a folder shared with them.")
+    parser.add_argument(
+        "-H", "--host",
+        help="address to listen on; 0.0.0.0 for other machines, on a"
+             " trusted network only (default: this computer only)",
+        default="127.0.0.1")
+    parser.add_argument(
+        "-p", "--port",
+        help="port to listen on",
+        type=int,
+        default=WORKER_PORT)
+    parser.add_argument(
+        "-t", "--threads",
+        help="number of slices of cuts saved at once",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "folder",
+        help="shared folder that rendering runs in, or one containing it,"
+             " at the same path as on the rendering computer"
+             " (default: current folder)",
+        nargs="?",
+        default=os.getcwd())
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    configure_moviepy()
+    from distributed import serve_segments
+    serve_segments(args.host, args.port, args.folder, args.threads)
+
+
+if __name__ == "__main__":
+    main()